@@ -0,0 +1,176 @@
+"""
+Rendering benchmarks for Linnaeo. Builds synthetic alignments over a grid of sequence counts, lengths, gap fractions,
+structure tracks and themes, and times (and memory-profiles) each stage of drawing an alignment window:
+
+    seqInit      AlignSubWindow.seqInit -- the residue store and its color layer
+    redrawFancy  utilities.redrawFancy -- colored HTML for the whole alignment
+    redrawBasic  utilities.redrawBasic -- plain HTML, as drawn while resizing
+    buildRuler   utilities.buildRuler, with its cache cleared first, for every wrapped line
+    nameArrange  AlignSubWindow.nameArrange -- the name pane
+    setHtml      AlignPane.setHtml with the redrawFancy output
+
+Runs under the Qt offscreen platform, so no display is needed, and writes the results as JSON:
+
+    python benchmarks/render.py -o before.json
+    python benchmarks/render.py -o after.json --compare before.json
+
+With --compare, any stage that got slower by more than --threshold (default 20%) is listed and the exit code is 1.
+--quick runs a small grid for a smoke test.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psutil
+from PyQt5.QtCore import QT_VERSION_STR, PYQT_VERSION_STR
+
+from linnaeo import __version__
+from linnaeo.main import LinnaeoApp, Linnaeo
+from linnaeo.classes import utilities
+from linnaeo.classes.displays import AlignSubWindow
+
+AMINO = "ACDEFGHIKLMNPQRSTVWY"
+GRID = {'seqs': [10, 100, 500], 'length': [500, 5000], 'gaps': [0.0, 0.3], 'dssp': [False, True],
+        'theme': ['Default', 'Conservation']}
+QUICK = {'seqs': [10, 50], 'length': [300], 'gaps': [0.2], 'dssp': [False, True], 'theme': ['Default']}
+
+
+def makeAlignment(seqs, length, gaps, seed=0):
+    """ Random aligned sequences, each column a gap with the given probability. """
+    rand = random.Random(seed)
+    return {"seq%d" % n: "".join("-" if rand.random() < gaps else rand.choice(AMINO) for _ in range(length))
+            for n in range(seqs)}
+
+
+def makeStructure(length, seed=0):
+    """ DSSP-like codes for one sequence: runs of helix, strand and coil. """
+    rand = random.Random(seed)
+    codes = {}
+    resid = 1
+    while resid <= length:
+        code, run = rand.choice("HE-"), rand.randint(3, 15)
+        for resid in range(resid, min(length, resid + run) + 1):
+            codes[resid] = code
+        resid += 1
+    return codes
+
+
+def measure(func, repeat):
+    """ Median and all wall times of func over repeat runs, plus the Python heap peak and RSS growth of the first. """
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    times = [time.perf_counter() - start]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    grown = process.memory_info().rss - rss
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'seconds': statistics.median(times), 'runs': times, 'peakKB': peak // 1024, 'rssKB': grown // 1024}
+
+
+def benchCase(app, window, case, repeat):
+    """ Every stage for one alignment; the window is shown (offscreen) so nothing is put off. """
+    alignment = makeAlignment(case['seqs'], case['length'], case['gaps'])
+    widget = AlignSubWindow(alignment, window.optionsPane.params)
+    widget.resize(1000, 800)
+    widget.show()
+    app.processEvents()
+    widget.theme = utilities.lookupTheme(case['theme'])
+    if case['theme'] == 'Conservation':
+        # Conservation colors residues against a reference; without one the whole alignment is a single color
+        widget.refseq = 0
+        widget.consvColors = True
+    widget.dssps = {0: makeStructure(case['length'])} if case['dssp'] else {}
+    chars = 80
+    lines = int(widget.maxlen / chars) + 1
+    results = {}
+    results['seqInit'] = measure(lambda: widget.seqInit(force=True), repeat)
+    store = widget.store
+    html = []
+    results['redrawFancy'] = measure(
+        lambda: html.append(utilities.redrawFancy(store, chars, lines, True, True, case['dssp'])), repeat)
+    results['redrawBasic'] = measure(lambda: utilities.redrawBasic(store, chars, lines, True, case['dssp']), repeat)
+
+    def rulers():
+        utilities.buildRuler.cache_clear()
+        utilities.rulerLines(chars, lines, store.width)
+    results['buildRuler'] = measure(rulers, repeat)
+
+    def names():
+        # Only the full (non-virtual) layout draws every name at once
+        widget.virtual = False
+        widget.lines = 0
+        widget.nameArrange(lines)
+    results['nameArrange'] = measure(names, repeat)
+    style = widget.paneStyle()
+    results['setHtml'] = measure(lambda: widget.alignPane.setHtml(style + html[0]), repeat)
+    results['setHtml']['bytes'] = len(html[0])
+    widget.hide()
+    widget.deleteLater()
+    app.processEvents()
+    del alignment, widget, store, html, style
+    return results
+
+
+def compare(current, baseline, threshold):
+    """ Stages in current that are slower than the same case and stage in baseline by more than threshold. """
+    old = {(json.dumps(entry['case'], sort_keys=True), entry['stage']): entry['seconds']
+           for entry in baseline['results']}
+    slower = []
+    for entry in current['results']:
+        before = old.get((json.dumps(entry['case'], sort_keys=True), entry['stage']))
+        if before and entry['seconds'] > before * (1 + threshold):
+            slower.append((entry['case'], entry['stage'], before, entry['seconds']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Linnaeo rendering benchmarks")
+    parser.add_argument("-o", "--output", default="bench_render.json", help="JSON file for the results")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs per stage; the median is reported")
+    parser.add_argument("--quick", action="store_true", help="small grid, for checking the suite itself")
+    parser.add_argument("--compare", help="earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    app = LinnaeoApp([])
+    window = Linnaeo()
+    grid = QUICK if args.quick else GRID
+    cases = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+    output = {'meta': {'linnaeo': __version__, 'python': platform.python_version(), 'qt': QT_VERSION_STR,
+                       'pyqt': PYQT_VERSION_STR, 'platform': platform.platform(), 'repeat': args.repeat,
+                       'date': time.strftime("%Y-%m-%dT%H:%M:%S")},
+              'results': []}
+    for case in cases:
+        for stage, result in benchCase(app, window, case, args.repeat).items():
+            output['results'].append(dict(case=case, stage=stage, **result))
+            print("%-60s %-12s %9.4fs %8d KB" % (json.dumps(case), stage, result['seconds'], result['peakKB']))
+    with open(args.output, 'w') as handle:
+        json.dump(output, handle, indent=1)
+    print("Wrote %s" % args.output)
+    if args.compare:
+        with open(args.compare) as handle:
+            slower = compare(output, json.load(handle), args.threshold)
+        for case, stage, before, after in slower:
+            print("SLOWER %-60s %-12s %.4fs -> %.4fs" % (json.dumps(case), stage, before, after))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
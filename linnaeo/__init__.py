@@ -1,19 +1,22 @@
 __version__ = 'v0.3.2'
 import logging
+import multiprocessing
 import sys
 import time
 
-from PyQt5.QtCore import QFile, QByteArray, Qt
-from PyQt5.QtGui import QIcon, QPalette, QColor
-from PyQt5.QtWidgets import QStyle
-
-from linnaeo.main import LinnaeoApp, Linnaeo
-
 start_time = time.perf_counter()
 conout = None
 
 
 def main():
+    # Pairwise identity of large alignments spawns worker processes; frozen builds have to hand them off here
+    multiprocessing.freeze_support()
+    # The GUI is imported here rather than with the package, so worker processes importing linnaeo.classes don't
+    # load Qt and Clustal Omega
+    from PyQt5.QtCore import Qt
+    from PyQt5.QtGui import QIcon, QPalette, QColor
+    from linnaeo.main import LinnaeoApp, Linnaeo
+
     logging.basicConfig(level=logging.DEBUG, stream=sys.stderr)
     appLogger = logging.getLogger("INIT")
     #handler = logging.StreamHandler(sys.stderr)
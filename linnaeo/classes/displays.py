@@ -1,11 +1,14 @@
+import csv
 import logging
 
-from PyQt5.QtCore import pyqtSignal, Qt
-from PyQt5.QtGui import QFontMetricsF, QColor, QFont
-from PyQt5.QtWidgets import QWidget, QDialog, QDialogButtonBox, QPushButton, QTextEdit, QFrame, QSizePolicy, qApp
+import numpy
+from PyQt5.QtCore import pyqtSignal, Qt, QPoint, QTimer
+from PyQt5.QtGui import QColor
+from PyQt5.QtWidgets import QWidget, QDialog, QDialogButtonBox, QPushButton, QTextEdit, QFrame, QSizePolicy, qApp, \
+    QScrollBar, QVBoxLayout, QHBoxLayout, QComboBox, QLabel, QFileDialog
 
 from linnaeo import __version__
-from linnaeo.classes import widgets, utilities, themes
+from linnaeo.classes import widgets, utilities, themes, models, export, stats
 from linnaeo.classes.utilities import lookupTheme
 from linnaeo.ui import alignment_ui, quit_ui, about_ui, ali_settings_ui, comments_ui
 
@@ -16,9 +19,23 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
     Sequences in the alignment are threaded and prepared as HTML; the color is stored in the array in order to
     reduce the load on display. However, just drawing the display is computationally expensive (as is generating
     the ruler for it), so both are turned off during resizing.
+    In virtual mode (the default) only the wrapped lines in view, plus a little overscan, are drawn into the panes;
+    a separate scrollbar counts text rows across the whole alignment and the panes are refilled as it moves.
+    Drawn lines are kept in a per-window cache keyed by the layout, so going back to an earlier width is instant;
+    lines that are not cached are drawn off the GUI thread by the render service, latest request wins.
+    Painter mode skips the text document for the alignment itself: the pane copies pre-rasterized residue cells
+    from a glyph atlas for just the rows in view (virtual mode only; the names and side ruler stay as text).
+    The overview strip under the alignment shows all of it at once and jumps the view to wherever it is clicked.
+    With wrapping off, each sequence is one row: names, ruler and structure stay put while the residue area shows only
+    the columns and sequences under the two scrollbars, so a width change only redraws what is in view.
+    Windows that cannot be seen (closed, minimized or covered by another tab) only note what needs redoing; the
+    work is done once, in flush, when the window is shown or activated again.
     # TODO: This does not maintain the alignment order -- trouble with the ClustalO API. Shant be helped?...
     """
     resized = pyqtSignal()
+    # Font sizes under MINTEXT are block zoom levels instead, in pixels per column
+    MINTEXT = 5
+    BLOCKZOOM = {4: 4, 3: 2, 2: 1, 1: 0.5, 0: 0.25}
     nameChange = pyqtSignal((str, str))
     lineChange = pyqtSignal(int)
 
@@ -29,6 +46,11 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
         self.alignLogger = logging.getLogger("AlignWindow")
         self.alignPane = widgets.AlignPane(self)
         self.rulerPane = QTextEdit()
+        self.vScroll = QScrollBar(Qt.Vertical)
+        self.hScroll = QScrollBar(Qt.Horizontal)
+        self.overview = widgets.OverviewPane(self)
+        self.track = widgets.TrackPane(self)
+        self.blockPane = widgets.BlockPane(self)
         self.commentPane = CommentsPane()
         self.commentButton = QPushButton("Save")
 
@@ -37,7 +59,7 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
         self._seqs = seqs
         self.dssps = {}
         self.splitNames = []
-        self.splitSeqs = []
+        self.store = models.ResidueStore([])
         self.userIsResizing = False
         self.refseq = None
         self.last = 0
@@ -47,9 +69,22 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
         self.comments = {}
         self.showRuler = False
         self.showColors = False
+        self.showLogo = False
         self.consvColors = False
         self.showDSSP = True
         self.ssFontWidth = None
+        self.virtual = True
+        self.painted = False
+        self.zoom = 0
+        self.wrap = True
+        self.overscan = 1
+        self.charCount = 0
+        self.drawn = None
+        self.drawFlags = (True, True, True, True)
+        self.dirty = set()
+        self.blockCache = utilities.BlockCache()
+        self.renderer = utilities.RenderService(self)
+        self.timings = utilities.RenderTimings(self.alignLogger)
 
         # Draw the window
         self.setupUi(self)
@@ -60,15 +95,25 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
         self.alignPane.verticalScrollBar().valueChanged.connect(self.rulerPane.verticalScrollBar().setValue)
         self.alignPane.verticalScrollBar().valueChanged.connect(self.namePane.verticalScrollBar().setValue)
         #self.namePane.verticalScrollBar().valueChanged.connect(self.alignPane.verticalScrollBar().setValue)
+        self.vScroll.valueChanged.connect(lambda: self.viewportArrange())
+        self.hScroll.valueChanged.connect(self.linearArrange)
+        self.renderer.rendered.connect(self.linesRendered)
+        self.overview.jump.connect(self.jumpToColumn)
+        self.alignPane.verticalScrollBar().valueChanged.connect(self.overviewArrange)
+        self.blockPane.verticalScrollBar().valueChanged.connect(self.overviewArrange)
         self.nameChange.connect(self.updateName)
         self.lineChange.connect(self.nameArrange)
         #self.alignPane.commentAdded.connect(self.showCommentWindow)
 
         # Initialize settings
-        self.theme = lookupTheme('Default').theme
+        self.theme = lookupTheme('Default')
+        self.baseColors = None
+        self.baseTheme = None
+        self.gaps = self.store.gapMask()
         self.params = {}
         self.setParams(params)
-        self.ssFontWidth = QFontMetricsF(QFont("Default-Noto", self.params['fontsize'])).averageCharWidth()
+        self.ssFontWidth = utilities.fontMetrics(self.font().family(),
+                                                 max(self.MINTEXT, self.params['fontsize'])).ssWidth
         # print("Setting ssFONT Width to %s" % self.ssFontWidth)
 
         self.done = True
@@ -99,133 +144,232 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
             background-color:%s;}" % bgcolor.name())
         self.gridLayout_2.addWidget(self.alignPane, 0, 1)
         self.gridLayout_2.addWidget(self.rulerPane, 0, 2)
+        self.gridLayout_2.addWidget(self.vScroll, 0, 3)
+        self.vScroll.hide()
+        self.gridLayout_2.addWidget(self.track, 1, 1)
+        self.track.hide()
+        self.gridLayout_2.addWidget(self.overview, 3, 1)
+        self.gridLayout_2.addWidget(self.blockPane, 0, 1)
+        self.blockPane.hide()
+        self.gridLayout_2.addWidget(self.hScroll, 2, 1)
+        self.hScroll.hide()
         self.namePane.viewport().installEventFilter(self)
         self.rulerPane.viewport().installEventFilter(self)
+        self.alignPane.viewport().installEventFilter(self)
         del bgcolor
 
     def eventFilter(self, obj, event):
         #print(event.type())
         if event.type() == 31:
-            qApp.sendEvent(self.alignPane.viewport(), event)
-            return True
-        else:
-            return False
+            if self.virtual or not self.wrap:
+                # Panes only hold the lines in view, so wheel events drive the row scrollbar instead.
+                qApp.sendEvent(self.vScroll, event)
+                return True
+            elif obj is not self.alignPane.viewport():
+                qApp.sendEvent(self.alignPane.viewport(), event)
+                return True
+        return False
+
+    def setVirtual(self, state):
+        """ Switches between drawing the whole alignment into the panes and drawing only the lines in view. """
+        self.virtual = state
+        self.vScroll.setVisible((state or not self.wrap) and not self.zoom)
+        self.rulerPane.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff if state else Qt.ScrollBarAsNeeded)
+        self.alignPane.firstLine = 0
+        self.alignPane.setPainted(self.painted and state and self.wrap)
+        self.drawn = None
+        if self.done:
+            self.nameArrange(self.lines)
+            self.seqArrange()
+        del state
 
-    def seqInit(self):
+    def setPainted(self, state):
+        """ Switches the alignment pane between the text document and painting cells from the glyph atlas. """
+        self.painted = state
+        self.params['painter'] = state
+        self.alignPane.setPainted(state and self.virtual and self.wrap)
+        self.drawn = None
+        if self.done:
+            self.seqArrange()
+        del state
+
+    def rowsPerLine(self):
+        """ Number of text rows used by each wrapped line: ruler, structure, sequences and the blank spacer. """
+        return len(self.store) + int(self.showRuler) + int(self.showDSSP) + 1
+
+    def seqInit(self, force=False):
         """
-        Sequences are stored as double layer arrays of each character.
-        First layer is SEQUENCE
-        Second layer is SEQUENCE POSITION
-        Third layer is RESIDUE and COLOR
-        so self.seq = [SEQ = [Position = [HTML Char/Color, ResID, Dssp], ... ], ... ]
+        Sequences are stored column-wise in a ResidueStore (see models), one (sequence x position) array per layer:
+        residue character, residue number, DSSP code and an index into this window's color palette.
+        Everything is done as whole-array operations: residue numbers are a running count over the non-gap mask,
+        and structure codes are looked up by residue number. The color layer is left to colorInit, since it is the
+        only layer that depends on the theme and reference; changing those only ever recolors.
         """
-        self.splitSeqs = []
-        self.splitNames = []
-        self.maxname = 0
-        consv = True if self.theme == themes.Conservation().theme else False
-        comments = True if self.theme == themes.Comments().theme else False
-        for seq in self._seqs.values():
-            if len(seq) > self.maxlen:
-                self.maxlen = len(seq)
-        for name, seq in self._seqs.items():
-            self.splitNames.append(name)
-            if len(name) > self.maxname:
-                self.maxname = len(name)
-            if len(seq) < self.maxlen:
-                for n in range(self.maxlen - len(seq)):
-                    seq.append(" ")
-            local = []
-            count = 0
-            for i in range(self.maxlen):
-                char = seq[i]
-                if char not in ["-", " "]:
-                    color = None
-                    count += 1
-                    tcount = count
-                    dssp = None
-                    if not consv:
-                        #print("Consv theme is off, skipping alt colors")
-                        color = self.theme[char]
-                        #print("DEFAULTING %s to %s" % (char, color.name()))
-                        if self.consvColors and self.refseq is not None:
-                            ref = list(self._seqs.values())[self.refseq][i]
-                            compare = utilities.checkConservation(char, ref)
-                            if compare is not None:
-                         #       print(compare)
-                                if compare > 10:
-                                    color = QColor(Qt.white)
-                            else:
-                                color = QColor(Qt.white)
-                            del compare
-                    elif consv:
-                        #print("Consv theme iS ON", i)
-                        if self.consvColors and self.refseq is not None:
-                            ref = list(self._seqs.values())[self.refseq][i]
-                            compare = utilities.checkConservation(char, ref)
-                            if compare is not None and compare <= len(self.theme):
-                         #       print(compare)
-                                color = self.theme[compare]
-                            else:
-                                color = QColor(Qt.white)
-                            del compare
-                    if comments:
-                        if i in self.comments.keys():
-                            color = QColor(Qt.yellow)
-                    if not color:
-                        color = QColor(Qt.white)
-                    #print(color.name())
-                    tcolor = str(self.palette().color(self.alignPane.backgroundRole()).name()) if \
-                        color.getHsl()[2] / 255 * 100 <= 50 else '#000000'
-                    #print("tColor is %s" % tcolor)
-                    char = '<span style=\"background-color: %s; color: %s\">%s</span>' % (
-                        color.name(), tcolor, char)
-                    #print('char is now %s' % char)
-                    if self.dssps:
-                        index = list(self._seqs.values()).index(seq)
-                        try:
-                            # print("adding dssp")
-                            dssp = self.dssps[index][tcount]
-                        except KeyError:
-                            dssp = '-'
-                        del index
-                    else:
-                        dssp = None
+        self.splitNames = list(self._seqs.keys())
+        self.maxname = max([len(name) for name in self.splitNames]) if self.splitNames else 0
+        self.maxlen = max([self.maxlen] + [len(seq) for seq in self._seqs.values()])
+        if not force and self.deferred('init'):
+            return
+        self.dirty.discard('init')
+        with self.timings.span('seqInit', seqs=len(self._seqs), cols=self.maxlen):
+            store = models.ResidueStore(self._seqs.values())
+            store.number()
+            if self.dssps:
+                store.ss[:] = ord('-')
+                for row, dssp in self.dssps.items():
+                    if row < len(store):
+                        codes = numpy.full(int(store.resids[row].max()) + 1, ord('-'), dtype=numpy.uint8)
+                        for resid, code in dssp.items():
+                            if 0 < resid < len(codes):
+                                codes[resid] = ord(code)
+                        store.ss[row] = codes[store.resids[row]]
+            else:
+                store.ss[store.gapMask()] = ord('-')
+            old = self.store
+            if old.stats is not None and old.width == store.width:
+                # Renames and reorders only move rows, so the counts carry over, less any rows that really changed
+                gone, added = stats.rowChanges(old.residues, store.residues)
+                store.stats = old.stats.replaced(old.residues[gone], store.residues[added]) if gone or added \
+                    else old.stats
+                del gone, added
+            self.store = store
+            self.gaps = store.gapMask()
+            self.baseColors = None
+            self.alignPane.store = self.store
+        self.colorInit()
+        del store, old
+
+    def colorInit(self):
+        """
+        Builds the color layer of the residue store from the theme, and from the reference when coloring by
+        conservation. The theme colors of every residue do not depend on the reference, so they are kept until the
+        theme changes; a new reference is one conservation lookup and a mask on top of them.
+        Column themes color every residue of a column by a column statistic instead (see stats).
+        """
+        if 'init' in self.dirty:
+            # The store will be built, and colored, when the window is next shown
+            return
+        store = self.store
+        with self.timings.span('colorInit', seqs=len(store), cols=store.width):
+            consv = isinstance(self.theme, themes.Conservation)
+            comments = isinstance(self.theme, themes.Comments)
+            metric = self.theme.metric
+            palette, lut = self.themeLUT()
+            if self.baseColors is None or self.baseTheme is not self.theme:
+                if metric:
+                    bins = stats.scoreBins(store.columnStats().score(metric), len(self.theme.theme))
+                    self.baseColors = numpy.broadcast_to(lut[bins], store.residues.shape)
+                    del bins
+                elif not consv:
+                    self.baseColors = lut[store.residues]
                 else:
-                    char = '<span style=\"background-color:#FFFFFF;\">' + seq[i] + "</span>"
-                    tcount = 0
-                    dssp = "-"
-                local.append([char, tcount, dssp])
-            self.splitSeqs.append(local)
-            del i, char, color, tcount, dssp
-        self.alignPane.seqs = self.splitSeqs
-        del consv, comments, seq, name, local, count
+                    self.baseColors = numpy.broadcast_to(numpy.uint8(1), store.residues.shape)
+                self.baseTheme = self.theme
+            ref = None
+            if self.consvColors and self.refseq is not None and self.refseq < len(store) and not metric:
+                ref = utilities.conservationClasses(store.residues, store.residues[self.refseq])
+            if ref is None:
+                colors = self.baseColors.copy()
+            elif consv:
+                colors = lut[ref]
+            else:
+                # Only residues that are conserved with the reference keep their color.
+                colors = numpy.where(ref > 10, numpy.uint8(1), self.baseColors)
+            if comments and self.comments:
+                palette = palette + ((QColor(Qt.yellow).name(), '#000000'),)
+                columns = [col for col in self.comments.keys() if col < store.width]
+                colors[:, columns] = len(palette) - 1
+                del columns
+            colors[self.gaps] = 0
+            store.colors = colors
+            store.palette = palette
+            self.overview.setStore(store)
+            self.blockPane.setStore(store, self.splitNames)
+            self.track.setStore(store, self.logoColors(palette, lut))
+        del store, consv, comments, metric, palette, lut, ref, colors
+
+    def logoColors(self, palette, lut):
+        """ Color of each logo letter (stats.AMINO then X): a darker shade of its theme color, or plain text. """
+        text = self.alignPane.palette().text().color().name()
+        colors = [QColor(palette[lut[ord(aa)]][0]).darker(160).name() if lut[ord(aa)] > 1 else text
+                  for aa in stats.AMINO + "X"]
+        del palette, lut, text
+        return colors
+
+    def themeLUT(self):
+        """ Current theme as (palette, lookup table), compiled once per text color; see themes.compileTheme. """
+        return self.theme.compiled(str(self.palette().color(self.alignPane.backgroundRole()).name()))
 
     def nameArrange(self, lines):
         """ Generates the name panel; only fires if the number of lines changes to avoid needless computation"""
         if lines:
-            self.namePane.clear()
             self.namePane.setMinimumWidth((self.maxname * self.fmF.averageCharWidth()) + 5)
+            if self.virtual or not self.wrap:
+                # Names are drawn with the rest of the viewport
+                self.drawn = None
+                del lines
+                return
+            with self.timings.span('nameArrange', seqs=len(self.splitNames), lines=lines):
+                self.namePane.clear()
+                self.namePane.setHtml(self.nameHtml(0, lines))
+            del lines
 
-            names = ["<pre style=\"font-family:%s; font-size:%spt; text-align: right;\">\n" % (self.font().family(),
-                                                                                               self.font().pointSize())]
-            for line in range(lines):
-                if self.showRuler:
-                    names.append("\n")
-                if self.showDSSP:
-                    names.append("\n")
-                for i in range(len(self.splitNames)):
-                    names.append(self.splitNames[i] + "\n")
+    def nameHtml(self, first, last):
+        """ Name panel HTML for the wrapped lines first to last. """
+        names = ["<pre style=\"font-family:%s; font-size:%spt; text-align: right;\">\n" % (self.font().family(),
+                                                                                           self.font().pointSize())]
+        for line in range(first, last):
+            if self.showRuler:
                 names.append("\n")
-            names.append("</pre>")
-            self.namePane.setHtml("".join(names))
-            del names, line, lines, i
+            if self.showDSSP:
+                names.append("\n")
+            for i in range(len(self.splitNames)):
+                names.append(self.splitNames[i] + "\n")
+            names.append("\n")
+        names.append("</pre>")
+        final = "".join(names)
+        del names, first, last
+        return final
+
+    def rulerHtml(self, char_count, first, last):
+        """ Side ruler HTML for the wrapped lines first to last; each row shows the last residue number on it. """
+        rulerHtml = ["<pre style=\"font-family:%s; font-size:%spt; text-align: left;\">" %
+                     (self.font().family(), self.font().pointSize())]
+        for x in range(first, last):
+            if self.showRuler and self.showDSSP:
+                exline = "\n\n\n"
+            elif self.showRuler or self.showDSSP:
+                exline = "\n\n"
+            else:
+                exline = "\n"
+            # exline = "\n\n" if self.showRuler else "\n"
+            rulerHtml.append(exline)
+            end = x * char_count + char_count
+            if end - 1 < self.store.width:
+                rulerHtml.append("".join(["%s\n" % n for n in self.store.lastResids[:, end - 1].tolist()]))
+            else:
+                rulerHtml.append("\n" * len(self.store))
+        rulerHtml.append('</pre>')
+        final = "".join(rulerHtml)
+        del rulerHtml, char_count, first, last
+        return final
 
     def seqArrange(self, color=True, rulers=True, dssp=True):
         """
-        The bread and butter. This fires upon creation and any resizing event. Computing the resize is done
-        in a separate thread to help with smoothness; showing color and rulers is still very slow though. Resize events
-        call this function with color off, and the ruler is turned off automatically.
+        The bread and butter. This fires upon creation and any resizing event. The lines are drawn by the render
+        service off the GUI thread and put in place when they arrive; a newer arrangement cancels an older one that
+        is still drawing. Resize events call this function with color off, and the ruler is turned off automatically.
         """
+        if self.zoom or self.deferred('arrange'):
+            # Block zoom lays itself out from the residue store
+            del color, rulers, dssp
+            return
+        if not self.wrap:
+            self.drawFlags = (color and self.showColors, rulers and self.showRuler, dssp and self.showDSSP,
+                              not self.userIsResizing)
+            self.linearArrange()
+            del color, rulers, dssp
+            return
         try:
             #self.last = None
             if not self.showColors:
@@ -252,67 +396,372 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
             self.alignPane.lines = lines
             self.alignPane.setChars(char_count)
             self.alignPane.names = self.splitNames
-            self.alignPane.clear()
             fancy = False if self.userIsResizing else True
-            # print("Sending seq with dssp:", dssp)
-            worker = utilities.SeqThread(self.splitSeqs, char_count, lines, rulers, color, dssp, fancy=fancy,
-                                         parent=self, )
-            worker.start()
-            worker.finished.connect(worker.deleteLater)
-            worker.finished.connect(worker.quit)
-            worker.wait()
-            style = "<style>pre{font-family:%s; font-size:%spt;}</style>" % (
-                self.font().family(), self.font().pointSize())
-            self.alignPane.setHtml(style + worker.html)
-            del worker
-            # RULER CALCULATION --> SIDE PANEL.
-            self.rulerPane.clear()
-            rulerHtml = ["<pre style=\"font-family:%s; font-size:%spt; text-align: left;\">" %
-                         (self.font().family(), self.font().pointSize())]
-            for x in range(self.lines):
-                if self.showRuler and self.showDSSP:
-                    exline = "\n\n\n"
-                elif self.showRuler or self.showDSSP:
-                    exline = "\n\n"
-                else:
-                    exline = "\n"
-                # exline = "\n\n" if self.showRuler else "\n"
-                rulerHtml.append(exline)
-                for i in range(len(self.splitSeqs)):
-                    try:
-                        label = str(self.splitSeqs[i][x * char_count + char_count - 1][1])
-                        if label == "0":
-                            for y in range(char_count):
-                                label = str(self.splitSeqs[i][x * char_count + char_count - 1 - y][1])
-                                if label != "0":
-                                    break
-                    except IndexError:
-                        label = ""
-                    rulerHtml.append(label + "\n")
-                    del label
-                del i
-            del x, exline
-
-            rulerHtml.append('</pre>')
-            self.rulerPane.setHtml(style + "".join(rulerHtml))
-            prev = self.rulerPane.verticalScrollBar().sliderPosition()
-            if self.rulerPane.verticalScrollBar().isVisible():
-                if self.last:
-                    self.last = int(round(((self.rulerPane.verticalScrollBar().maximum() -
-                                    self.rulerPane.verticalScrollBar().minimum()) *
-                                    self.last)))
-                    self.rulerPane.verticalScrollBar().setSliderPosition(self.last)
-            del prev
-            del charpx, width, char_count, lines, fancy, style, rulerHtml
+            self.charCount = char_count
+            self.drawFlags = (color, rulers, dssp, fancy)
+            self.drawn = None
+            if self.virtual:
+                self.updateScrollRange()
+                self.viewportArrange()
+            else:
+                self.fullArrange()
+            del charpx, width, char_count, lines, fancy
         except ZeroDivisionError:
             self.alignLogger.info("Font returned zero char width. Please choose a different font")
         del color, rulers, dssp
 
+    def deferred(self, work):
+        """ True (and work is marked for flush) if the window is out of sight and drawing it would be wasted. """
+        if self.isVisible() and not self.visibleRegion().isEmpty():
+            if work == 'init':
+                self.dirty.discard('init')
+            if 'init' not in self.dirty:
+                del work
+                return False
+        self.dirty.add(work)
+        del work
+        return True
+
+    def flush(self):
+        """ Does whatever was put off while the window was out of sight: a fresh residue store and/or a redraw. """
+        if not self.dirty or not self.isVisible() or self.visibleRegion().isEmpty():
+            return
+        dirty = self.dirty
+        self.dirty = set()
+        if 'init' in dirty:
+            self.invalidate()
+            self.seqInit()
+        self.nameArrange(self.lines)
+        self.seqArrange()
+        del dirty
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.dirty:
+            # Shown or uncovered with work pending; do it after painting, once the layout has settled
+            QTimer.singleShot(0, self.flush)
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        if self.renderer.pending():
+            # Lines being drawn for a window nobody can see, and that may be closing; draw them again when it comes back
+            self.renderer.stop()
+            self.drawn = None
+            self.dirty.add('arrange')
+
+    def fullArrange(self, fresh=None):
+        """ Non-virtual mode: puts the whole alignment in the panes once every line has been drawn. """
+        html = self.drawLines(0, self.lines, fresh)
+        if html is None:
+            return
+        self.alignPane.firstLine = 0
+        self.alignPane.clear()
+        style = self.paneStyle()
+        with self.timings.span('setHtml', seqs=len(self.store), cols=self.store.width, bytes=len(html)):
+            self.alignPane.setHtml(style + html)
+        # RULER CALCULATION --> SIDE PANEL.
+        with self.timings.span('ruler', lines=self.lines):
+            self.rulerPane.clear()
+            self.rulerPane.setHtml(style + self.rulerHtml(self.charCount, 0, self.lines))
+        prev = self.rulerPane.verticalScrollBar().sliderPosition()
+        if self.rulerPane.verticalScrollBar().isVisible():
+            if self.last:
+                self.last = int(round(((self.rulerPane.verticalScrollBar().maximum() -
+                                self.rulerPane.verticalScrollBar().minimum()) *
+                                self.last)))
+                self.rulerPane.verticalScrollBar().setSliderPosition(self.last)
+        self.drawn = (0, self.lines)
+        self.timings.finish()
+        del prev, html, style
+
+    def layoutKey(self):
+        """
+        Everything a drawn line depends on besides the residue store itself. The theme is the registered object, not
+        its name, since importing a theme again replaces it under the same name.
+        """
+        color, rulers, dssp, fancy = self.drawFlags
+        return (self.charCount, color, rulers, dssp, fancy, self.theme, self.refseq, self.consvColors,
+                self.palette().color(self.alignPane.backgroundRole()).name(),
+                self.font().family(), self.font().pointSize())
+
+    def drawLines(self, first, last, fresh=None):
+        """
+        HTML for wrapped lines [first, last) in the current layout, if they are all either just delivered (fresh, as
+        {line: html}) or in the block cache. Otherwise asks the render service for the missing ones and returns None;
+        linesRendered picks them up when they arrive. Fresh lines are never asked for again, so lines that don't all
+        fit in the cache at once still get shown.
+        """
+        key = self.layoutKey()
+        fresh = fresh or {}
+        blocks = [fresh.get(line) or self.blockCache.get((key, line)) for line in range(first, last)]
+        missing = [i for i, block in enumerate(blocks) if block is None]
+        if missing:
+            color, rulers, dssp, fancy = self.drawFlags
+            self.renderer.request(key, self.store, self.charCount, self.lines, rulers, color, dssp, fancy=fancy,
+                                  first=first + missing[0], last=first + missing[-1] + 1)
+            del key, blocks, missing, color, rulers, dssp, fancy, first, last, fresh
+            return None
+        self.renderer.cancel()
+        html = ("<pre>" if self.drawFlags[3] else "<pre>\n") + "".join(blocks) + "</pre>"
+        del key, blocks, missing, first, last, fresh
+        return html
+
+    def linesRendered(self, key, first, blocks):
+        """
+        Shows lines from the render service if they are for the current layout, handing them over directly, and only
+        then stores them in the block cache; storing first could evict lines the same arrangement is about to use.
+        """
+        if utilities.RenderTimings.enabled:
+            self.timings.add('render', self.renderer.seconds, lines=len(blocks),
+                             bytes=sum([len(block) for block in blocks]))
+        if key == self.layoutKey():
+            fresh = dict(enumerate(blocks, first))
+            if self.virtual:
+                self.viewportArrange(fresh)
+            else:
+                self.fullArrange(fresh)
+            del fresh
+        for line, html in enumerate(blocks, first):
+            self.blockCache.put((key, line), html)
+        del key, first, blocks
+
+    def invalidate(self):
+        """ The residue store changed under the drawn lines; forget them, including any being drawn now. """
+        self.renderer.cancel()
+        self.blockCache.clear()
+        self.drawn = None
+
+    def paneStyle(self):
+        """ Font of the panes plus a class for each color in the palette (see utilities.paletteStyle). """
+        return "<style>pre{font-family:%s; font-size:%spt;}</style>" % \
+            (self.font().family(), self.font().pointSize()) + utilities.paletteStyle(self.store.palette)
+
+    def rowHeight(self):
+        """ Height of one text row, measured from the drawn document when possible. """
+        doc = self.namePane.document() if self.alignPane.painted else self.alignPane.document()
+        if doc.blockCount() > 1:
+            layout = doc.documentLayout()
+            height = layout.blockBoundingRect(doc.findBlockByNumber(1)).top() - \
+                layout.blockBoundingRect(doc.findBlockByNumber(0)).top()
+            if height > 0:
+                del doc, layout
+                return height
+        del doc
+        return self.fmF.lineSpacing()
+
+    def updateScrollRange(self):
+        """ Virtual mode: the row scrollbar spans every text row, keeping the same relative position on rewrap. """
+        visible = int(self.alignPane.viewport().height() / self.rowHeight())
+        total = self.lines * self.rowsPerLine() - 1
+        maximum = max(0, total - visible + 1)
+        fraction = self.vScroll.value() / self.vScroll.maximum() if self.vScroll.maximum() else 0
+        self.vScroll.blockSignals(True)
+        self.vScroll.setRange(0, maximum)
+        self.vScroll.setPageStep(max(1, visible))
+        self.vScroll.setSingleStep(1)
+        self.vScroll.setValue(int(round(fraction * maximum)))
+        self.vScroll.blockSignals(False)
+        del visible, total, maximum, fraction
+
+    def viewportArrange(self, fresh=None):
+        """
+        Virtual mode: fills the panes with only the wrapped lines under the scrollbar, plus overscan on both sides,
+        then scrolls each pane to the right row. Only redraws when the lines in view change, and keeps the old
+        lines up while new ones are being drawn.
+        """
+        if not self.wrap:
+            self.linearArrange()
+            return
+        if not self.virtual or self.zoom or not self.charCount or not self.lines:
+            return
+        per = self.rowsPerLine()
+        top = self.vScroll.value()
+        visible = int(self.alignPane.viewport().height() / self.rowHeight()) + 1
+        # Lines taller than the view already cover it; overscan would only add whole screens of rows
+        overscan = self.overscan if per <= visible else 0
+        first = max(0, int(top / per) - overscan)
+        last = min(self.lines, int((top + visible) / per) + 1 + overscan)
+        if self.drawn is None or not (self.drawn[0] <= max(0, int(top / per)) and
+                                      min(self.lines, int((top + visible) / per) + 1) <= self.drawn[1]):
+            style = self.paneStyle()
+            if not self.alignPane.painted:
+                html = self.drawLines(first, last, fresh)
+                if html is None:
+                    del per, top, visible, first, last, html, style, overscan
+                    return
+                self.alignPane.firstLine = first
+                with self.timings.span('setHtml', seqs=len(self.store), cols=self.store.width, bytes=len(html)):
+                    self.alignPane.setHtml(style + html)
+                del html
+            with self.timings.span('nameArrange', seqs=len(self.splitNames), lines=last - first):
+                self.namePane.setHtml(self.nameHtml(first, last))
+            with self.timings.span('ruler', lines=last - first):
+                self.rulerPane.setHtml(style + self.rulerHtml(self.charCount, first, last))
+            self.drawn = (first, last)
+            del style
+        row = top - self.drawn[0] * per
+        for pane in [self.alignPane, self.namePane, self.rulerPane]:
+            self.scrollPane(pane, row)
+        if self.alignPane.painted:
+            # Line the painted rows up with wherever the name pane put the same row
+            block = self.namePane.document().findBlockByNumber(row)
+            offset = self.namePane.document().documentLayout().blockBoundingRect(block).top() - \
+                self.namePane.verticalScrollBar().value() + \
+                self.namePane.viewport().mapTo(self, QPoint(0, 0)).y() - \
+                self.alignPane.viewport().mapTo(self, QPoint(0, 0)).y()
+            with self.timings.span('paint', seqs=len(self.store), cols=self.store.width):
+                self.alignPane.paintRows(top, offset, self.rowHeight(), self.font(), self.drawFlags[:3])
+            del block, offset
+        self.overviewArrange()
+        self.timings.finish()
+        del per, top, visible, first, last, row, pane, overscan
+
+    def linearArrange(self):
+        """
+        Non-wrapping layout: one row per sequence under a frozen ruler (and structure) row, with the names and last
+        residue numbers beside them. The scrollbars pick the first column and the first sequence, and only what
+        fits in the pane is drawn, so it costs the same however long the alignment is.
+        """
+        if self.wrap or self.zoom or not len(self.store):
+            return
+        color, rulers, dssp, fancy = self.drawFlags
+        header = int(rulers) + int(dssp)
+        charpx = self.fmF.averageCharWidth()
+        chars = max(1, int(self.alignPane.viewport().width() / charpx - 40 / charpx))
+        rows = max(1, int(self.alignPane.viewport().height() / self.rowHeight()) - header)
+        for bar, maximum, page in [(self.hScroll, self.store.width - chars, chars),
+                                   (self.vScroll, len(self.store) - rows, rows)]:
+            bar.blockSignals(True)
+            bar.setRange(0, max(0, maximum))
+            bar.setPageStep(page)
+            bar.blockSignals(False)
+        start = self.hScroll.value()
+        end = min(self.store.width, start + chars)
+        first = self.vScroll.value()
+        last = min(len(self.store), first + rows + 1)
+        style = self.paneStyle()
+        self.alignPane.linear = (first, start, header)
+        self.alignPane.chars = chars
+        with self.timings.span('setHtml', seqs=last - first, cols=end - start) as span:
+            html = utilities.linearRows(self.store, first, last, start, end, rulers, color and fancy, dssp)
+            self.alignPane.setHtml(style + "<pre>" + html + "</pre>")
+            if span is not None:
+                span['bytes'] = len(html)
+        names = ["<pre style=\"font-family:%s; font-size:%spt; text-align: right;\">\n" %
+                 (self.font().family(), self.font().pointSize()), "\n" * header]
+        numbers = [names[0].replace("right", "left"), "\n" * header]
+        for i in range(first, last):
+            names.append(self.splitNames[i] + "\n")
+            numbers.append("%s\n" % self.store.lastResid(i, end))
+        with self.timings.span('nameArrange', seqs=last - first):
+            self.namePane.setHtml("".join(names) + "</pre>")
+        with self.timings.span('ruler', seqs=last - first):
+            self.rulerPane.setHtml(style + "".join(numbers) + "</pre>")
+        for pane in [self.alignPane, self.namePane, self.rulerPane]:
+            pane.verticalScrollBar().setValue(0)
+        self.overviewArrange()
+        self.timings.finish()
+        del color, rulers, dssp, fancy, header, charpx, chars, rows, bar, maximum, page, start, end, first, last, \
+            style, names, numbers, pane, html, span
+
+    def setWrap(self, state):
+        """ Switches between the wrapped layout and one row per sequence. """
+        self.wrap = state
+        self.params['wrap'] = state
+        self.alignPane.linear = None
+        self.alignPane.firstLine = 0
+        self.alignPane.setPainted(self.painted and self.virtual and state)
+        self.hScroll.setVisible(not state and not self.zoom)
+        self.vScroll.setVisible((self.virtual or not state) and not self.zoom)
+        self.vScroll.setValue(0)
+        self.drawn = None
+        if self.done:
+            self.nameArrange(self.lines)
+            self.seqArrange()
+        del state
+
+    def visibleLines(self):
+        """ Wrapped lines [first, last) at least partly in view. """
+        if self.virtual:
+            per = self.rowsPerLine()
+            visible = int(self.alignPane.viewport().height() / self.rowHeight()) + 1
+            first = int(self.vScroll.value() / per)
+            last = min(self.lines, int((self.vScroll.value() + visible) / per) + 1)
+            del per, visible
+        else:
+            bar = self.alignPane.verticalScrollBar()
+            span = bar.maximum() - bar.minimum() + bar.pageStep()
+            first = int(self.lines * (bar.value() - bar.minimum()) / span) if span else 0
+            last = min(self.lines, int(self.lines * (bar.value() - bar.minimum() + bar.pageStep()) / span) + 1) \
+                if span else self.lines
+            del bar, span
+        return first, last
+
+    def overviewArrange(self):
+        """ Outlines the columns in view on the overview pane, and lines the consensus track up with them. """
+        self.trackArrange()
+        if self.overview.isVisible() and self.zoom:
+            self.overview.setView(*self.blockPane.visibleColumns())
+        elif self.overview.isVisible() and not self.wrap:
+            self.overview.setView(self.hScroll.value(), min(self.store.width, self.hScroll.value() +
+                                                            self.hScroll.pageStep()))
+        elif self.overview.isVisible() and self.charCount and self.lines:
+            first, last = self.visibleLines()
+            self.overview.setView(first * self.charCount, min(self.store.width, last * self.charCount))
+            del first, last
+
+    def trackArrange(self):
+        """ Consensus and logo of the wrapped line at the top of the view, or of the columns scrolled to. """
+        if not self.track.isVisible() or not self.charCount:
+            return
+        measure = utilities.fontMetrics(self.font().family(), self.font().pointSize())
+        origin = self.alignPane.viewport().mapTo(self, QPoint(0, 0)).x() - self.track.mapTo(self, QPoint(0, 0)).x() \
+            + self.alignPane.document().documentMargin()
+        self.track.setGrid(self.font(), measure.charWidth, measure.lineSpacing, origin)
+        start = self.visibleLines()[0] * self.charCount if self.wrap else self.hScroll.value()
+        self.track.setView(start, min(self.store.width, start + self.charCount))
+        del measure, origin, start
+
+    def toggleLogo(self, state):
+        self.showLogo = state
+        self.params['logo'] = state
+        self.track.setVisible(state and not self.zoom)
+        self.trackArrange()
+        del state
+
+    def jumpToColumn(self, column):
+        """ Scrolls so the wrapped line holding a column is at the top of the view. """
+        if self.zoom:
+            self.blockPane.scrollToColumn(column)
+            del column
+            return
+        if not self.wrap:
+            # Put the column in the middle of the residue area
+            self.hScroll.setValue(column - self.hScroll.pageStep() // 2)
+            del column
+            return
+        if not self.charCount:
+            return
+        row = int(column / self.charCount) * self.rowsPerLine()
+        if self.virtual:
+            self.vScroll.setValue(row)
+        else:
+            self.scrollPane(self.alignPane, row)
+        del column, row
+
+    def scrollPane(self, pane, row):
+        """ Scrolls a pane so the given text row is at the top. """
+        doc = pane.document()
+        block = doc.findBlockByNumber(row)
+        if block.isValid():
+            pane.verticalScrollBar().setValue(int(doc.documentLayout().blockBoundingRect(block).top()))
+        del doc, block, pane, row
+
     # UTILITY FUNCTIONS
     def setTheme(self, theme):
-        self.theme = lookupTheme(theme).theme
+        self.theme = lookupTheme(theme)
         self.params['theme'] = theme
-        self.seqInit()
+        self.colorInit()
         self.seqArrange()
         del theme
 
@@ -342,6 +791,7 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
 
     def setSeqs(self, seqs):
         self._seqs = seqs
+        self.invalidate()
         self.seqArrange()
         del seqs
 
@@ -350,6 +800,7 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
         seq = self._seqs[old]
         self._seqs[new] = seq
         self._seqs.pop(old)
+        self.invalidate()
         if self.done:
             self.seqInit()
             self.nameArrange(self.lines)
@@ -366,21 +817,45 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
         if font.family() != self.font().family() and font.pointSize() != self.font().pointSize():
             font.setPointSize(self.font().pointSize())
         super().setFont(font)
-        self.fmF = QFontMetricsF(self.font())
+        self.fmF = utilities.fontMetrics(self.font().family(), self.font().pointSize()).metrics
         if self.done:
-            self.seqInit()
             self.nameArrange(self.lines)
             self.seqArrange()
         del font
 
     def setFontSize(self, size):
-        """ Updates the symbol font size too -- make sure it matches. """
+        """ Updates the symbol font size too -- make sure it matches. Sizes under MINTEXT switch to block zoom. """
+        if size < self.MINTEXT:
+            self.setZoom(self.BLOCKZOOM[max(0, size)])
+            del size
+            return
+        self.setZoom(0)
         font = self.font()
         font.setPointSize(size)
-        self.ssFontWidth = QFontMetricsF(QFont("Default-Noto", size)).averageCharWidth()
+        self.ssFontWidth = utilities.fontMetrics(font.family(), size).ssWidth
         self.setFont(font)
         del size, font
 
+    def setZoom(self, zoom):
+        """
+        Zoom 0 is the text view; otherwise the alignment is drawn as solid blocks at zoom pixels per column, in place
+        of the name, alignment and ruler panes.
+        """
+        if bool(zoom) != bool(self.zoom):
+            for pane in [self.namePane, self.alignPane, self.rulerPane]:
+                pane.setVisible(not zoom)
+            self.vScroll.setVisible((self.virtual or not self.wrap) and not zoom)
+            self.hScroll.setVisible(not self.wrap and not zoom)
+            self.blockPane.setVisible(bool(zoom))
+            self.track.setVisible(self.showLogo and not zoom)
+            self.drawn = None
+            del pane
+        self.zoom = zoom
+        if zoom:
+            self.blockPane.setZoom(zoom)
+            self.overviewArrange()
+        del zoom
+
     def setParams(self, params):
         #print("UPDATING VALUES")
         self.params = params.copy()
@@ -389,25 +864,55 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
         self.showColors = self.params['colors']
         self.consvColors = self.params['byconsv']
         self.showDSSP = self.params['dssp']
-        if self.font().pointSize() != self.params['fontsize']:
+        self.blockCache.setBudget(self.params['cachemb'] * 1024 * 1024)
+        if self.params['virtual'] != self.virtual or not self.done:
+            self.setVirtual(self.params['virtual'])
+        if self.params['painter'] != self.painted:
+            self.setPainted(self.params['painter'])
+        self.overview.setVisible(self.params['overview'])
+        if self.params['logo'] != self.showLogo:
+            self.toggleLogo(self.params['logo'])
+        if self.params['wrap'] != self.wrap:
+            self.setWrap(self.params['wrap'])
+        if self.font().pointSize() != self.params['fontsize'] or self.params['fontsize'] < self.MINTEXT:
             # print("Changing font size")
             self.setFontSize(self.params['fontsize'])
-        if self.font() != self.params['font']:
+        if self.font().family() != self.params['font'].family():
+            # Only the family comes from the chosen font; the size is the window's own
             self.setFont(self.params['font'])
-        newtheme = lookupTheme(self.params['theme']).theme
-        if self.theme != newtheme:
+        newtheme = lookupTheme(self.params['theme'])
+        if newtheme is not self.theme:
             self.theme = newtheme
             if self.done:
-                self.seqInit()
+                self.colorInit()
                 self.seqArrange()
+        self.flush()
         del params, newtheme
 
+    def exportImage(self, path, dpi=300, chars=None):
+        """
+        Writes the whole alignment to an image file through export.AlignmentExport, wrapped at chars columns (the
+        current width by default) with the current font, theme and tracks. The window does not have to be visible.
+        """
+        if 'init' in self.dirty:
+            # Never been shown, so the residue store was never built
+            self.dirty.discard('init')
+            self.dirty.add('arrange')
+            self.seqInit(force=True)
+        base = self.alignPane.palette().base().color().name()
+        text = self.alignPane.palette().text().color().name()
+        exporter = export.AlignmentExport(self.store, self.splitNames, self.font(), chars or self.charCount or 80, dpi,
+                                          (self.showColors, self.showRuler, self.showDSSP), base, text)
+        exporter.write(path)
+        del path, dpi, chars, base, text, exporter
+
     def showCommentWindow(self, target):
         # TODO: shows for ALL rows!
         name = self.splitNames[target[0]]
-        resi = self.splitSeqs[target[0]][target[2]]
+        resi = int(self.store.resids[target[0], target[2]])
         self.comments[target[2]] = "COMMENT"
-        self.seqInit()
+        self.invalidate()
+        self.colorInit()
         self.seqArrange()
         #self.commentPane.lineEdit.setText(str(name) + " " + str(resi))
         # self.gridLayout.addWidget(self.commentButton,1,0)
@@ -415,7 +920,7 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
         del target, name, resi
 
     def addStructure(self, dssp, seq):
-        """ Adds DSSP data to the SplitSeqs array. """
+        """ Adds DSSP data to the structure layer of the residue store. """
         seqs = [x.replace('-', '') for x in self._seqs.values()]
         test = str(seq.seq).replace('-', '')
         # print("Query:\n%s" % test)
@@ -424,20 +929,14 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
             index = seqs.index(test)
             # print("Matched sequence to index %s" % index)
             self.dssps[index] = dssp
-            for res in self.splitSeqs[index]:
-                # print(res[1], res[2])
-                if not res[2]:
-                    try:
-                        res[2] = dssp[res[1]]
-                        # print("Adding structure info %s" % res[2])
-                    except KeyError:
-                        # print("skipping!")
-                        res[2] = "-"
-                else:
-                    pass
-                    #print("Weird, got a duplicate at %s " % res[1])
-            # print(self.splitSeqs[index])
-            del index, res
+            if 'init' in self.dirty:
+                # The store has not been built yet; seqInit will read the structure from dssps
+                del index, dssp, seq, seqs, test
+                return
+            empty = numpy.flatnonzero(self.store.ss[index] == 0)
+            self.store.ss[index, empty] = [ord(dssp.get(resid, "-")) for resid in self.store.resids[index, empty].tolist()]
+            self.invalidate()
+            del index, empty
         del dssp, seq, seqs, test,
 
     def setReference(self, name):
@@ -445,12 +944,12 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
             self.refseq = self.splitNames.index(name)
             #print("refseq set to ", self.refseq)
             if self.done:
-                self.seqInit()
+                self.colorInit()
                 self.seqArrange()
         elif name == "Select seq...":
             self.refseq = None
             if self.done:
-                self.seqInit()
+                self.colorInit()
                 self.seqArrange()
         else:
             pass
@@ -459,7 +958,7 @@ class AlignSubWindow(QWidget, alignment_ui.Ui_aliWindow):
 
     def setConsvColors(self, state):
         self.consvColors = state
-        self.seqInit()
+        self.colorInit()
         self.seqArrange()
         del state
 
@@ -486,6 +985,9 @@ class OptionsPane(QWidget, ali_settings_ui.Ui_Form):
         self.comboFont.currentFontChanged.connect(self.changeFont)
         self.spinFontSize.valueChanged.connect(self.changeFontSize)
         self.checkStructure.toggled.connect(self.structureToggle)
+        self.checkLogo.toggled.connect(self.logoToggle)
+        self.checkPainter.toggled.connect(self.painterToggle)
+        self.checkWrap.toggled.connect(self.wrapToggle)
         self.checkConsv.toggled.connect(self.consvToggle)
         del index
 
@@ -499,12 +1001,22 @@ class OptionsPane(QWidget, ali_settings_ui.Ui_Form):
         self.checkColors.setChecked(self.params['colors'])
         self.checkConsv.setChecked(self.params['byconsv'])
         self.checkStructure.setChecked(self.params['dssp'])
+        self.checkLogo.setChecked(self.params['logo'])
+        self.checkPainter.setChecked(self.params['painter'])
+        self.checkWrap.setChecked(self.params['wrap'])
         self.comboTheme.setCurrentIndex(self.themeIndices[self.params['theme']])
         self.spinFontSize.setValue(self.params['fontsize'])
         self.comboFont.setCurrentFont(self.params['font'])
         del params
         # print(self.params['font'].family())
 
+    def addTheme(self, name):
+        """ Adds a newly registered theme to the choices, unless a theme of that name is already there. """
+        if name not in self.themeIndices:
+            self.comboTheme.addItem(name)
+            self.themeIndices[name] = self.comboTheme.count() - 1
+        del name
+
     def consvToggle(self):
         self.params['byconsv'] = self.checkConsv.isChecked()
         self.comboReference.setEnabled(self.checkConsv.isChecked())
@@ -515,6 +1027,15 @@ class OptionsPane(QWidget, ali_settings_ui.Ui_Form):
     def colorToggle(self):
         self.params['colors'] = self.checkColors.isChecked()
 
+    def logoToggle(self):
+        self.params['logo'] = self.checkLogo.isChecked()
+
+    def painterToggle(self):
+        self.params['painter'] = self.checkPainter.isChecked()
+
+    def wrapToggle(self):
+        self.params['wrap'] = self.checkWrap.isChecked()
+
     def structureToggle(self):
         #print("Toggled structure")
         self.params['dssp'] = self.checkStructure.isChecked()
@@ -585,3 +1106,82 @@ class AboutDialog(QDialog, about_ui.Ui_Dialog):
 
     def ok(self):
         self.done(1)
+
+
+class IdentityDialog(QDialog):
+    """
+    All-vs-all percent identity and similarity of the sequences of an alignment, as a heatmap clustered by identity,
+    with CSV export of either matrix. The matrices are worked out by an IdentityThread and shown when they arrive.
+    """
+
+    def __init__(self, parent, title, names, residues):
+        super().__init__(parent)
+        self.setWindowTitle("Percent identity: %s" % title)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+        self.names = names
+        self.matrices = {}
+        self.order = list(range(len(names)))
+        self.comboMatrix = QComboBox()
+        self.comboMatrix.addItems(["Identity", "Similarity"])
+        self.comboMatrix.setToolTip("Identical residues, or residues with a positive BLOSUM62 score")
+        self.label = QLabel("Comparing %s sequences..." % len(names))
+        self.heatmap = widgets.HeatmapPane(self)
+        self.buttonBox = QDialogButtonBox(QDialogButtonBox.Close)
+        self.buttonExport = self.buttonBox.addButton("Export CSV...", QDialogButtonBox.ActionRole)
+        self.buttonExport.setEnabled(False)
+        self.comboMatrix.setEnabled(False)
+        top = QHBoxLayout()
+        top.addWidget(self.comboMatrix)
+        top.addWidget(self.label, 1)
+        layout = QVBoxLayout(self)
+        layout.addLayout(top)
+        layout.addWidget(self.heatmap, 1)
+        layout.addWidget(self.buttonBox)
+        self.resize(600, 640)
+        self.comboMatrix.currentIndexChanged.connect(self.showMatrix)
+        self.buttonExport.clicked.connect(self.exportCSV)
+        self.buttonBox.rejected.connect(self.reject)
+        # Parented to the main window, so closing the dialog early does not pull the thread out from under itself
+        worker = utilities.IdentityThread(residues, parent=parent)
+        worker.finished.connect(self.matricesDone)
+        worker.error.connect(self.matricesFailed)
+        worker.finished.connect(worker.deleteLater)
+        worker.error.connect(worker.deleteLater)
+        worker.start()
+        del parent, title, names, residues, top, layout, worker
+
+    def matricesDone(self, result):
+        identity, similarity, self.order = result
+        self.matrices = {"Identity": identity, "Similarity": similarity}
+        upper = identity[numpy.triu_indices(len(identity), 1)]
+        self.label.setText("%s sequences; mean identity %.1f%%" % (len(identity), upper.mean() if len(upper) else 100))
+        self.comboMatrix.setEnabled(True)
+        self.buttonExport.setEnabled(True)
+        self.showMatrix()
+        del result, identity, similarity, upper
+
+    def matricesFailed(self, error):
+        self.label.setText("Unable to compare sequences: %s" % error[1])
+        del error
+
+    def showMatrix(self):
+        self.heatmap.setMatrix(self.matrices[self.comboMatrix.currentText()], self.names, self.order)
+
+    def exportCSV(self):
+        """ Writes the matrix on show, in alignment order, with the sequence names as the first row and column. """
+        path = QFileDialog.getSaveFileName(self, "Export CSV", self.comboMatrix.currentText().lower() + ".csv",
+                                           "CSV (*.csv)")[0]
+        if path:
+            matrix = self.matrices[self.comboMatrix.currentText()]
+            try:
+                with open(path, 'w', newline='') as handle:
+                    writer = csv.writer(handle)
+                    writer.writerow([""] + self.names)
+                    for name, row in zip(self.names, matrix.tolist()):
+                        writer.writerow([name] + ["%.2f" % value for value in row])
+                self.label.setText("Saved %s" % path)
+            except OSError as error:
+                self.label.setText("Unable to save: %s" % error)
+            del matrix
+        del path
+
@@ -0,0 +1,264 @@
+import struct
+import zlib
+from math import ceil, floor
+from xml.sax.saxutils import escape
+
+from PyQt5.QtCore import QPointF, QRectF, QSizeF, QMarginsF
+from PyQt5.QtGui import QImage, QPainter, QColor, QFont, QFontMetricsF, QPdfWriter, QPageSize
+
+from linnaeo.classes import utilities
+
+"""
+Off-screen export of a whole alignment, drawn straight from the residue store rather than grabbed from a window.
+"""
+
+
+class AlignmentExport:
+    """
+    Draws the complete alignment -- names, horizontal ruler, structure track, residues and residue numbers -- wrapped
+    at a chosen width and resolution, laid out the same as the alignment window.
+    Nothing is ever drawn whole: PNG and TIFF are rendered a strip of rows at a time and compressed as they go, SVG
+    is written out row by row, and PDF gets a new page for every few hundred inches of lines, so memory stays the
+    same however long the alignment is. BMP and JPEG have no way to be written in pieces and are drawn in one image.
+    """
+    STRIP = 256  # Pixel rows per raster strip
+    PDFPAGE = 200  # Largest PDF page, in inches
+
+    def __init__(self, store, names, font, chars=80, dpi=300, flags=(True, True, True), base='#ffffff',
+                 text='#000000'):
+        self.store = store
+        self.names = names
+        self.chars = max(1, min(chars, store.width))
+        self.lines = max(1, ceil(store.width / self.chars))
+        self.dpi = dpi
+        self.flags = flags
+        self.base = base
+        self.text = text
+        self.per = len(store) + int(flags[1]) + int(flags[2]) + 1
+        # Point sizes are measured against an image at the export resolution, as every output device will
+        self.device = QImage(1, 1, QImage.Format_RGB888)
+        self.device.setDotsPerMeterX(round(dpi / 0.0254))
+        self.device.setDotsPerMeterY(round(dpi / 0.0254))
+        self.fonts = (QFont(font), QFont("Default-Noto", font.pointSize()))
+        metrics = QFontMetricsF(self.fonts[0], self.device)
+        self.charW = metrics.averageCharWidth()
+        self.rowH = metrics.lineSpacing()
+        self.ascents = (metrics.ascent(), QFontMetricsF(self.fonts[1], self.device).ascent())
+        self.nameCols = max([len(name) for name in names]) if names else 0
+        self.numCols = len(str(int(store.resids.max()))) if store.width else 1
+        self.margin = 2 * self.charW
+        del store, names, font, chars, dpi, flags, base, text, metrics
+
+    def rowCount(self):
+        """ Text rows over all the wrapped lines, less the blank one after the last. """
+        return self.lines * self.per - 1
+
+    def size(self):
+        """ (width, height) of the whole export in pixels at its resolution. """
+        columns = self.nameCols + 2 + self.chars + 2 + self.numCols
+        width = int(ceil(2 * self.margin + columns * self.charW))
+        height = int(ceil(2 * self.margin + self.rowCount() * self.rowH))
+        del columns
+        return width, height
+
+    def rowRuns(self, row):
+        """
+        Everything on one text row as (column, text, background, text color, underline, structure font) runs, merging
+        neighbouring cells that look the same. Columns count from the left edge of the name column.
+        """
+        cells = [(column + self.nameCols + 2, cell) for column, cell in
+                 utilities.rowCells(self.store, self.chars, self.lines, self.flags, row, self.base, self.text)]
+        line, kind = divmod(row, self.per)
+        kind -= int(self.flags[1]) + int(self.flags[2])
+        if 0 <= kind < len(self.store):
+            name = self.names[kind]
+            cells.insert(0, (self.nameCols - len(name), (name, self.base, self.text)))
+            if line < self.lines - 1:
+                # Same as the side ruler: the last residue number on each line
+                number = str(int(self.store.lastResids[kind, (line + 1) * self.chars - 1]))
+                cells.append((self.nameCols + 2 + self.chars + 2, (number, self.base, self.text)))
+        runs = []
+        for column, cell in cells:
+            look = tuple(cell[1:]) + (False, False)[len(cell) - 3:]
+            if runs and runs[-1][0] + len(runs[-1][1]) == column and runs[-1][2:] == look:
+                runs[-1][1] += cell[0]
+            else:
+                runs.append([column, cell[0]] + list(look))
+        del cells, line, kind, row
+        return runs
+
+    def paintRows(self, painter, first, last, top):
+        """ Draws text rows first to last with the top of the first one at top. """
+        fonts = []
+        for underline in (False, True):
+            for font in self.fonts:
+                font = QFont(font)
+                font.setUnderline(underline)
+                fonts.append(font)
+        for row in range(first, last):
+            y = top + (row - first) * self.rowH
+            for column, text, bg, fg, underline, ss in self.rowRuns(row):
+                x = self.margin + column * self.charW
+                if bg != self.base:
+                    painter.fillRect(QRectF(x, y, len(text) * self.charW, self.rowH), QColor(bg))
+                painter.setFont(fonts[2 * int(underline) + int(ss)])
+                painter.setPen(QColor(fg))
+                painter.drawText(QPointF(x, y + self.ascents[int(ss)]), text)
+        del fonts, underline, font, painter, first, last, top
+
+    def strips(self):
+        """ The whole export as (top pixel row, RGB image) strips of at most STRIP pixel rows, top to bottom. """
+        width, height = self.size()
+        for top in range(0, height, self.STRIP):
+            bottom = min(height, top + self.STRIP)
+            image = QImage(width, bottom - top, QImage.Format_RGB888)
+            image.setDotsPerMeterX(self.device.dotsPerMeterX())
+            image.setDotsPerMeterY(self.device.dotsPerMeterY())
+            image.fill(QColor(self.base))
+            first = max(0, floor((top - self.margin) / self.rowH))
+            last = min(self.rowCount(), ceil((bottom - self.margin) / self.rowH))
+            painter = QPainter(image)
+            painter.setRenderHint(QPainter.TextAntialiasing)
+            self.paintRows(painter, first, last, self.margin + first * self.rowH - top)
+            painter.end()
+            yield top, image
+            del image, painter, bottom, first, last
+        del width, height
+
+    @staticmethod
+    def scanlines(image):
+        """ Tightly packed RGB bytes of every pixel row of an image (QImage pads each row to four bytes). """
+        data = image.constBits().asstring(image.sizeInBytes())
+        stride = image.bytesPerLine()
+        rows = [data[y * stride:y * stride + image.width() * 3] for y in range(image.height())]
+        del data, stride, image
+        return rows
+
+    def write(self, path):
+        """ Writes the export to path, in the format given by its extension. """
+        suffix = path.rsplit('.', 1)[-1].lower()
+        if suffix == 'png':
+            self.writePNG(path)
+        elif suffix in ['tif', 'tiff']:
+            self.writeTIFF(path)
+        elif suffix == 'svg':
+            self.writeSVG(path)
+        elif suffix == 'pdf':
+            self.writePDF(path)
+        elif suffix in ['bmp', 'jpg', 'jpeg']:
+            width, height = self.size()
+            image = QImage(width, height, QImage.Format_RGB888)
+            if image.isNull():
+                raise ValueError("Too large for %s; save as PNG, TIFF, SVG or PDF instead" % suffix.upper())
+            for top, strip in self.strips():
+                painter = QPainter(image)
+                painter.drawImage(0, top, strip)
+                painter.end()
+            image.setDotsPerMeterX(self.device.dotsPerMeterX())
+            image.setDotsPerMeterY(self.device.dotsPerMeterY())
+            image.save(path)
+            del width, height, image, top, strip, painter
+        else:
+            raise ValueError("Unknown image format: %s" % suffix)
+        del path, suffix
+
+    def writePNG(self, path):
+        """ RGB PNG; each strip is filtered and fed through one deflate stream as soon as it is drawn. """
+        def chunk(kind, data):
+            handle.write(struct.pack(">I", len(data)) + kind + data +
+                         struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+        width, height = self.size()
+        deflate = zlib.compressobj(6)
+        with open(path, 'wb') as handle:
+            handle.write(b'\x89PNG\r\n\x1a\n')
+            chunk(b'IHDR', struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            chunk(b'pHYs', struct.pack(">IIB", self.device.dotsPerMeterX(), self.device.dotsPerMeterY(), 1))
+            for top, image in self.strips():
+                data = deflate.compress(b''.join([b'\x00' + row for row in self.scanlines(image)]))
+                if data:
+                    chunk(b'IDAT', data)
+            chunk(b'IDAT', deflate.flush())
+            chunk(b'IEND', b'')
+        del path, width, height, deflate, handle, top, image, data
+
+    def writeTIFF(self, path):
+        """ Baseline RGB TIFF, one deflated strip per drawn strip; the directory goes last, once they are known. """
+        width, height = self.size()
+        offsets = []
+        counts = []
+        with open(path, 'wb') as handle:
+            handle.write(b'II*\x00\x00\x00\x00\x00')
+            for top, image in self.strips():
+                data = zlib.compress(b''.join(self.scanlines(image)), 6)
+                offsets.append(handle.tell())
+                counts.append(len(data))
+                handle.write(data)
+            if handle.tell() % 2:
+                handle.write(b'\x00')
+            ifd = handle.tell()
+            # (tag, type, values): type 3 is SHORT, 4 is LONG and 5 is RATIONAL
+            entries = [(256, 4, [width]), (257, 4, [height]), (258, 3, [8, 8, 8]), (259, 3, [8]), (262, 3, [2]),
+                       (273, 4, offsets), (277, 3, [3]), (278, 4, [self.STRIP]), (279, 4, counts),
+                       (282, 5, [self.dpi, 1]), (283, 5, [self.dpi, 1]), (296, 3, [2])]
+            extra = ifd + 2 + 12 * len(entries) + 4
+            table = [struct.pack("<H", len(entries))]
+            values = []
+            for tag, kind, data in entries:
+                packed = struct.pack("<%d%s" % (len(data), "H" if kind == 3 else "I"), *data)
+                count = len(data) // 2 if kind == 5 else len(data)
+                if len(packed) <= 4:
+                    table.append(struct.pack("<HHI", tag, kind, count) + packed.ljust(4, b'\x00'))
+                else:
+                    table.append(struct.pack("<HHII", tag, kind, count, extra + len(b''.join(values))))
+                    values.append(packed)
+            table.append(struct.pack("<I", 0))
+            handle.write(b''.join(table + values))
+            handle.seek(4)
+            handle.write(struct.pack("<I", ifd))
+        del path, width, height, offsets, counts, handle, top, image, data, ifd, entries, extra, table, values, tag, \
+            kind, packed, count
+
+    def writeSVG(self, path):
+        """ SVG at the export resolution, written out a row at a time; textLength keeps each run on the cell grid. """
+        width, height = self.size()
+        fonts = ['font-family="%s"' % escape(self.fonts[0].family()), 'font-family="Default-Noto"']
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                         '<svg xmlns="http://www.w3.org/2000/svg" width="%.3fin" height="%.3fin" viewBox="0 0 %s %s">\n'
+                         % (width / self.dpi, height / self.dpi, width, height))
+            handle.write('<rect width="100%%" height="100%%" fill="%s"/>\n' % self.base)
+            handle.write('<g font-size="%.2fpx" xml:space="preserve">\n' % (self.fonts[0].pointSizeF() * self.dpi / 72))
+            for row in range(self.rowCount()):
+                y = self.margin + row * self.rowH
+                for column, text, bg, fg, underline, ss in self.rowRuns(row):
+                    x = self.margin + column * self.charW
+                    if bg != self.base:
+                        handle.write('<rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" fill="%s"/>'
+                                     % (x, y, len(text) * self.charW, self.rowH, bg))
+                    handle.write('<text x="%.2f" y="%.2f" textLength="%.2f" fill="%s" %s%s>%s</text>'
+                                 % (x, y + self.ascents[int(ss)], len(text) * self.charW, fg, fonts[int(ss)],
+                                    ' text-decoration="underline"' if underline else '', escape(text)))
+                handle.write('\n')
+            handle.write('</g>\n</svg>\n')
+        del path, width, height, fonts, handle, row, y
+
+    def writePDF(self, path):
+        """ Vector PDF at the export resolution; alignments taller than PDFPAGE inches go over several pages. """
+        width, height = self.size()
+        rows = self.per * max(1, int((self.PDFPAGE * self.dpi - 2 * self.margin) / (self.per * self.rowH)))
+        writer = QPdfWriter(path)
+        writer.setResolution(self.dpi)
+        writer.setPageMargins(QMarginsF(0, 0, 0, 0))
+        painter = None
+        for first in range(0, self.rowCount(), rows):
+            last = min(self.rowCount(), first + rows)
+            writer.setPageSize(QPageSize(QSizeF(width / self.dpi, (2 * self.margin + (last - first) * self.rowH) /
+                                                self.dpi), QPageSize.Inch))
+            if painter is None:
+                painter = QPainter(writer)
+            else:
+                writer.newPage()
+            self.paintRows(painter, first, last, self.margin)
+        painter.end()
+        del path, width, height, rows, writer, painter, first, last
@@ -5,11 +5,11 @@ from Bio import SeqIO, AlignIO
 from Bio.Alphabet import generic_protein
 from Bio.Seq import MutableSeq, Seq
 from PyQt5.QtCore import QFile, QIODevice, QDataStream, Qt, QDir, QUrl
-from PyQt5.QtGui import QStandardItem, QFontMetricsF, QIcon, QDesktopServices
-from PyQt5.QtWidgets import QFileDialog, QApplication, qApp
+from PyQt5.QtGui import QStandardItem, QIcon, QDesktopServices
+from PyQt5.QtWidgets import QFileDialog, QApplication, qApp, QInputDialog
 
-from linnaeo.classes import widgets, models, utilities
-from linnaeo.classes.displays import AboutDialog
+from linnaeo.classes import widgets, models, utilities, themes
+from linnaeo.classes.displays import AboutDialog, IdentityDialog
 from linnaeo.classes.utilities import lookupTheme
 
 
@@ -66,19 +66,87 @@ class Slots:
         qDialog = AboutDialog(self)
         qDialog.exec()
 
+    def showIdentity(self):
+        """
+        All-vs-all percent identity of the sequences of the current alignment window, from the alignment stored on its
+        project node rather than by aligning again.
+        """
+        if self._currentWindow:
+            alignment = None
+            for node in utilities.iterTreeView(self.projectModel.invisibleRootItem()):
+                if node.data(self.WindowRole) == self._currentWindow.wid:
+                    alignment = node.data(self.SequenceRole)
+            if alignment is None or len(alignment) < 2:
+                self.mainStatus.showMessage("Percent identity needs an alignment window", msecs=4000)
+            else:
+                residues = models.ResidueStore([record.seq for record in alignment]).residues
+                dialog = IdentityDialog(self, self._currentWindow.windowTitle(),
+                                        [record.name for record in alignment], residues)
+                dialog.show()
+                del residues, dialog
+            del alignment
+
+    def importTheme(self):
+        """
+        Registers a custom color theme from a JSON file (see themes.loadTheme) and adds it to the theme choices,
+        selecting it for the current window.
+        """
+        path = QFileDialog.getOpenFileName(self, "Import color theme", QDir.homePath(), "Color theme (*.json)")[0]
+        if path:
+            try:
+                theme = themes.loadTheme(path)
+            except (OSError, ValueError) as error:
+                self.mainLogger.error("Unable to load theme: %s" % error)
+                self.mainStatus.showMessage("Unable to load theme: %s" % error, msecs=4000)
+            else:
+                self.optionsPane.addTheme(theme.name)
+                if self.optionsPane.comboTheme.currentText() == theme.name:
+                    # Reloaded over a theme of the same name, so the choice itself does not change
+                    self.changeTheme()
+                self.optionsPane.comboTheme.setCurrentIndex(self.optionsPane.themeIndices[theme.name])
+                self.mainStatus.showMessage("Loaded color theme %s" % theme.name, msecs=4000)
+                del theme
+        del path
+
     def saveImage(self):
-        """ Captures the current alignment window in entirety. Very crude. """
+        """
+        Exports the whole of the current alignment, not just what is on screen, at a chosen resolution and wrap width.
+        PNG, TIFF, SVG and PDF are written piece by piece, so even very long alignments can be exported as posters.
+        """
         if self._currentWindow:
-            self._currentWindow.widget().grab()  # TODO The first time this runs it redraws the window, but never after...
-            w = self._currentWindow.widget().alignPane.size().width()
-            sw = self._currentWindow.widget().alignPane.verticalScrollBar().size().width()
-            self._currentWindow.widget().alignPane.verticalScrollBar().hide()
-            self._currentWindow.widget().alignPane.size().setWidth(int(w - sw))
+            widget = self._currentWindow.widget()
             file = QFileDialog.getSaveFileName(self, "Save as...", "name",
-                                               "PNG (*.png);; BMP (*.bmp);;TIFF (*.tiff *.tif);; JPEG (*.jpg *.jpeg)")
-            self._currentWindow.widget().grab().save(file[0] + file[1][-5:-1])
-            self._currentWindow.widget().alignPane.verticalScrollBar().show()
-            del file, w, sw
+                                               "PNG (*.png);;TIFF (*.tiff *.tif);;SVG (*.svg);;PDF (*.pdf);;"
+                                               "BMP (*.bmp);;JPEG (*.jpg *.jpeg)")
+            if not file[0]:
+                del widget, file
+                return
+            dpi, ok = QInputDialog.getInt(self, "Save image", "Resolution (DPI):", 300, 72, 2400)
+            if ok:
+                chars, ok = QInputDialog.getInt(self, "Save image", "Residues per line:", widget.charCount or 80, 10,
+                                                max(10, widget.store.width or widget.maxlen))
+            if ok:
+                path = file[0]
+                if "." not in path.rsplit("/", 1)[-1]:
+                    path += "." + file[1].split("*.")[1].split(" ")[0].rstrip(")")
+                QApplication.setOverrideCursor(Qt.WaitCursor)
+                try:
+                    widget.exportImage(path, dpi, chars)
+                    self.mainStatus.showMessage("Saved image to %s" % path, msecs=4000)
+                except (OSError, ValueError) as error:
+                    self.mainLogger.error("Unable to save image: %s" % error)
+                    self.mainStatus.showMessage("Unable to save image: %s" % error, msecs=4000)
+                finally:
+                    QApplication.restoreOverrideCursor()
+                del path
+            del widget, file, dpi, ok
+
+    def toggleTimings(self, state):
+        """ Times every stage of drawing the alignment windows; the last breakdown goes in the status bar and log. """
+        utilities.RenderTimings.enabled = state
+        self.renderLabel.setVisible(state)
+        self.renderLabel.clear()
+        del state
 
     def toggleOptionsPane(self, state):
         """ Permanent button for hiding or displaying the right-side options pane for alignment controls. """
@@ -103,6 +171,24 @@ class Slots:
             self._currentWindow.widget().toggleStructure(bool(state))
         del state
 
+    def toggleLogo(self, state):
+        """ Turn the consensus and logo track on/off """
+        if self._currentWindow:
+            self._currentWindow.widget().toggleLogo(state)
+        del state
+
+    def togglePainter(self, state):
+        """ Turn painting the alignment from the glyph atlas on/off """
+        if self._currentWindow:
+            self._currentWindow.widget().setPainted(state)
+        del state
+
+    def toggleWrap(self, state):
+        """ Switch between wrapped lines and one row per sequence """
+        if self._currentWindow:
+            self._currentWindow.widget().setWrap(state)
+        del state
+
     def toggleConsv(self, state):
         """ Turn reference sequence on/off """
         if self._currentWindow:
@@ -120,7 +206,7 @@ class Slots:
         desc = lookupTheme(self.optionsPane.comboTheme.currentText()).getDesc()
         self.colorPane.insertHtml(desc)
         font = self.colorPane.document().defaultFont()
-        fmF = QFontMetricsF(font)
+        fmF = utilities.fontMetrics(font.family(), font.pointSize()).metrics
         text = self.colorPane.document().toPlainText()
         textSize = fmF.size(0, text)
         hgt = textSize.height()+10
@@ -140,9 +226,9 @@ class Slots:
         """
         if self._currentWindow:
             self._currentWindow.widget().setFont(font)
-            fmF = QFontMetricsF(font)
-            if not fmF.averageCharWidth() - 0.5 <= self._currentWindow.widget().ssFontWidth <= \
-                   fmF.averageCharWidth() + 0.5:
+            # Measured at the size the window actually uses, not the size baked into the chosen font
+            fmF = utilities.fontMetrics(font.family(), self._currentWindow.widget().font().pointSize())
+            if not fmF.charWidth - 0.5 <= self._currentWindow.widget().ssFontWidth <= fmF.charWidth + 0.5:
                 self.mainLogger.debug("Font size is too different from symbol font; disabling structure!")
                 self.mainStatus.showMessage("Font incompatible with structure symbols; please choose another!",
                                             msecs=6000)
@@ -166,7 +252,9 @@ class Slots:
 
     def showColorDesc(self, state):
         if state:
-            self.optionsPane.verticalLayout.insertWidget(12, self.colorPane)
+            index = self.optionsPane.verticalLayout.indexOf(self.optionsPane.checkColorDesc) + 1
+            self.optionsPane.verticalLayout.insertWidget(index, self.colorPane)
+            del index
             self.colorPane.show()
         else:
             self.optionsPane.verticalLayout.removeWidget(self.colorPane)
@@ -213,21 +301,22 @@ class Slots:
                 wid = node.data(role=self.WindowRole)
                 seqr = node.data(role=self.SequenceRole)
                 for seq in seqr:
-                    seqs[seq.name] = str(seq.seq)
-                worker = utilities.AlignThread(self, seqs, seqtype=3, num_threads=self.threadpool.maxThreadCount())
-                worker.start()
-                worker.finished.connect(worker.deleteLater)
-                worker.finished.connect(worker.quit)
-                worker.wait()
-                ali = worker.aligned
-                del worker
-                self.makeNewWindow(wid, ali, nonode=True)
+                    # The saved rows are gapped; aligning the bare sequences again is what made them
+                    seqs[seq.name] = str(seq.seq).replace('-', '')
+                self.callAlign(seqs, lambda ali, wid=wid: self.restoreWindow(wid, ali), title=node.data())
         self.bioModel.updateWindows(self.windows)
         self.projectModel.updateWindows(self.windows)
         self.mainStatus.showMessage(f"Loading complete! took {float(time.perf_counter()-self.start):.2f} seconds", msecs=4000)
         self.mainLogger.debug("Regenerating windows took took %f seconds" % float(time.perf_counter() - self.start))
         del node
 
+    def restoreWindow(self, wid, ali):
+        """ Makes the window of a reloaded alignment once its realignment comes back from the AlignQueue. """
+        self.makeNewWindow(wid, ali, nonode=True)
+        self.bioModel.updateWindows(self.windows)
+        self.projectModel.updateWindows(self.windows)
+        del wid, ali
+
     def saveWorkspace(self):
         """
         Saves the current workspace as is. Saves the trees and all of the nodes (and node data). Does not save
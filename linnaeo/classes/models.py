@@ -1,7 +1,10 @@
 from abc import ABC
 
+import numpy
 from Bio import SeqRecord
 
+from linnaeo.classes import stats
+
 
 class SeqR(SeqRecord.SeqRecord, ABC):
     """
@@ -65,3 +68,68 @@ class SeqR(SeqRecord.SeqRecord, ABC):
                     return True
                 else:
                     return False
+
+
+class ResidueStore:
+    """
+    Columnar storage of an alignment for drawing. Every layer is a (sequences x columns) array, so memory is
+    a few bytes per residue rather than a Python list of strings per residue.
+    residues: uint8 character code of each position; gaps are '-' and short sequences are padded with ' '
+    resids: int32 residue number within its own sequence, 0 for gaps
+    lastResids: int32 number of the last residue at or before each position (a running max of resids), so labels
+        and tooltips never have to search back over gaps
+    ss: uint8 DSSP code of each residue, 0 where there is no structure information
+    colors: uint8 index into the palette, which holds the (background, text) color names for this window.
+        Text color is None for gaps, which only get a background.
+    stats: column statistics and residue frequencies (see stats.ColumnStats), worked out when first asked for
+    """
+    GAPS = (ord('-'), ord(' '))
+
+    def __init__(self, seqs):
+        seqs = [str(seq) for seq in seqs]
+        self.width = max([len(seq) for seq in seqs]) if seqs else 0
+        self.residues = numpy.full((len(seqs), self.width), ord(' '), dtype=numpy.uint8)
+        for i, seq in enumerate(seqs):
+            self.residues[i, :len(seq)] = numpy.frombuffer(seq.encode('ascii', 'replace'), dtype=numpy.uint8)
+        self.resids = numpy.zeros(self.residues.shape, dtype=numpy.int32)
+        self.lastResids = numpy.zeros(self.residues.shape, dtype=numpy.int32)
+        self.ss = numpy.zeros(self.residues.shape, dtype=numpy.uint8)
+        self.colors = numpy.zeros(self.residues.shape, dtype=numpy.uint8)
+        self.palette = (('#FFFFFF', None),)
+        self.stats = None
+        del seqs
+
+    def __len__(self):
+        return self.residues.shape[0]
+
+    def gapMask(self):
+        """ True wherever a position is a gap or padding rather than a residue. """
+        return (self.residues == self.GAPS[0]) | (self.residues == self.GAPS[1])
+
+    def number(self):
+        """
+        Numbers every residue along its own sequence by a running count of the non-gap positions. The running count
+        itself is the last residue number at or before each column.
+        """
+        residue = ~self.gapMask()
+        self.lastResids = numpy.cumsum(residue, axis=1, dtype=numpy.int32)
+        self.resids = self.lastResids * residue
+        del residue
+
+    def columnStats(self):
+        """ Residue counts and column statistics of the alignment (see stats), shared with any identical store. """
+        if self.stats is None:
+            self.stats = stats.columnStats(self.residues)
+        return self.stats
+
+    def lastResid(self, row, end):
+        """ Number of the last residue of a row before column end (0 if there is none yet). """
+        return int(self.lastResids[row, min(end, self.width) - 1]) if end > 0 else 0
+
+    def text(self, row, start, end):
+        """ Plain residue characters of a row between two columns. """
+        return self.residues[row, start:end].tobytes().decode('ascii')
+
+    def nbytes(self):
+        return self.residues.nbytes + self.resids.nbytes + self.lastResids.nbytes + self.ss.nbytes + \
+            self.colors.nbytes
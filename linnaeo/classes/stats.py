@@ -0,0 +1,350 @@
+"""
+Column statistics of an alignment: Shannon entropy, identity, gap fraction and BLOSUM62 sum-of-pairs for every column.
+Everything comes from one (symbols x columns) count matrix, so each statistic is a handful of array operations over
+a few dozen rows however many sequences there are. Statistics are kept per alignment content, so windows showing the
+same alignment, and redraws of the same window, share them.
+Pairwise identity and similarity of the sequences come from one-hot matrix products in the same way.
+"""
+import copy
+import hashlib
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from Bio.Align import substitution_matrices
+
+from linnaeo.classes.workers import initIdentity, identityRows
+
+AMINO = "ACDEFGHIKLMNPQRSTVWY"
+OTHER = len(AMINO)
+GAP = OTHER + 1
+SYMBOLS = GAP + 1
+# Metric name to its label in menus
+METRICS = OrderedDict([('identity', 'Identity'), ('entropy', 'Entropy'), ('gaps', 'Occupancy'),
+                       ('blosum', 'BLOSUM62')])
+CACHED = 8
+_cache = OrderedDict()
+
+
+def symbolCodes():
+    """
+    Lookup table from character code to symbol: the 20 amino acids (either case), OTHER for any other letter
+    (X, B, Z, U...) and GAP for gaps, padding and anything that is not a letter.
+    """
+    codes = numpy.full(256, GAP, dtype=numpy.uint8)
+    for code in range(256):
+        if chr(code).isascii() and chr(code).isalpha():
+            codes[code] = OTHER
+    for i, aa in enumerate(AMINO):
+        codes[[ord(aa), ord(aa.lower())]] = i
+    return codes
+
+
+def blosumMatrix():
+    """ BLOSUM62 between the symbols; OTHER scores as X, and gaps score nothing since they are never counted. """
+    blosum = substitution_matrices.load("BLOSUM62")
+    letters = AMINO + "X"
+    matrix = numpy.zeros((SYMBOLS, SYMBOLS))
+    for i, a in enumerate(letters):
+        for j, b in enumerate(letters):
+            matrix[i, j] = blosum[a][b]
+    del blosum, letters
+    return matrix
+
+
+CODES = symbolCodes()
+BLOSUM62 = blosumMatrix()
+
+
+def residueCounts(residues, chunk=512):
+    """
+    Count of every symbol in every column of a (sequences x columns) array of character codes, as a (SYMBOLS x
+    columns) array. Rows are counted a chunk at a time with one bincount over symbol * columns + column, so memory
+    stays at a few bytes per residue of the chunk whatever the size of the alignment.
+    """
+    n, width = residues.shape
+    counts = numpy.zeros(SYMBOLS * width, dtype=numpy.int64)
+    offsets = numpy.arange(width, dtype=numpy.int64)
+    for row in range(0, n, chunk):
+        index = CODES[residues[row:row + chunk]] * numpy.int64(width) + offsets
+        counts += numpy.bincount(index.ravel(), minlength=SYMBOLS * width)
+        del index
+    del residues, n, offsets
+    return counts.reshape(SYMBOLS, width)
+
+
+class ColumnStats:
+    """
+    Per-column statistics of one alignment, each worked out from the count matrix the first time it is asked for.
+    Gaps are left out of entropy, identity and sum-of-pairs; identity is still a fraction of all sequences, so gappy
+    columns do not look conserved.
+    """
+
+    def __init__(self, residues):
+        self.sequences = residues.shape[0]
+        self.counts = residueCounts(residues)
+        self.occupied = self.sequences - self.counts[GAP]
+        self.results = {}
+        del residues
+
+    def replaced(self, old, new):
+        """
+        Statistics of the same alignment with some rows swapped, without counting it all again: the counts of the old
+        rows come off and those of the new rows go on. Old and new are (rows x columns) character codes of the same
+        width, and rowChanges tells which rows they are. This object is left as it is, since the cache may share it.
+        """
+        stats = copy.copy(self)
+        stats.sequences = self.sequences - len(old) + len(new)
+        stats.counts = self.counts - residueCounts(old) + residueCounts(new)
+        stats.occupied = stats.sequences - stats.counts[GAP]
+        stats.results = {}
+        del old, new
+        return stats
+
+    def frequencies(self):
+        """ (SYMBOLS - 1) x columns frequency of each residue among the residues (not gaps) of each column. """
+        if 'frequencies' not in self.results:
+            self.results['frequencies'] = self.counts[:GAP] / numpy.maximum(1, self.occupied)
+        return self.results['frequencies']
+
+    def gapFraction(self):
+        if 'gaps' not in self.results:
+            self.results['gaps'] = self.counts[GAP] / max(1, self.sequences)
+        return self.results['gaps']
+
+    def identity(self):
+        """ Fraction of all sequences that have the most common residue of each column. """
+        if 'identity' not in self.results:
+            self.results['identity'] = self.counts[:GAP].max(axis=0) / max(1, self.sequences)
+        return self.results['identity']
+
+    def entropy(self):
+        """ Shannon entropy of the residues in each column, in bits; 0 for a column of gaps. """
+        if 'entropy' not in self.results:
+            freqs = self.frequencies()
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                terms = numpy.where(freqs > 0, freqs * numpy.log2(freqs), 0.0)
+            self.results['entropy'] = -terms.sum(axis=0)
+            del freqs, terms
+        return self.results['entropy']
+
+    def sumOfPairs(self):
+        """
+        BLOSUM62 sum-of-pairs score of each column over every pair of residues in it, from the counts c as
+        (c.B.c - sum of c_a B_aa) / 2, so it costs the same for 10 sequences or 10,000.
+        """
+        if 'sumOfPairs' not in self.results:
+            counts = self.counts.astype(numpy.float64)
+            self.results['sumOfPairs'] = ((counts * (BLOSUM62 @ counts)).sum(axis=0) -
+                                          (numpy.diag(BLOSUM62)[:, None] * counts).sum(axis=0)) / 2
+            del counts
+        return self.results['sumOfPairs']
+
+    def meanPair(self):
+        """ Sum-of-pairs per pair of residues, which unlike the sum can be compared between columns. """
+        pairs = self.occupied * (self.occupied - 1) / 2
+        return numpy.where(pairs > 0, self.sumOfPairs() / numpy.maximum(1, pairs), 0.0)
+
+    def consensus(self, threshold=0.5):
+        """
+        Consensus residue of each column as character codes: the most common residue, in lower case when it makes up
+        less than threshold of the residues in the column, and a gap where there are no residues at all.
+        """
+        if ('consensus', threshold) not in self.results:
+            freqs = self.frequencies()
+            top = freqs.argmax(axis=0)
+            codes = numpy.frombuffer((AMINO + "X").encode(), dtype=numpy.uint8)[top]
+            weak = freqs[top, numpy.arange(freqs.shape[1])] < threshold
+            codes = numpy.where(weak, codes | 0x20, codes).astype(numpy.uint8)
+            codes[self.occupied == 0] = ord('-')
+            self.results[('consensus', threshold)] = codes
+            del freqs, top, weak, codes
+        return self.results[('consensus', threshold)]
+
+    def logo(self):
+        """
+        Sequence logo heights: each residue's share of the information content of its column, log2(20) less the
+        entropy, as a fraction of the most a column can hold, in a (SYMBOLS - 1) x columns array.
+        """
+        if 'logo' not in self.results:
+            maximum = numpy.log2(len(AMINO))
+            information = numpy.clip(maximum - self.entropy(), 0, maximum) / maximum
+            self.results['logo'] = self.frequencies() * information
+            del maximum, information
+        return self.results['logo']
+
+    def score(self, metric):
+        """
+        A metric (a key of METRICS) scaled from 0 to 1, with 1 the most conserved column, for themes and tracks.
+        BLOSUM62 is scaled so that a mean pair score of -1 or less is 0 and 4 or more is 1.
+        """
+        if metric == 'identity':
+            return self.identity()
+        elif metric == 'entropy':
+            return 1 - self.entropy() / numpy.log2(GAP)
+        elif metric == 'gaps':
+            return 1 - self.gapFraction()
+        elif metric == 'blosum':
+            return numpy.clip((self.meanPair() + 1) / 5, 0, 1)
+        raise ValueError("Unknown column statistic %s" % metric)
+
+
+def columnStats(residues):
+    """
+    ColumnStats for a (sequences x columns) array of character codes, from the cache when the same content was seen
+    recently. The key is a digest of the residues themselves, so edits to an alignment never get stale statistics.
+    """
+    residues = numpy.ascontiguousarray(residues)
+    key = (residues.shape, hashlib.blake2b(residues.data, digest_size=16).digest())
+    if key in _cache:
+        _cache.move_to_end(key)
+    else:
+        _cache[key] = ColumnStats(residues)
+        while len(_cache) > CACHED:
+            _cache.popitem(last=False)
+    stats = _cache[key]
+    del residues, key
+    return stats
+
+
+def rowChanges(old, new):
+    """
+    Rows that differ between two (sequences x columns) arrays of character codes of the same width, whatever order
+    the rows are in: indices of the rows of old with no equal row left in new, and of the rows of new with none left
+    in old. Rows are matched by a digest of their residues, so renaming or reordering sequences changes nothing.
+    """
+    unmatched = {}
+    for row in range(len(old)):
+        unmatched.setdefault(hashlib.blake2b(old[row].tobytes(), digest_size=16).digest(), []).append(row)
+    added = []
+    for row in range(len(new)):
+        rows = unmatched.get(hashlib.blake2b(new[row].tobytes(), digest_size=16).digest())
+        if rows:
+            rows.pop()
+        else:
+            added.append(row)
+    gone = sorted([row for rows in unmatched.values() for row in rows])
+    del old, new, unmatched
+    return gone, added
+
+
+def scoreBins(score, bins):
+    """ Scores from 0 to 1 as bin numbers from 0 to bins - 1. """
+    return numpy.minimum((numpy.asarray(score) * bins).astype(numpy.uint8), bins - 1)
+
+
+# Pairs of symbols that count as similar: a positive BLOSUM62 score
+SIMILAR = BLOSUM62[:GAP, :GAP] > 0
+# Sequences from which pairwise identity is spread over processes
+PROCESSES = 1000
+
+
+def oneHot(residues):
+    """
+    One-hot encoding of a (sequences x columns) array of character codes, as bool arrays: same (symbols x sequences x
+    columns, the residue is that symbol), close (likewise, the residue has a positive BLOSUM62 score with it) and
+    occupied (sequences x columns, not a gap). A byte per residue per symbol, built once for all the blocks of rows.
+    """
+    codes = CODES[residues]
+    near = numpy.zeros((GAP, SYMBOLS), dtype=bool)
+    near[:, :GAP] = SIMILAR
+    same = codes[None] == numpy.arange(GAP, dtype=codes.dtype)[:, None, None]
+    close = near[:, codes]
+    occupied = codes != GAP
+    del residues, codes, near
+    return same, close, occupied
+
+
+def identityBlock(encoded, start, end, chunk=256):
+    """
+    Pairwise counts between rows start to end and every row of a oneHot encoded alignment, as (identical, similar,
+    aligned) arrays of (end - start) x sequences: residues that are the same, residues with a positive BLOSUM62 score,
+    and columns where neither has a gap. Each count is a sum of matrix products, one symbol at a time, so the floats
+    in hand are one symbol of the alignment plus the chunk of rows at hand.
+    """
+    same, close, occupied = encoded
+    n = len(occupied)
+    identical = numpy.zeros((end - start, n), dtype=numpy.float32)
+    similar = numpy.zeros((end - start, n), dtype=numpy.float32)
+    occupied = occupied.astype(numpy.float32)
+    aligned = occupied[start:end] @ occupied.T
+    del occupied
+    for symbol in range(GAP):
+        right = same[symbol].astype(numpy.float32)
+        near = close[symbol].astype(numpy.float32)
+        for row in range(start, end, chunk):
+            block = right[row:min(end, row + chunk)]
+            identical[row - start:row - start + len(block)] += block @ right.T
+            similar[row - start:row - start + len(block)] += block @ near.T
+            del block
+        del right, near
+    del encoded, same, close, n, start, end, chunk
+    return identical, similar, aligned
+
+
+def pairwiseIdentity(residues, workers=None):
+    """
+    Percent identity and similarity of every pair of rows of a (sequences x columns) array of character codes, over
+    the columns where neither has a gap, as two float32 sequences x sequences arrays. Rows are split into blocks
+    worked out in separate processes once there are PROCESSES sequences or more. The processes are spawned, not
+    forked, as this runs from a thread of the Qt application, and start from the workers module (see there).
+    """
+    n = len(residues)
+    workers = workers or ((os.cpu_count() or 1) if n >= PROCESSES else 1)
+    if workers > 1:
+        edges = numpy.linspace(0, n, workers * 2 + 1).astype(int).tolist()
+        residues = numpy.ascontiguousarray(residues, dtype=numpy.uint8)
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=initIdentity,
+                                 initargs=(residues.tobytes(), residues.shape)) as pool:
+            blocks = list(pool.map(identityRows, edges[:-1], edges[1:]))
+        identical, similar, aligned = [numpy.concatenate(parts) for parts in zip(*blocks)]
+        del edges, blocks
+    else:
+        identical, similar, aligned = identityBlock(oneHot(residues), 0, n)
+    aligned = numpy.maximum(aligned, 1)
+    identity = 100 * identical / aligned
+    similarity = 100 * similar / aligned
+    del residues, n, workers, identical, similar, aligned
+    return identity, similarity
+
+
+def clusterOrder(distance):
+    """
+    Order of the rows of a distance matrix as the leaves of its average linkage (UPGMA) tree, so that similar rows
+    end up next to each other. The nearest cluster of every row is kept and only looked for again when it merges, so
+    each of the merges is a few array operations on single rows.
+    """
+    n = len(distance)
+    if n < 3:
+        return list(range(n))
+    dist = numpy.array(distance, dtype=numpy.float64)
+    numpy.fill_diagonal(dist, numpy.inf)
+    sizes = numpy.ones(n)
+    members = [[i] for i in range(n)]
+    active = numpy.ones(n, dtype=bool)
+    nearest = dist.argmin(axis=1)
+    rows = numpy.arange(n)
+    for _ in range(n - 1):
+        closest = numpy.where(active, dist[rows, nearest], numpy.inf)
+        i = int(closest.argmin())
+        j = int(nearest[i])
+        merged = (dist[i] * sizes[i] + dist[j] * sizes[j]) / (sizes[i] + sizes[j])
+        merged[[i, j]] = numpy.inf
+        merged[~active] = numpy.inf
+        dist[i], dist[:, i] = merged, merged
+        dist[j], dist[:, j] = numpy.inf, numpy.inf
+        active[j] = False
+        sizes[i] += sizes[j]
+        members[i] = members[i] + members[j]
+        members[j] = None
+        stale = numpy.flatnonzero(active & ((nearest == i) | (nearest == j) | (rows == i)))
+        nearest[stale] = dist[stale].argmin(axis=1)
+        closer = numpy.flatnonzero(active & (merged < dist[rows, nearest]))
+        nearest[closer] = i
+        del closest, j, merged, stale, closer
+    order = members[i]
+    del distance, n, dist, sizes, members, active, nearest, rows, i
+    return order
@@ -1,8 +1,35 @@
+import json
+import os
+from collections import OrderedDict
+
+import numpy
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QColor
 
 #TODO Add secondary structure theme?
 
+def compileTheme(theme, text='#ffffff'):
+    """
+    Builds a theme (the .theme dict of residue colors, or list of category colors) into a 256-entry lookup table
+    from character code (or conservation category) to an index into a palette of (background, text) color names.
+    Text contrast is worked out once per color here: dark backgrounds get the given text color, light get black.
+    Palette index 0 is the blank gap cell and index 1 a plain white residue, which anything unthemed falls to.
+    """
+    palette = [('#FFFFFF', None), ('#ffffff', '#000000')]
+    lut = numpy.ones(256, dtype=numpy.uint8)
+    lut[[ord('-'), ord(' ')]] = 0
+    items = theme.items() if isinstance(theme, dict) else enumerate(theme)
+    for key, color in items:
+        if color:
+            pair = (color.name(), text if color.getHsl()[2] / 255 * 100 <= 50 else '#000000')
+            if pair not in palette:
+                palette.append(pair)
+            lut[ord(key) if isinstance(key, str) else key] = palette.index(pair)
+            del pair
+    del items, theme, text
+    return palette, lut
+
+
 class AbstractTheme:
     """
     Here are the approximate residue percentages based on category.
@@ -24,6 +51,10 @@ class AbstractTheme:
     gly = QColor(Qt.white)
     pro = QColor(Qt.white)
     cys = QColor(Qt.white)
+    # Column statistic that colors whole columns (see ColumnTheme); None for themes colored by residue
+    metric = None
+    # Name in the registry, set by register
+    name = None
 
     def __init__(self):
         """ My standard categorizing. Can be changed per theme. Loosely based on type."""
@@ -53,6 +84,19 @@ class AbstractTheme:
 
         self.example = ['I', 'W', 'S', 'C', 'P', 'R', 'D', 'A', 'G']
 
+    def compiled(self, text='#ffffff'):
+        """
+        The theme as (palette, lookup table) from compileTheme, built once for each text color and read-only after,
+        since the same registered theme is shared by every window.
+        """
+        luts = self.__dict__.setdefault('luts', {})
+        if text not in luts:
+            palette, lut = compileTheme(self.theme, text)
+            lut.flags.writeable = False
+            luts[text] = (tuple(palette), lut)
+            del palette, lut
+        return luts[text]
+
     def getDesc(self):
         string = ["<pre style=\"text-align:right;\">"]
         for ex in self.example:
@@ -300,6 +344,42 @@ class Conservation(AbstractTheme):
         return "".join(string)
 
 
+class ColumnTheme(AbstractTheme):
+    """
+    Colors whole columns by one of the column statistics (see stats.METRICS), from pale for the least conserved
+    to dark for the most. The theme is a list of colors by bin of the 0 to 1 score; the lowest bin is left white.
+    """
+    label = "Score"
+
+    def __init__(self):
+        super().__init__()
+        self.theme = [None, QColor('#dbe6f6'), QColor('#a9c4ea'), QColor('#6f9bd8'), QColor('#2f5fb3')]
+        self.descr = ['%s %d-%d%%' % (self.label, low, low + 20) for low in (80, 60, 40, 20, 0)]
+        self.colors = list(reversed(self.theme))
+
+    getDesc = Conservation.getDesc
+
+
+class Entropy(ColumnTheme):
+    metric = 'entropy'
+    label = "Order"
+
+
+class Identity(ColumnTheme):
+    metric = 'identity'
+    label = "Identity"
+
+
+class Occupancy(ColumnTheme):
+    metric = 'gaps'
+    label = "Occupancy"
+
+
+class Blosum(ColumnTheme):
+    metric = 'blosum'
+    label = "Similarity"
+
+
 
 class Comments(AbstractTheme):
     """ Coloration for comments is done in the SeqInit method directly. """
@@ -312,3 +392,86 @@ class FirstTheme(AbstractTheme):
     cys = QColor(255, 255, 85)
     aro = QColor(145, 255, 168)
     gly = QColor(255, 255, 0)
+
+
+class CustomTheme(AbstractTheme):
+    """
+    Theme read from a file by loadTheme. Colors map one or more residue letters to a color, e.g. {"ILMV": "#97A4E8"},
+    and the optional descriptions map the same keys to the label shown in the color legend. Raises ValueError for
+    anything else, including letters that do not fit the single-byte residue tables.
+    """
+
+    def __init__(self, colors, descr=None):
+        super().__init__()
+        if not isinstance(colors, dict) or not all([isinstance(key, str) and isinstance(name, str)
+                                                    for key, name in colors.items()]):
+            raise ValueError("Theme colors must map residue letters to color names")
+        if descr is not None and (not isinstance(descr, dict) or not all([isinstance(key, str) and
+                                                                          isinstance(label, str)
+                                                                          for key, label in descr.items()])):
+            raise ValueError("Theme descriptions must map residue letters to text")
+        self.theme = {}
+        self.descr = {}
+        self.example = []
+        for residues, name in colors.items():
+            letters = residues.upper()
+            if not letters.isalpha() or len(letters) != len(residues) or max([ord(res) for res in letters]) > 255:
+                raise ValueError("Invalid theme residues %r" % residues)
+            color = QColor(name)
+            if not color.isValid():
+                raise ValueError("Invalid theme color %r for %r" % (name, residues))
+            for res in letters:
+                self.theme[res] = color
+            self.descr[letters[0]] = (descr or {}).get(residues, letters)
+            self.example.append(letters[0])
+            del letters, color
+        del colors, descr
+
+
+THEMES = OrderedDict()
+
+
+def register(name, theme):
+    """ Adds a theme to the registry under name, replacing any theme of that name, and returns it. """
+    theme.name = name
+    THEMES[name] = theme
+    del name
+    return theme
+
+
+def lookupTheme(name):
+    """ The registered theme of that name; the default for unknown names. Every caller gets the same instance. """
+    return THEMES.get(name, THEMES['Default'])
+
+
+def loadTheme(path):
+    """
+    Registers a custom theme from a JSON file: {"name": ..., "colors": {residues: color}, "descr": {residues: label}}.
+    The name defaults to the file name, and may not be that of a built-in theme. Raises ValueError if the file is
+    not a theme.
+    """
+    with open(path) as handle:
+        try:
+            data = json.load(handle)
+        except json.JSONDecodeError as error:
+            raise ValueError("Not a theme file: %s" % error)
+    if not isinstance(data, dict) or not isinstance(data.get('colors'), dict):
+        raise ValueError("Theme file has no colors")
+    name = data.get('name') or os.path.splitext(os.path.basename(path))[0]
+    if not isinstance(name, str):
+        raise ValueError("Theme name must be text")
+    if name in BUILTIN:
+        raise ValueError("%s is the name of a built-in theme" % name)
+    theme = register(name, CustomTheme(data['colors'], data.get('descr')))
+    del path, handle, data, name
+    return theme
+
+
+for _name, _theme in [('Default', PaleByType), ('Bold', Bold), ('Hydropathy', Hydropathy), ('ColorSafe', ColorSafe),
+                      ('Rainbow', Rainbow), ('Grayscale', Grayscale), ('Annotations', Comments),
+                      ('Conservation', Conservation), ('Identity', Identity), ('Entropy', Entropy),
+                      ('Occupancy', Occupancy), ('BLOSUM62', Blosum)]:
+    register(_name, _theme())
+del _name, _theme
+# Names that custom themes may not take over
+BUILTIN = frozenset(THEMES)
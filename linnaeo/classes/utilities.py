@@ -1,59 +1,129 @@
+import hashlib
 import json
 import logging
+import os
 import re
 import sys
+import threading
+import time
 import traceback
 import urllib
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
 from urllib.error import HTTPError
 
 import clustalo
 import numpy
 from Bio import PDB
 from Bio.PDB import DSSP, PDBIO
-from PyQt5.QtCore import pyqtSignal, QThread, QTimer, Qt, QTemporaryFile, QObject
+from PyQt5.QtCore import pyqtSignal, QThread, QTimer, Qt, QTemporaryFile, QObject, QRunnable, QThreadPool
+from PyQt5.QtGui import QFont, QFontMetricsF
 from bioservices import UniProt
-from linnaeo.classes import themes
+from linnaeo.classes import themes, stats
 
 """
 Additional classes and functions that are used within Linnaeo, but are not responsible for viewing data.
 """
 
+# Adapted from http://www.imgt.org/IMGTeducation/Aide-memoire/_UK/aminoacids/IMGTclasses.html
+# Original paper: https://pubmed.ncbi.nlm.nih.gov/14872534/
+CONSERVED = {
+    # Direct conserved first --> exact category
+    0: ['A','I','L','V','M'], 1: ['R', 'H', 'K'], 2: ['S', 'T'],
+    3: ['D', 'E'], 4: ['N','Q'], 5: ['C', 'C'], 6: ['G','G'], 7: ['P','P'], 8: ['W','W'],
+    9: ['Y','Y'], 10: ['F','F'],
+    # Very similar; mostly compatible swaps
+    11: ['I', 'L', 'V', 'M', 'F',], 12: ['A', 'S'], 13: ['D', 'N'], 14: ['E', 'Q'],
+    15: ['F', 'W', 'Y'], 16: ['A', 'T'], 17: ['H', 'Q'],
+    # Less similar; sort of compatible swaps
+    18: ['R', 'E', 'Q'], 19: ['K','E','Q'], 20: ['C','S',], 21: ['T','I','L','V','M','F'],
+    22: ['H', 'Y'], 23: ['W','Q']
+}
+
+
+def conservationMatrix():
+    """
+    Conservation category of every pair of letters, as a 26 x 26 array (A to Z both ways) with 255 where the pair
+    shares no category. Where a pair is in several categories the first one, the closest match, wins.
+    """
+    matrix = numpy.full((26, 26), 255, dtype=numpy.uint8)
+    for key in sorted(CONSERVED.keys(), reverse=True):
+        index = [ord(res) - 65 for res in CONSERVED[key]]
+        matrix[numpy.ix_(index, index)] = key
+    del key, index
+    return matrix
+
+
+# Built once: the letter matrix, and the same thing spread over all byte codes so residue arrays index it directly
+CONSERVATION = conservationMatrix()
+CONSERVATION_CODES = numpy.full((256, 256), 255, dtype=numpy.uint8)
+CONSERVATION_CODES[65:91, 65:91] = CONSERVATION
+
+
 def checkConservation(res, ref):
     """ Reads in a residue and checks whether it falls within a conserved category relative to the reference. """
-    conserved = {
-        # Adapted from http://www.imgt.org/IMGTeducation/Aide-memoire/_UK/aminoacids/IMGTclasses.html
-        # Original paper: https://pubmed.ncbi.nlm.nih.gov/14872534/
-        # Direct conserved first --> exact category
-        0: ['A','I','L','V','M'], 1: ['R', 'H', 'K'], 2: ['S', 'T'],
-        3: ['D', 'E'], 4: ['N','Q'], 5: ['C', 'C'], 6: ['G','G'], 7: ['P','P'], 8: ['W','W'],
-        9: ['Y','Y'], 10: ['F','F'],
-        # Very similar; mostly compatible swaps
-        11: ['I', 'L', 'V', 'M', 'F',], 12: ['A', 'S'], 13: ['D', 'N'], 14: ['E', 'Q'],
-        15: ['F', 'W', 'Y'], 16: ['A', 'T'], 17: ['H', 'Q'],
-        # Less similar; sort of compatible swaps
-        18: ['R', 'E', 'Q'], 19: ['K','E','Q'], 20: ['C','S',], 21: ['T','I','L','V','M','F'],
-        22: ['H', 'Y'], 23: ['W','Q']
-    }
-    for key, value in conserved.items():
-        #print("Searching %s, %s, in %s" % (res, ref, value))
-        if res in value and ref in value:
-        #    print('%s matches %s within %s' % (res, ref, value))
-            del value, res, ref, conserved
-            return key
-        else:
-            continue
-    del key, value, conserved, res, ref
-    return None
+    if not ("A" <= res <= "Z" and "A" <= ref <= "Z"):
+        return None
+    key = int(CONSERVATION[ord(res) - 65, ord(ref) - 65])
+    return None if key == 255 else key
+
 
+def conservationClasses(residues, ref):
+    """
+    Conservation category of every residue in a (sequence x position) array of character codes against a reference
+    row of the same width, 255 where there is none. One indexing operation into CONSERVATION_CODES.
+    """
+    return CONSERVATION_CODES[residues, ref[numpy.newaxis, :]]
+
+
+@lru_cache(maxsize=64)
+def paletteStyle(palette):
+    """
+    Style sheet with a class for every color index in a ResidueStore palette, so a colored run of residues is
+    just <span class="cN"> rather than an inline style on each residue. Palettes are tuples, so each style sheet is
+    only ever built once.
+    """
+    return "<style>%s</style>" % "".join(['.c%s{background-color:%s; color:%s;}' % (i, bg, fg) if fg else
+                                          '.c%s{background-color:%s;}' % (i, bg)
+                                          for i, (bg, fg) in enumerate(palette)])
+
+
+def colorRuns(seqs, row, start, end):
+    """ Residues of a row between two columns, as one span per run of residues that share a color. """
+    colors = seqs.colors[row, start:end]
+    if not len(colors):
+        return ""
+    edges = [0] + (numpy.flatnonzero(colors[1:] != colors[:-1]) + 1).tolist() + [len(colors)]
+    text = seqs.text(row, start, end)
+    runs = "".join(['<span class="c%s">%s</span>' % (c, text[a:b])
+                    for c, a, b in zip(colors[edges[:-1]].tolist(), edges, edges[1:])])
+    del seqs, row, start, end, colors, edges, text
+    return runs
 
-def redrawBasic(seqs, chars, lines, rulers=False, dssp=False):
+
+def redrawBasic(seqs, chars, lines, rulers=False, dssp=False, first=0, last=None):
     """
     Black and white only; keeps space for ruler but does not calculate the ruler or DSSP stuff,
     which helps with speed during window size changes.
+    First and last select a range of wrapped lines to draw (for the virtual viewport); default is all of them.
+    Seqs is the ResidueStore of the window.
+    """
+    return "<pre>\n" + "".join(basicLines(seqs, chars, lines, rulers, dssp, first, last)) + "</pre>"
+
+
+def basicLines(seqs, chars, lines, rulers=False, dssp=False, first=0, last=None, stop=None):
+    """
+    Same as redrawBasic, but returns the HTML of each wrapped line separately and without the pre tags.
+    Stop is checked before every line; if it returns True the drawing is abandoned and None is returned.
     """
-    html = ["<pre>\n"]
-    n = 0
-    for line in range(lines):
+    blocks = []
+    last = lines if last is None else last
+    n = first
+    for line in range(first, last):
+        if stop and stop():
+            return None
+        html = []
         if rulers:
             html.append("\n")
         if dssp:
@@ -61,35 +131,36 @@ def redrawBasic(seqs, chars, lines, rulers=False, dssp=False):
         start = n * chars
         end = n * chars + chars
         if line == lines - 1:
-            end = start + len(seqs[0][start:])
+            end = seqs.width
         for i in range(len(seqs)):
-            html.append("".join([x[0][-8] for x in seqs[i][start:end]]))
+            html.append(seqs.text(i, start, end))
             if line == lines-1:
-                label = str(seqs[i][end - 1][1])
-                if label == "0":
-                    for y in range(chars):
-                        label = str(seqs[i][end - 1 - y][1])
-                        if label != "0":
-                            break
-                    del y
+                label = str(seqs.lastResid(i, end))
                 html.append(" "*2 + label + "\n")
                 del label
             else:
                 html.append("\n")
 
         html.append("\n")
+        blocks.append("".join(html))
         n+=1
-    html.append("</pre>")
-    final = "".join(html)
-    del html, seqs, chars, lines, rulers, dssp, i, line, start, end, n
-    return final
+    del html, seqs, chars, lines, rulers, dssp, i, line, start, end, n, first, last
+    return blocks
 
 
-def redrawFancy(seqs, chars, lines, rulers, colors, dssp):
+def redrawFancy(seqs, chars, lines, rulers, colors, dssp, first=0, last=None):
     """
     Fancy like the name implies. Called at the end of resize events. Keeps your opinion on colors and rulers.
     Keeps a lot of whitespace because the tooltip and calculation of the residue ID depends on certain whitespace.
+    First and last select a range of wrapped lines to draw (for the virtual viewport); default is all of them.
+    Seqs is the ResidueStore of the window; colors come from its color index layer, as classes of the palette style.
     """
+    return paletteStyle(seqs.palette) + "<pre>" + \
+        "".join(fancyLines(seqs, chars, lines, rulers, colors, dssp, first, last)) + "</pre>"
+
+
+def structureRow(seqs, row, start, end):
+    """ DSSP symbols of a row between two columns, in the symbol font. """
     # All the possible symbols from DSSP. The unicode values were drawn by me in my modified default font.
     '''lookup = {'H': '&#x27B0;', 'G': '&nbsp;', 'I': '&nbsp;',
               '>': '&#x27B2;', 'E': '&#x27B1;', 'B': '&nbsp;',
@@ -100,125 +171,226 @@ def redrawFancy(seqs, chars, lines, rulers, colors, dssp):
               '>': '&#x27B2;', 'E': '&#x27B1;', 'B': '&nbsp;',
               'T': '&nbsp;', 'S': '&nbsp;',
               '-': '&nbsp;', 'C': '&nbsp;'}
-    html = ["<pre>"]
-    n = 0
+    ss = ['<span style=\"font-family:Default-Noto;font-size:inherit;\">']
+    codes = seqs.ss[row, start:end + 1].tolist()
+    # TODO: THIS DOES NOT WORK FOR ALIGNMENTS; NEED TO LOOK AT THE TRUE INDEX NOT RAW INDEX NUMBER?!
+    for index in range(end - start):
+        code = chr(codes[index]) if codes[index] else None
+        if code:
+            if code == "E":
+                if index + 1 >= len(codes) or codes[index + 1] != 69:
+                    ss.append(lookup['>'])
+                #    print('using arrowhead')
+                else:
+                #    print("using rectangle")
+                    ss.append(lookup[code])
+            else:
+                ss.append(lookup[code])
+    ss.append("</span>")
+    final = "".join(ss)
+    del seqs, row, start, end, lookup, ss, codes
+    return final
+
+
+def linearRows(seqs, first, last, start, end, rulers, colors, dssp):
+    """
+    HTML rows of the non-wrapping layout, without the pre tags: the ruler and structure rows when shown, then
+    sequences first to last, each cut down to the columns from start to end.
+    """
+    html = []
+    if rulers:
+        html.append(buildRuler(end - start, start, end) + "\n")
+    if dssp:
+        html.append(structureRow(seqs, 0, start, end) + "\n")
+    for i in range(first, last):
+        html.append(colorRuns(seqs, i, start, end) if colors else seqs.text(i, start, end))
+        html.append("\n")
+    final = "".join(html)
+    del seqs, first, last, start, end, rulers, colors, dssp, html
+    return final
+
+
+def fancyLines(seqs, chars, lines, rulers, colors, dssp, first=0, last=None, stop=None):
+    """
+    Same as redrawFancy, but returns the HTML of each wrapped line separately and without the pre tags.
+    Stop is checked before every line; if it returns True the drawing is abandoned and None is returned.
+    """
+    blocks = []
+    last = lines if last is None else last
+    n = first
     #print("Redraw Fancy: DSSP",dssp)
-    for line in range(lines):
+    rulerText = rulerLines(chars, lines, seqs.width, first, last) if rulers else None
+    for line in range(first, last):
+        if stop and stop():
+            return None
+        html = []
         start = n * chars
-        end = start + len(seqs[0][start:]) if line == lines - 1 else n * chars + chars
+        end = seqs.width if line == lines - 1 else n * chars + chars
         if rulers:
-            # If there is a horizontal ruler, build the ruler and thread it in.
-            html.append(str(buildRuler(chars, start, end))+"\n")
+            # If there is a horizontal ruler, thread it in.
+            html.append(str(rulerText[line - first])+"\n")
         for i in range(len(seqs)):
             if dssp and i == 0:
-                ss = ['<span style=\"font-family:Default-Noto;font-size:inherit;\">']
-                # TODO: THIS DOES NOT WORK FOR ALIGNMENTS; NEED TO LOOK AT THE TRUE INDEX NOT RAW INDEX NUMBER?!
-                for index, x in enumerate(seqs[i][start:end]):
-                    #print(index+start, x[2])
-                    if x[2]:
-                        if x[2] == "E":
-                            #print(x[2],index+start,"Next residue:", seqs[i][index+start+1][2], index+start+1)
-                            if seqs[i][index+start+1][2] != 'E':
-                                ss.append(lookup['>'])
-                            #    print('using arrowhead')
-                            else:
-                            #    print("using rectangle")
-                                ss.append(lookup[x[2]])
-                        else:
-                            ss.append(lookup[x[2]])
-                ss.append("</span>")
-                html.append("".join(ss))
-                #html.append("".join([x[2] if x[2] else "&nbsp;" for x in seqs[i][start:end]]))
+                html.append(structureRow(seqs, i, start, end))
                 if line == lines-1:
                     html.append("&nbsp;"*(chars-(end-start)))
                 html.append("\n")
             if colors:
-                # The whole thing has the HTML color as well
-                html.append("".join([x[0] for x in seqs[i][start:end]]))
+                # The whole thing has the HTML color as well, merged into runs of the same color
+                html.append(colorRuns(seqs, i, start, end))
             else:
                 # Only use the residue, not the color HTML part.
-                html.append("".join([x[0][-8] for x in seqs[i][start:end]]))
+                html.append(seqs.text(i, start, end))
             if line == lines-1:
                 # If last line, append the final residue ID number.
-                label = str(seqs[i][end - 1][1])
-                if label == "0":
-                    for y in range(chars):
-                        label = str(seqs[i][end - 1 - y][1])
-                        if label != "0":
-                            break
+                label = str(seqs.lastResid(i, end))
                 html.append("&nbsp;"*2 + label + "&nbsp;"*(chars-(end-start)-(len(label)+2))+"\n")
             else:
                 html.append("\n")
         if line < lines - 1:
             html.append(" "*chars+"\n")
+        blocks.append("".join(html))
         n += 1
-    html.append("</pre>")
-    final = "".join(html)
-    del seqs, chars, lines, rulers, colors, dssp, html, line, start, end, i,
-    return final
+    del seqs, chars, lines, rulers, colors, dssp, html, line, start, end, i, first, last, rulerText
+    return blocks
+
 
+def rulerInterval(chars):
+    """ Spacing of the ruler labels; divides the screen width into even intervals. """
+    interval = chars
+    if 25 <= chars <= 50:
+        interval = int(chars / 2)
+    elif 50 < chars <= 100:
+        interval = int(chars / 3)
+    elif 100 < chars <= 150:
+        interval = int(chars / 4)
+    elif 150 < chars <= 250:
+        interval = int(chars / 5)
+    elif 250 < chars:
+        interval = int(chars/6)
+    return interval
 
+
+@lru_cache(maxsize=8192)
 def buildRuler(chars, start, end):
-    """ Semi-complicated function for building the horizontal ruler. Divides the screen width into even intervals. """
-    ruler = None
-    if start != end:
-        interval = chars
-        if 25 <= chars <= 50:
-            interval = int(chars / 2)
-        elif 50 < chars <= 100:
-            interval = int(chars / 3)
-        elif 100 < chars <= 150:
-            interval = int(chars / 4)
-        elif 150 < chars <= 250:
-            interval = int(chars / 5)
-        elif 250 < chars:
-            interval = int(chars/6)
-        labels = list(numpy.arange(start, end, interval))
-        if len(labels) == 1:
-            #    print(labels[0])
-            if labels[0] <= (start + 1):
-                #        print("removed ", labels[0])
-                labels.pop(0)
-            elif labels[0] - (start + 1) < len(str(labels[-1])) * 2 + 2:
-                #        print("removed ", labels[0])
-                labels.pop(0)
-        if len(labels) > 1:
-            rm = []
-            for x in range(2):
-                #        print(labels[x])
-                if labels[x] - (start + 1) < len(str(labels[-1])) * 2 + 2:
-                    #            print("Removed ",labels[x])
-                    rm.append(labels[x])
-                    if len(labels) <= 1:
-                        break
-                if end - labels[-x] < len(str(labels[-1])) * 2 + 2:
-                    #            print("Removed ",labels[-x])
-                    rm.append(labels[-x])
-            [labels.remove(x) for x in rm]
-            del rm
-        labels.insert(0, start + 1)
-        if end - (start + 1) >= len(str(start + 1)) + len(str(end)) + 2:
-            labels.append(end)
-        # print(labels)
-        rulel = ['<u>' + str(labels[0])[0] + '</u>' + str(labels[0])[1:]]
-        for x in labels[1:]:
-            prevx = labels[labels.index(x) - 1]
-            xlab = len(str(x))
-            if labels.index(x) == 1 and len(str(prevx)) > 1:
-                # Different for first space because I left align the first number.
-                xlab = len(str(x)) + len(str(prevx)) - 1
-            spacer = x - prevx - xlab
-            #   print("Spacer is (%s-%s)-%s=%s " % (x, prevx, xlab, spacer))
-            rulel.append("&nbsp;" * spacer)
-            rulel.append(str(x)[:-1] + '<u>' + str(x)[-1:] + '</u>')
-            del spacer
-            del x, prevx, xlab,
-        count = list(re.findall(r'(&nbsp;)|[0-9]',"".join(rulel)))
-        rulel.append("&nbsp;"*(chars-len(count)))
-        ruler = "".join(rulel)
-        del rulel, count, labels, interval
-    del chars, start, end,
-    return ruler
+    """
+    Builds the horizontal ruler for columns start to end. The first column and (when it fits) the last one are
+    labelled, with evenly spaced labels in between, dropping any that would crowd the ends. Positions and padding
+    are worked out arithmetically, and each ruler is only ever built once for a given width and start.
+    """
+    if start == end:
+        return None
+    ticks = range(start, end, rulerInterval(chars))
+    labels = []
+    if len(ticks) > 1:
+        crowded = len(str(ticks[-1])) * 2 + 2
+        # The first tick always sits on the start label
+        drop = {ticks[0]}
+        if ticks[1] - (start + 1) < crowded:
+            drop.add(ticks[1])
+        if end - ticks[-1] < crowded:
+            drop.add(ticks[-1])
+        labels = [x for x in ticks if x not in drop]
+        del crowded, drop
+    labels.insert(0, start + 1)
+    if end - (start + 1) >= len(str(start + 1)) + len(str(end)) + 2:
+        labels.append(end)
+    first = str(labels[0])
+    ruler = ['<u>' + first[0] + '</u>' + first[1:]]
+    count = len(first)
+    for i in range(1, len(labels)):
+        label = str(labels[i])
+        xlab = len(label)
+        if i == 1 and len(first) > 1:
+            # Different for first space because I left align the first number.
+            xlab += len(first) - 1
+        spacer = max(0, labels[i] - labels[i - 1] - xlab)
+        ruler.append("&nbsp;" * spacer + label[:-1] + '<u>' + label[-1:] + '</u>')
+        count += spacer + len(label)
+        del label, xlab, spacer
+    ruler.append("&nbsp;" * (chars - count))
+    del chars, start, end, ticks, labels, first, count
+    return "".join(ruler)
+
+
+@lru_cache(maxsize=8192)
+def rulerCells(ruler):
+    """ A ruler from buildRuler as plain (character, underlined) cells, for drawing it without the text engine. """
+    cells = []
+    for part in re.split(r'(<u>.*?</u>)', ruler.replace("&nbsp;", " ")):
+        if part.startswith('<u>'):
+            cells.extend([(ch, True) for ch in part[3:-4]])
+        else:
+            cells.extend([(ch, False) for ch in part])
+    del ruler
+    return tuple(cells)
+
+
+def rulerLines(chars, lines, width, first=0, last=None):
+    """ Horizontal rulers for the wrapped lines first to last of an alignment of the given width, in one go. """
+    last = lines if last is None else last
+    return [buildRuler(chars, n * chars, width if n == lines - 1 else n * chars + chars) for n in range(first, last)]
+
+
+def rowCells(seqs, chars, lines, flags, row, base, text):
+    """
+    Everything on one text row of the wrapped layout as (column, (text, background, text color[, underline,
+    structure font])) cells, laid out the same as fancyLines. Blank cells are left out unless they are colored.
+    Flags are (colors, rulers, dssp) and the row counts every row of every line, blank separator rows included.
+    """
+    colors, rulers, dssp = flags
+    line, kind = divmod(row, len(seqs) + int(rulers) + int(dssp) + 1)
+    start = line * chars
+    end = seqs.width if line == lines - 1 else start + chars
+    if rulers:
+        if kind == 0:
+            ruler = buildRuler(chars, start, end) or ""
+            return [(column, (ch, base, text, underline)) for column, (ch, underline)
+                    in enumerate(rulerCells(ruler)) if ch != " "]
+        kind -= 1
+    if dssp:
+        if kind == 0:
+            codes = seqs.ss[0, start:end + 1].tolist()
+            cells = []
+            for index in range(end - start):
+                if codes[index] == 72:
+                    cells.append((index, ("\u27B0", base, text, False, True)))
+                elif codes[index] == 69:
+                    arrow = "\u27B2" if index + 1 >= len(codes) or codes[index + 1] != 69 else "\u27B1"
+                    cells.append((index, (arrow, base, text, False, True)))
+            return cells
+        kind -= 1
+    if kind >= len(seqs):
+        return []
+    letters = seqs.text(kind, start, end)
+    if colors:
+        palette = seqs.palette
+        cells = [(column, (ch, palette[c][0], palette[c][1] or text)) for column, (ch, c) in
+                 enumerate(zip(letters, seqs.colors[kind, start:end].tolist()))]
+    else:
+        cells = [(column, (ch, base, text)) for column, ch in enumerate(letters) if ch != " "]
+    if line == lines - 1:
+        # Last line carries the final residue number, two spaces after the residues
+        label = str(seqs.lastResid(kind, end))
+        cells.extend([(end - start + 2 + i, (ch, base, text)) for i, ch in enumerate(label)])
+    return cells
+
+
+FontMeasure = namedtuple('FontMeasure', ['metrics', 'charWidth', 'lineSpacing', 'ssWidth'])
+
+
+@lru_cache(maxsize=None)
+def fontMetrics(family, size):
+    """
+    Measurements of a font, shared by the whole program: the QFontMetricsF itself, its average character width and
+    line spacing, and the width of the Default-Noto structure symbols at the same size. Every (family, point size)
+    is only ever measured once, however many windows use it.
+    """
+    metrics = QFontMetricsF(QFont(family, size))
+    measure = FontMeasure(metrics, metrics.averageCharWidth(), metrics.lineSpacing(),
+                          QFontMetricsF(QFont("Default-Noto", size)).averageCharWidth())
+    del family, size, metrics
+    return measure
 
 
 def checkName(name, titles, layer=0):
@@ -293,39 +465,127 @@ def nodeSelector(tree, model):
 
 
 def lookupTheme(theme):
-    """ Converts the stored theme name into a class """
-    match = themes.PaleByType()
-    if theme == 'Default':
-        match = themes.PaleByType()
-    elif theme == 'Bold':
-        match = themes.Bold()
-    elif theme == 'Hydropathy':
-        match = themes.Hydropathy()
-    elif theme == 'ColorSafe':
-        match = themes.ColorSafe()
-    elif theme == 'Rainbow':
-        match = themes.Rainbow()
-    elif theme == 'Grayscale':
-        match = themes.Grayscale()
-    elif theme == 'Annotations':
-        match = themes.Comments()
-    elif theme == 'Conservation':
-        match = themes.Conservation()
-    del theme
-    return match
-
-
-class SeqThread(QThread):
-    """
-     Determines which type of redraw should occur based on the values of rulers, colors, and "fancy", then
-     does this in a separate thread. See redraw functions above.
-     """
-    finished = pyqtSignal()
+    """ Converts the stored theme name into the registered theme; see themes.register. """
+    return themes.lookupTheme(theme)
 
-    def __init__(self, *args, fancy=True, parent=None):
-        QThread.__init__(self, parent)
-        self.seqLogger = logging.getLogger("SEQDRAW")
-        self.html = None
+
+class RenderTimings:
+    """
+    Timing spans for the stages of drawing an alignment window, for finding out where a slow redraw goes.
+    Each span is a stage name, its duration and attributes such as the sequence and column counts or the HTML size;
+    finish closes a redraw, keeps its spans as the last breakdown and logs it.
+    Switched on and off for every window at once through enabled. While it is off, span hands back one shared
+    do-nothing context and add returns straight away, so the drawing code pays no more than the call.
+    """
+    enabled = False
+    NOSPAN = nullcontext()
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.spans = []
+        self.last = []
+        del logger
+
+    @contextmanager
+    def timed(self, stage, attrs):
+        start = time.perf_counter()
+        yield attrs
+        self.spans.append((stage, time.perf_counter() - start, attrs))
+        del start, stage, attrs
+
+    def span(self, stage, **attrs):
+        """ Context that times its body as one stage; attributes can be added to the yielded dict. """
+        if not RenderTimings.enabled:
+            return self.NOSPAN
+        return self.timed(stage, attrs)
+
+    def add(self, stage, seconds, **attrs):
+        """ A stage that was timed elsewhere, like a render job off the GUI thread. """
+        if RenderTimings.enabled:
+            self.spans.append((stage, seconds, attrs))
+        del stage, seconds, attrs
+
+    def finish(self):
+        """ Ends a redraw: its spans become the last breakdown, which is also logged. """
+        if self.spans:
+            self.last = self.spans
+            self.spans = []
+            self.logger.info("Render: %s" % self.summary())
+
+    def summary(self):
+        """ The last breakdown as one line, e.g. 'seqInit 2.1 ms (seqs=20, cols=400) | setHtml 40.0 ms ...' """
+        parts = []
+        for stage, seconds, attrs in self.last:
+            details = ", ".join(["%s=%s" % item for item in attrs.items()])
+            parts.append("%s %.1f ms" % (stage, seconds * 1000) + (" (%s)" % details if details else ""))
+        final = " | ".join(parts)
+        del parts
+        return final
+
+
+class BlockCache:
+    """
+    Least-recently-used store of drawn HTML for single wrapped lines, so a window going back to a width (or theme,
+    reference, etc.) it was just at can reuse what it drew. Keys are (layout, line) where layout holds everything
+    the drawing depends on. Bounded by the total size of the stored HTML rather than a count of lines.
+    """
+
+    def __init__(self, budget=32 * 1024 * 1024):
+        self.budget = budget
+        self.size = 0
+        self._blocks = OrderedDict()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key):
+        html = self._blocks.get(key)
+        if html is not None:
+            self._blocks.move_to_end(key)
+        return html
+
+    def put(self, key, html):
+        if key in self._blocks:
+            self.size -= len(self._blocks.pop(key))
+        self._blocks[key] = html
+        self.size += len(html)
+        self.evict()
+        del key, html
+
+    def evict(self):
+        """ Drops the least recently used lines until the stored HTML fits in the budget. """
+        while self._blocks and self.size > self.budget:
+            self.size -= len(self._blocks.popitem(last=False)[1])
+
+    def setBudget(self, budget):
+        self.budget = budget
+        self.evict()
+        del budget
+
+    def clear(self):
+        self._blocks.clear()
+        self.size = 0
+
+
+class RenderSignals(QObject):
+    """ Runnables are not QObjects, so render jobs send their results through one of these, owned by the service. """
+    finished = pyqtSignal(object)
+
+
+class RenderJob(QRunnable):
+    """
+    Draws a range of wrapped lines off the GUI thread, fancy or basic depending on the flags (see the draw
+    functions above). Checks its cancelled flag between lines and gives up as soon as it is set.
+    """
+
+    def __init__(self, signals, generation, key, *args, fancy=True, first=0, last=None):
+        QRunnable.__init__(self)
+        self.signals = signals
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.generation = generation
+        self.key = key
+        self.cancelled = False
         self.seqs = args[0]
         self.chars = args[1]
         self.lines = args[2]
@@ -333,18 +593,95 @@ class SeqThread(QThread):
         self.colors = args[4]
         self.dssp = args[5]
         self.fancy = fancy
-        del args, fancy, parent
-        #self.seqLogger.debug("Sequence thread created")
+        self.first = first
+        self.last = last
+        del args, fancy, first, last, generation, key, signals
 
     def run(self):
-        while not self.html:
+        start = time.perf_counter()
+        try:
             if self.fancy:
-                self.html = redrawFancy(self.seqs, self.chars, self.lines, self.rulers, self.colors, self.dssp)
+                blocks = fancyLines(self.seqs, self.chars, self.lines, self.rulers, self.colors, self.dssp,
+                                    first=self.first, last=self.last, stop=self.isCancelled)
             else:
-                self.html = redrawBasic(self.seqs, self.chars, self.lines, self.rulers, self.dssp)
-        #self.seqLogger.debug("Sequence thread finished")
-        self.finished.emit()
+                blocks = basicLines(self.seqs, self.chars, self.lines, self.rulers, self.dssp,
+                                    first=self.first, last=self.last, stop=self.isCancelled)
+            if blocks is not None and not self.cancelled:
+                try:
+                    self.signals.finished.emit((self.generation, self.key, self.first, blocks,
+                                                time.perf_counter() - start))
+                except RuntimeError:
+                    # The window, and its service with the signals, went away while the lines were drawn
+                    pass
+            del blocks
+        finally:
+            with self.lock:
+                self.done.set()
+        del start
 
+    def isCancelled(self):
+        return self.cancelled
+
+
+class RenderService(QObject):
+    """
+    Asynchronous drawing for an alignment window. Every request gets a new generation number and cancels the one
+    in flight, and results are only delivered (through rendered) when they belong to the latest generation, so
+    a burst of requests during a drag-resize costs one drawing rather than a queue of them.
+    rendered sends (key, first line, [html of each line]); how long the drawing took is left in seconds.
+    """
+    rendered = pyqtSignal(object, int, list)
+
+    def __init__(self, parent=None, pool=None):
+        QObject.__init__(self, parent)
+        self.pool = pool if pool else QThreadPool.globalInstance()
+        self.signals = RenderSignals(self)
+        self.signals.finished.connect(self.deliver)
+        self.generation = 0
+        self.current = None
+        self.seconds = 0
+        del parent, pool
+
+    def request(self, key, *args, fancy=True, first=0, last=None):
+        self.cancel()
+        job = RenderJob(self.signals, self.generation, key, *args, fancy=fancy, first=first, last=last)
+        self.current = job
+        self.pool.start(job)
+        del job, key, args, fancy, first, last
+
+    def cancel(self):
+        """ Drops whatever is in flight; its result will be ignored even if it has already been sent. """
+        self.generation += 1
+        if self.current:
+            self.current.cancelled = True
+            self.current = None
+
+    def stop(self):
+        """
+        Cancels the job in flight and, if it has already started, waits for it to give up, so that nothing is left
+        running for a window that is being closed. Jobs check between lines, so this takes one line at most.
+        """
+        job = self.current
+        self.cancel()
+        if job is not None:
+            with job.lock:
+                # The pool deletes a job once it returns, which it can't do before done is set
+                waiting = not job.done.is_set() and not self.pool.tryTake(job)
+            if waiting:
+                job.done.wait()
+            del waiting
+        del job
+
+    def pending(self):
+        return self.current is not None
+
+    def deliver(self, result):
+        generation, key, first, blocks, seconds = result
+        if generation == self.generation:
+            self.seconds = seconds
+            self.current = None
+            self.rendered.emit(key, first, blocks)
+        del result, generation, key, first, blocks, seconds
 
 
 class GetPDBThread(QThread):
@@ -530,6 +867,7 @@ class AlignThread(QThread):
     Clustal Omega is run in a separate thread. Currently have no idea how to access the alignment order;
     I'm hoping there is a way, rather than returning it with the input order.
     I can't find anything in the source code of ClustalO for the API though, sadly.
+    Emits finished once the run is over, whether or not it failed (error comes first if it did).
     """
     finished = pyqtSignal()
     error = pyqtSignal(tuple)
@@ -556,6 +894,230 @@ class AlignThread(QThread):
             self.aligned = result
             self.clustalLogger.debug("Thread returned alignment successfully")
             del result
+        self.finished.emit()
+
+
+class AlignJob:
+    """ One Clustal Omega run in the AlignQueue; callback gets the alignment if the job completes. """
+    QUEUED, RUNNING, DONE, FAILED, CANCELLED = "Queued", "Running", "Done", "Failed", "Cancelled"
+
+    def __init__(self, jid, title, seqs, callback):
+        self.jid = jid
+        self.title = title
+        self.seqs = seqs
+        self.count = len(seqs)
+        self.callback = callback
+        self.state = self.QUEUED
+        self.thread = None
+        self.started = None
+        self.elapsed = 0
+        self.error = None
+        del jid, title, seqs, callback
+
+    def runtime(self):
+        """ Seconds spent running so far, or in total once finished. """
+        if self.thread is not None and self.started is not None:
+            return time.perf_counter() - self.started
+        return self.elapsed
+
+
+class AlignQueue(QObject):
+    """
+    Runs alignments one AlignThread each, at most maxJobs at once and with threads ClustalO threads apiece, in the order
+    they were submitted. The callback of a job is called on the GUI thread when it completes.
+    Clustal Omega can't be stopped part way, so cancelling a running job only discards its result; it still holds
+    its slot until the run returns.
+    """
+    changed = pyqtSignal()
+    PARAMS = {'seqtype': 3}
+
+    def __init__(self, parent, maxJobs=1, threads=1):
+        super().__init__(parent)
+        self.jobs = []
+        self.maxJobs = maxJobs
+        self.threads = threads
+        self.jid = 0
+        self.logger = logging.getLogger("ClustalO")
+        del parent, maxJobs, threads
+
+    def submit(self, title, seqs, callback):
+        self.jid += 1
+        job = AlignJob(self.jid, title, seqs, callback)
+        self.jobs.append(job)
+        self.logger.info("Queued alignment %s: %s" % (job.jid, title))
+        self.startNext()
+        self.changed.emit()
+        return job
+
+    def active(self):
+        """ Jobs whose thread is still going, including cancelled ones that have not returned yet. """
+        return [job for job in self.jobs if job.thread is not None]
+
+    def pending(self):
+        return [job for job in self.jobs if job.state in (AlignJob.QUEUED, AlignJob.RUNNING)]
+
+    def setLimits(self, maxJobs, threads):
+        self.maxJobs = maxJobs
+        self.threads = threads
+        self.startNext()
+        self.changed.emit()
+        del maxJobs, threads
+
+    def startNext(self):
+        queued = [job for job in self.jobs if job.state == AlignJob.QUEUED]
+        while queued and len(self.active()) < self.maxJobs:
+            job = queued.pop(0)
+            job.thread = AlignThread(self.parent(), job.seqs, num_threads=self.threads, **self.PARAMS)
+            job.thread.error.connect(lambda error, job=job: self.jobFailed(job, error))
+            job.thread.finished.connect(lambda job=job: self.jobFinished(job))
+            job.state = AlignJob.RUNNING
+            job.started = time.perf_counter()
+            job.thread.start()
+        del queued
+
+    def jobFailed(self, job, error):
+        job.error = str(error[1])
+        del job, error
+
+    def jobFinished(self, job):
+        job.elapsed = time.perf_counter() - job.started
+        job.thread.wait()
+        aligned = job.thread.aligned
+        job.thread.deleteLater()
+        job.thread = None
+        if job.state == AlignJob.RUNNING:
+            job.state = AlignJob.FAILED if job.error is not None else AlignJob.DONE
+        self.logger.info("Alignment %s %s after %.2f seconds" % (job.jid, job.state.lower(), job.elapsed))
+        self.startNext()
+        self.changed.emit()
+        if job.state == AlignJob.DONE:
+            job.callback(aligned)
+        job.seqs = None
+        job.callback = None
+        del job, aligned
+
+    def cancel(self, job):
+        if job.state in (AlignJob.QUEUED, AlignJob.RUNNING):
+            job.state = AlignJob.CANCELLED
+            job.callback = None
+            self.logger.info("Cancelled alignment %s" % job.jid)
+            self.changed.emit()
+        del job
+
+    def cancelAll(self):
+        for job in self.pending():
+            self.cancel(job)
+
+    def clearFinished(self):
+        self.jobs = [job for job in self.jobs if job.state in (AlignJob.QUEUED, AlignJob.RUNNING) or job.thread is not None]
+        self.changed.emit()
+
+    def wait(self):
+        """ Blocks until every thread has returned, as a thread must not be destroyed while it runs. """
+        for job in self.active():
+            job.thread.wait()
+
+
+class AlignCache:
+    """
+    Clustal Omega alignments kept on disk, one JSON file each, named by the sha256 of the sorted sequences (gaps
+    removed) and the aligner parameters, so the same sequences are not aligned twice, even across sessions. Names are
+    not part of the key: a hit is handed back under the names it was asked for, in the order asked. Once the files
+    come to more than maxBytes, the least recently used are removed.
+    """
+
+    def __init__(self, path, params, maxBytes=64 * 1024 * 1024):
+        self.path = path
+        self.params = params
+        self.maxBytes = maxBytes
+        self.logger = logging.getLogger("AlignCache")
+        del path, params, maxBytes
+
+    def filename(self, seqs):
+        sequences = sorted(str(seq).replace('-', '') for seq in seqs.values())
+        digest = hashlib.sha256(json.dumps([sequences, self.params], sort_keys=True).encode()).hexdigest()
+        del seqs, sequences
+        return os.path.join(self.path, digest + ".json")
+
+    def get(self, seqs):
+        """ The cached alignment of seqs, as {name: aligned row}, or None if there isn't one. """
+        filename = self.filename(seqs)
+        try:
+            with open(filename) as handle:
+                rows = json.load(handle)['rows']
+            os.utime(filename)
+        except (OSError, ValueError, KeyError):
+            del filename
+            return None
+        # Hand each row to the name of an input with the same residues; equal sequences go in turn
+        names = {}
+        for name, seq in seqs.items():
+            names.setdefault(str(seq).replace('-', ''), []).append(name)
+        aligned = {}
+        for row in rows:
+            waiting = names.get(row.replace('-', ''))
+            if not waiting:
+                self.logger.warning("Cached alignment %s does not match its sequences" % filename)
+                return None
+            aligned[waiting.pop(0)] = row
+        self.logger.debug("Alignment found in cache: %s" % filename)
+        del filename, rows, names
+        return {name: aligned[name] for name in seqs}
+
+    def put(self, seqs, aligned):
+        """ Stores aligned as the alignment of seqs; a cache that can't be written is only logged. """
+        filename = self.filename(seqs)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(filename + ".tmp", 'w') as handle:
+                json.dump({'params': self.params, 'rows': [str(row) for row in aligned.values()]}, handle)
+            os.replace(filename + ".tmp", filename)
+            self.evict()
+        except OSError as error:
+            self.logger.warning("Unable to cache alignment: %s" % error)
+        del seqs, aligned, filename
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.path) as files:
+            for entry in files:
+                if entry.name.endswith(".json"):
+                    info = entry.stat()
+                    entries.append((info.st_mtime, info.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            os.remove(path)
+            total -= size
+            self.logger.debug("Evicted cached alignment %s" % path)
+        del entries, total
+
+
+class IdentityThread(QThread):
+    """
+    Pairwise percent identity and similarity of the rows of an alignment (see stats.pairwiseIdentity), and the order
+    that clusters them by identity, worked out off the GUI thread. Large alignments are spread over processes.
+    """
+    finished = pyqtSignal(list)
+    error = pyqtSignal(tuple)
+
+    def __init__(self, residues, parent=None):
+        QThread.__init__(self, parent)
+        self.residues = residues
+        del residues, parent
+
+    def run(self):
+        try:
+            identity, similarity = stats.pairwiseIdentity(self.residues)
+            order = stats.clusterOrder(100 - identity)
+        except Exception:
+            traceback.print_exc()
+            exctype, value = sys.exc_info()[:2]
+            self.error.emit((exctype, value, traceback.format_exc()))
+        else:
+            self.finished.emit([identity, similarity, order])
+            del identity, similarity, order
 
 
 class ProcTimerThread(QThread):
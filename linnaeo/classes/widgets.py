@@ -1,15 +1,20 @@
 #!/usr/bin/python3
 import logging
 import sys
-from math import floor
+from collections import OrderedDict
+from math import floor, ceil
 
-from PyQt5.QtCore import Qt, pyqtSignal, QSize, QPoint, QTimer
-from PyQt5.QtGui import QStandardItemModel, QTextCursor, QIcon
+from PyQt5.QtCore import Qt, pyqtSignal, QSize, QPoint, QTimer, QPointF, QRectF
+from PyQt5.QtGui import QStandardItemModel, QTextCursor, QIcon, QPixmap, QPainter, QColor, QFont, QFontMetricsF, \
+    QImage
 from PyQt5.QtWidgets import QMdiSubWindow, QMdiArea, QTabBar, QTreeView, QSizePolicy, QAbstractItemView, \
-    QTextEdit, QAbstractScrollArea, QToolTip
+    QTextEdit, QAbstractScrollArea, QToolTip, QWidget, QMenu, QTreeWidget, QTreeWidgetItem, QPushButton, QSpinBox, \
+    QGridLayout, QLabel
+
+import numpy
 
 from linnaeo.resources import linnaeo_rc
-from linnaeo.classes import utilities
+from linnaeo.classes import utilities, stats
 
 
 class TreeView(QTreeView):
@@ -275,6 +280,62 @@ class ItemModel(QStandardItemModel):
             return super(ItemModel, self).setData(index, value, role)
 
 
+class GlyphAtlas:
+    """
+    Pre-rasterized character cells for the painter mode of AlignPane. Every (text, background, text color, underline,
+    structure font) cell is drawn once into a shared pixmap at the current fonts and handed out as a source rectangle,
+    so painting the alignment is just copying fragments of that pixmap.
+    """
+    COLUMNS = 32
+
+    def __init__(self, font, ssFont, width, height):
+        self.fonts = (QFont(font), QFont(ssFont))
+        self.width = int(ceil(width))
+        self.height = int(ceil(height))
+        self.ascents = (QFontMetricsF(self.fonts[0]).ascent(), QFontMetricsF(self.fonts[1]).ascent())
+        self.cells = {}
+        self.pixmap = QPixmap(self.width * self.COLUMNS, self.height * 4)
+        self.pixmap.fill(Qt.transparent)
+        del font, ssFont, width, height
+
+    def __len__(self):
+        return len(self.cells)
+
+    def source(self, text, bg, fg, underline=False, ss=False):
+        rect = self.cells.get((text, bg, fg, underline, ss))
+        if rect is None:
+            rect = self.raster((text, bg, fg, underline, ss))
+        return rect
+
+    def raster(self, key):
+        """ Draws a new cell into the next free slot, doubling the pixmap when it is full. """
+        text, bg, fg, underline, ss = key
+        row, column = divmod(len(self.cells), self.COLUMNS)
+        if (row + 1) * self.height > self.pixmap.height():
+            grown = QPixmap(self.pixmap.width(), self.pixmap.height() * 2)
+            grown.fill(Qt.transparent)
+            painter = QPainter(grown)
+            painter.drawPixmap(0, 0, self.pixmap)
+            painter.end()
+            self.pixmap = grown
+            del grown
+        rect = QRectF(column * self.width, row * self.height, self.width, self.height)
+        painter = QPainter(self.pixmap)
+        painter.setClipRect(rect)
+        painter.fillRect(rect, QColor(bg))
+        if text.strip():
+            font = QFont(self.fonts[int(ss)])
+            font.setUnderline(underline)
+            painter.setFont(font)
+            painter.setPen(QColor(fg))
+            painter.drawText(QPointF(rect.x(), rect.y() + self.ascents[int(ss)]), text)
+            del font
+        painter.end()
+        self.cells[key] = rect
+        del key, text, bg, fg, underline, ss, row, column, painter
+        return rect
+
+
 class AlignPane(QTextEdit):
 
     ttReq = pyqtSignal(QPoint, QTextCursor)
@@ -288,8 +349,20 @@ class AlignPane(QTextEdit):
         self.chars = None
         self.lastchars = None
         self.lines = None
-        self.seqs = None
+        self.firstLine = 0  # First wrapped line in the document; only moves in virtual mode
+        self.linear = None  # (first sequence, first column, header rows) when wrapping is off
+        self.store = None
         self.names = None
+        # Painter mode: cells are copied from a glyph atlas instead of laid out by the text document
+        self.painted = False
+        self.atlas = None
+        self.atlasKey = None
+        self.cellFont = QFont()
+        self.ssFont = QFont("Default-Noto")
+        self.topRow = 0
+        self.rowOffset = 0
+        self.rowHeight = 1
+        self.flags = (True, True, True)
 
         sizePolicy = QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         sizePolicy.setHorizontalStretch(0)
@@ -313,11 +386,13 @@ class AlignPane(QTextEdit):
 
     def setChars(self, chars):
         self.chars = chars
-        self.lastchars = len(self.seqs[0])-self.chars*(self.lines-1)
+        self.lastchars = self.store.width-self.chars*(self.lines-1)
         del chars
 
     def getSeqPos(self, pos, row_pos):
-        seqsperline = (len(self.seqs) + int(self.parentWidget().parentWidget().showRuler) + \
+        if self.linear:
+            return self.linearPos(pos, row_pos)
+        seqsperline = (len(self.store) + int(self.parentWidget().parentWidget().showRuler) + \
                        int(self.parentWidget().parentWidget().showDSSP) + 1)
         #cutoff = (self.lines-1)*seqsperline*(self.chars+1)
         # TODO: Can delete the cutoff stuff
@@ -325,7 +400,7 @@ class AlignPane(QTextEdit):
         # Have to do special stuff if it's on the last line, since there are no blank characters to keep the pattern.
         # Probably should have put them in to make my life easier, but whatever, I already figured it out.
         #if pos <= cutoff:
-        line = floor(pos/(self.chars+1))
+        line = floor(pos/(self.chars+1)) + self.firstLine * seqsperline
         #else:
         #line = ((self.lines-1)*seqsperline)+floor((pos-cutoff-2)/(self.lastchars+1))
         seqi = 0
@@ -333,22 +408,35 @@ class AlignPane(QTextEdit):
         for stack in range(self.lines):
             i = line - stack * seqsperline - int(self.parentWidget().parentWidget().showRuler) -\
                 int(self.parentWidget().parentWidget().showDSSP)
-            if i in list(range(len(self.seqs))):
+            if 0 <= i < len(self.store):
                 seqi = i
                 tline = stack
         tpos = tline * self.chars + row_pos - 1
         others = []
         try:
-            resid = self.seqs[seqi][tpos][1]
-            for n in range(len(self.seqs)):
+            resid = int(self.store.resids[seqi, tpos])
+            for n in range(len(self.store)):
                 if n != seqi:
-                    others.append([n, self.seqs[n][tpos][1]])
+                    others.append([n, int(self.store.resids[n, tpos]), tpos])
             true_pos = [[seqi, resid, tpos]] + others
         except IndexError:
             true_pos = None
         del pos, row_pos, seqsperline, line, seqi, tline, stack, tpos, others
         return true_pos
 
+    def linearPos(self, pos, row_pos):
+        """ getSeqPos for the non-wrapping layout, where each block is one sequence cut to the visible columns. """
+        first, start, header = self.linear
+        seqi = first + self.document().findBlock(pos).blockNumber() - header
+        tpos = start + row_pos - 1
+        if not first <= seqi < len(self.store) or not 0 <= tpos < self.store.width:
+            del pos, row_pos, first, start, header, seqi, tpos
+            return None
+        others = [[n, int(self.store.resids[n, tpos]), tpos] for n in range(len(self.store)) if n != seqi]
+        true_pos = [[seqi, int(self.store.resids[seqi, tpos]), tpos]] + others
+        del pos, row_pos, first, start, header, seqi, tpos, others
+        return true_pos
+
     def makeTT(self, mpos, curs):
         """ Converts a mouse position and text cursor into a tooltip by getting the true residue IDs """
         # Such elegance.
@@ -356,6 +444,11 @@ class AlignPane(QTextEdit):
         pos = self.textCursor().position()
         row_pos = self.textCursor().positionInBlock()
         resids = self.getSeqPos(pos, row_pos)
+        self.showTT(mpos, resn, resids)
+        del mpos, curs, resn, pos, row_pos, resids
+
+    def showTT(self, mpos, resn, resids):
+        """ Shows the tooltip for a residue, given the true residue IDs from getSeqPos or cellAt. """
         if resids and resn in ['A','C','D','E','F','G','H','I','K',
                         'L','M','N','P','Q','R','S','T','V','W','Y']:
             string = []
@@ -363,7 +456,10 @@ class AlignPane(QTextEdit):
                 name = self.names[each[0]]
                 resi = each[1]
                 if resi == 0:
-                    resi = "N/A"
+                    # Gap: say where it is in that sequence, from the last residue before it
+                    after = self.store.lastResid(each[0], each[2] + 1)
+                    resi = "N/A (after %s)" % after if after else "N/A"
+                    del after
                 text = str(resi)+" of "+name
                 if i > 0:
                     text = " --->" + text
@@ -375,7 +471,7 @@ class AlignPane(QTextEdit):
             del string
         else:
             QToolTip.hideText()
-        del mpos, curs, resn, pos, row_pos, resids,
+        del mpos, resn, resids
 
     def addAnnotation(self, curs):
         """ Locates the residue you double clicked"""
@@ -389,6 +485,92 @@ class AlignPane(QTextEdit):
             self.commentAdded.emit(target)
         del resn, pos, row_pos, resids, curs
 
+    def setPainted(self, state):
+        """ Turns painter mode on or off; the text document is emptied while painting. """
+        self.painted = state
+        self.atlas = None
+        if state:
+            self.clear()
+        self.viewport().update()
+        del state
+
+    def paintRows(self, top, offset, height, font, flags):
+        """
+        Painter mode: text row top of the alignment goes at offset pixels down the viewport and every row is height
+        pixels, matching the name and ruler panes. Font is the one the window draws the alignment in, and flags are
+        (colors, rulers, dssp) as drawn by the window.
+        """
+        self.topRow = top
+        self.rowOffset = offset
+        self.rowHeight = height
+        self.cellFont = QFont(font)
+        self.ssFont.setPointSize(font.pointSize())
+        self.flags = flags
+        self.viewport().update()
+        del top, offset, height, font, flags
+
+    def rowsPerLine(self):
+        return len(self.store) + int(self.flags[1]) + int(self.flags[2]) + 1
+
+    def glyphAtlas(self):
+        """ Atlas for the current fonts and palette, rebuilt (it is only a few dozen cells) when either changes. """
+        charW = utilities.fontMetrics(self.cellFont.family(), self.cellFont.pointSize()).charWidth
+        key = (self.cellFont.key(), self.ssFont.key(), charW, self.rowHeight, id(self.store.palette))
+        if self.atlas is None or key != self.atlasKey:
+            self.atlas = GlyphAtlas(self.cellFont, self.ssFont, charW, self.rowHeight)
+            self.atlasKey = key
+        del key
+        return self.atlas, charW
+
+    def paintEvent(self, event):
+        if not self.painted:
+            return super().paintEvent(event)
+        painter = QPainter(self.viewport())
+        painter.fillRect(event.rect(), self.palette().base())
+        if self.store is not None and len(self.store) and self.chars and self.lines:
+            atlas, charW = self.glyphAtlas()
+            margin = self.document().documentMargin()
+            base = self.palette().base().color().name()
+            text = self.palette().text().color().name()
+            per = self.rowsPerLine()
+            first = self.topRow + max(0, floor((event.rect().top() - self.rowOffset) / self.rowHeight))
+            last = min(self.lines * per,
+                       self.topRow + ceil((event.rect().bottom() - self.rowOffset) / self.rowHeight) + 1)
+            fragments = []
+            for row in range(first, last):
+                y = self.rowOffset + (row - self.topRow) * self.rowHeight
+                for column, cell in self.rowCells(row, per, base, text):
+                    fragments.append(QPainter.PixmapFragment.create(
+                        QPointF(margin + column * charW + atlas.width / 2, y + atlas.height / 2),
+                        atlas.source(*cell)))
+            painter.drawPixmapFragments(fragments, atlas.pixmap)
+            del atlas, charW, margin, base, text, per, first, last, fragments
+        painter.end()
+        del painter, event
+
+    def rowCells(self, row, per, base, text):
+        """ Painter mode: (column, atlas cell) for everything on one text row, laid out the same as fancyLines. """
+        return utilities.rowCells(self.store, self.chars, self.lines, self.flags, row, base, text)
+
+    def cellAt(self, pos):
+        """ Painter mode: (residue, true residue IDs as from getSeqPos) under a viewport position, or None. """
+        if self.store is None or not self.chars or not self.lines:
+            return None
+        per = self.rowsPerLine()
+        row = self.topRow + floor((pos.y() - self.rowOffset) / self.rowHeight)
+        line, seqi = divmod(row, per)
+        seqi -= int(self.flags[1]) + int(self.flags[2])
+        column = floor((pos.x() - self.document().documentMargin()) /
+                       utilities.fontMetrics(self.cellFont.family(), self.cellFont.pointSize()).charWidth)
+        tpos = line * self.chars + column
+        if not 0 <= seqi < len(self.store) or not 0 <= column < self.chars or not 0 <= tpos < self.store.width:
+            return None
+        resids = [[seqi, int(self.store.resids[seqi, tpos]), tpos]] + \
+                 [[n, int(self.store.resids[n, tpos]), tpos] for n in range(len(self.store)) if n != seqi]
+        resn = chr(self.store.residues[seqi, tpos])
+        del pos, per, row, line, seqi, column, tpos
+        return resn, resids
+
     def mouseMoveEvent(self, event):
         if self.tracking:
             self.mousePressEvent(event)
@@ -397,6 +579,15 @@ class AlignPane(QTextEdit):
             super().mouseMoveEvent(event)
 
     def mousePressEvent(self, event):
+        if self.painted:
+            cell = self.cellAt(event.pos())
+            if cell:
+                self.showTT(event.globalPos(), *cell)
+            else:
+                QToolTip.hideText()
+            self.tracking = True
+            del cell, event
+            return
         self.setTextCursor(self.cursorForPosition(event.pos()))
         self.moveCursor(QTextCursor.NextCharacter, mode=QTextCursor.KeepAnchor)
         curs = self.textCursor()
@@ -413,9 +604,575 @@ class AlignPane(QTextEdit):
         del curs
 
     def mouseDoubleClickEvent(self, event):
+        if self.painted:
+            cell = self.cellAt(event.pos())
+            if cell and cell[0] in ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K',
+                                    'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y']:
+                self.commentAdded.emit(cell[1][0])
+            del cell, event
+            return
         self.setTextCursor(self.cursorForPosition(event.pos()))
         self.moveCursor(QTextCursor.NextCharacter, mode=QTextCursor.KeepAnchor)
         curs = self.textCursor()
         self.annoReq.emit(curs)
         del curs
 
+
+
+class OverviewPane(QWidget):
+    """
+    Whole-alignment minimap: sequences down, columns across, downsampled into a small image by averaging blocks of
+    the color layer of the residue store with array reductions. The image is built once per change of the store and
+    only scaled when painting, so it stays cheap for very large alignments.
+    The columns currently in view are outlined; clicking or dragging emits jump with the column under the mouse.
+    Right-click switches between theme colors and a track of one of the column statistics (see stats.METRICS),
+    drawn as a bar per column, averaged the same way, with its height the 0 to 1 score of the column.
+    """
+    jump = pyqtSignal(int)
+    MAXROWS = 256
+    MAXCOLS = 2048
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.store = None
+        self.mode = "colors"
+        self.image = None
+        self.view = (0, 0)
+        self.setMinimumHeight(24)
+        self.setMaximumHeight(60)
+        self.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed))
+        self.setCursor(Qt.PointingHandCursor)
+        self.setToolTip("Alignment overview; click to jump")
+
+    def sizeHint(self):
+        return QSize(200, 40)
+
+    def setStore(self, store):
+        self.store = store
+        self.image = None
+        self.update()
+        del store
+
+    def setMode(self, mode):
+        self.mode = mode
+        self.image = None
+        self.update()
+        del mode
+
+    def setView(self, start, end):
+        """ Columns currently in view, outlined on the overview. """
+        if (start, end) != self.view:
+            self.view = (start, end)
+            self.update()
+        del start, end
+
+    def colorBands(self):
+        """ Function giving the packed colors of a band of rows (a slice) of the color layer. """
+        lut = packRGB(paletteRGB(self.store.palette))
+        def band(rows):
+            return lut.take(self.store.colors[rows])
+        return band
+
+    def trackImage(self):
+        """ Column statistic of the current mode as bars, white through to a deep blue as the score rises. """
+        m = self.store.width
+        w, h = min(m, self.MAXCOLS), self.MAXROWS // 4
+        colEdges = (numpy.arange(w) * m) // w
+        score = self.store.columnStats().score(self.mode)
+        score = numpy.add.reduceat(score, colEdges) / numpy.diff(numpy.append(colEdges, m))
+        ramp = (255 - numpy.outer(score, [200, 160, 60])).astype(numpy.uint8)
+        filled = (h - numpy.arange(h))[:, None] <= numpy.ceil(score * h)[None, :]
+        pixels = numpy.where(filled[..., None], ramp[None, :, :], numpy.uint8(255))
+        self.image = rgbImage(pixels)
+        del m, w, h, colEdges, score, ramp, filled, pixels
+
+    def buildImage(self):
+        """ Averages blocks of rows and columns down to at most MAXROWS x MAXCOLS pixels. """
+        if self.mode in stats.METRICS:
+            self.trackImage()
+            return
+        n, m = self.store.residues.shape
+        h, w = min(n, self.MAXROWS), min(m, self.MAXCOLS)
+        rowEdges = (numpy.arange(h + 1) * n) // h
+        colEdges = (numpy.arange(w) * m) // w
+        colSizes = numpy.diff(numpy.append(colEdges, m))
+        rowSizes = numpy.diff(rowEdges)
+        band = self.colorBands()
+        summed = numpy.empty((h, w), dtype=numpy.uint64)
+        # A few dozen output rows at a time keeps the full-size band small
+        for r in range(0, h, 32):
+            end = min(h, r + 32)
+            packed = numpy.add.reduceat(band(slice(rowEdges[r], rowEdges[end])), colEdges, axis=1)
+            summed[r:end] = numpy.add.reduceat(packed, rowEdges[r:end] - rowEdges[r], axis=0)
+            del end, packed
+        pixels = unpackRGB(summed, (rowSizes[:, None] * colSizes[None, :]).astype(numpy.uint64))
+        self.image = rgbImage(pixels)
+        del n, m, h, w, rowEdges, rowSizes, colEdges, colSizes, band, summed, pixels
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        if self.store is not None and len(self.store) and self.store.width:
+            if self.image is None:
+                self.buildImage()
+            painter.drawImage(self.rect(), self.image)
+            start, end = self.view
+            if end > start:
+                x = int(start * self.width() / self.store.width)
+                width = max(2, int((end - start) * self.width() / self.store.width))
+                painter.setPen(QColor(Qt.black))
+                painter.setBrush(QColor(0, 0, 0, 40))
+                painter.drawRect(x, 0, width - 1, self.height() - 1)
+                del x, width
+            del start, end
+        painter.end()
+        del painter, event
+
+    def columnAt(self, x):
+        return min(self.store.width - 1, max(0, int(x * self.store.width / max(1, self.width()))))
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton and self.store is not None and self.store.width:
+            self.jump.emit(self.columnAt(event.pos().x()))
+        del event
+
+    def mouseMoveEvent(self, event):
+        if event.buttons() & Qt.LeftButton and self.store is not None and self.store.width:
+            self.jump.emit(self.columnAt(event.pos().x()))
+        del event
+
+    def contextMenuEvent(self, event):
+        menu = QMenu(self)
+        modes = {menu.addAction("Theme colors"): "colors"}
+        menu.addSeparator()
+        for metric, label in stats.METRICS.items():
+            modes[menu.addAction(label + " track")] = metric
+        for action, mode in modes.items():
+            action.setCheckable(True)
+            action.setChecked(self.mode == mode)
+        chosen = menu.exec_(event.globalPos())
+        if chosen in modes:
+            self.setMode(modes[chosen])
+        del menu, modes, chosen, event
+
+
+class TrackPane(QWidget):
+    """
+    Consensus and compact sequence logo under the alignment, lined up with the columns in view: the wrapped line at the
+    top of the view, or the columns scrolled to when not wrapping. Both come from the residue frequencies of the store
+    (see stats.ColumnStats). Each stretch of columns is drawn into an image the first time it is in view and kept
+    until the wrap width, font or store change, so scrolling back over a line never draws it again.
+    """
+    LOGOROWS = 2
+    CACHED = 64
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.store = None
+        self.colors = None
+        self.view = (0, 0)
+        self.grid = None
+        self.images = OrderedDict()
+        self.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed))
+        self.setToolTip("Sequence logo and consensus of the columns in view")
+
+    def setStore(self, store, colors):
+        """ Store to draw, and the logo color of each residue of stats.AMINO then X, as color names. """
+        self.store = store
+        self.colors = colors
+        self.images.clear()
+        self.update()
+        del store, colors
+
+    def setGrid(self, font, charWidth, lineSpacing, origin):
+        """ Font and character cell of the alignment, and the x of its first column on this pane. """
+        grid = (font.family(), font.pointSize(), charWidth, lineSpacing, origin)
+        if grid != self.grid:
+            self.grid = grid
+            self.images.clear()
+            self.setFixedHeight(int(ceil(lineSpacing * (self.LOGOROWS + 1))) + 2)
+            self.update()
+        del font, charWidth, lineSpacing, origin, grid
+
+    def setView(self, start, end):
+        """ Columns to show; a new wrap width means new stretches of columns, so the old images are dropped. """
+        if end - start != self.view[1] - self.view[0]:
+            self.images.clear()
+        if (start, end) != self.view:
+            self.view = (start, end)
+            self.update()
+        del start, end
+
+    def drawTrack(self, start, end):
+        """ Logo letters stacked by their share of the information in each column, over the consensus row. """
+        family, size, charWidth, lineSpacing, origin = self.grid
+        columnStats = self.store.columnStats()
+        logo = columnStats.logo()[:, start:end]
+        consensus = columnStats.consensus()[start:end].tobytes().decode('ascii')
+        height = lineSpacing * self.LOGOROWS
+        image = QImage(int(ceil(charWidth * (end - start))) + 1, self.height(), QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        font = QFont(family, size)
+        font.setBold(True)
+        painter.setFont(font)
+        metrics = QFontMetricsF(font)
+        letters = stats.AMINO + "X"
+        for column in range(end - start):
+            bottom = height
+            heights = logo[:, column] * height
+            # Smallest at the bottom, so the best conserved residue is on top
+            for symbol in numpy.argsort(heights).tolist():
+                if heights[symbol] < 1:
+                    continue
+                rect = metrics.tightBoundingRect(letters[symbol])
+                painter.save()
+                painter.translate(column * charWidth + charWidth * 0.05, bottom)
+                painter.scale(charWidth * 0.9 / max(1, rect.width()), heights[symbol] / max(1, rect.height()))
+                painter.setPen(QColor(self.colors[symbol]))
+                painter.drawText(QPointF(-rect.left(), -rect.bottom()), letters[symbol])
+                painter.restore()
+                bottom -= heights[symbol]
+                del rect
+        painter.setFont(QFont(family, size))
+        painter.setPen(self.palette().text().color())
+        painter.drawText(QPointF(0, height + QFontMetricsF(QFont(family, size)).ascent()), consensus)
+        painter.end()
+        del family, size, charWidth, lineSpacing, origin, columnStats, logo, consensus, height, painter, font, \
+            metrics, letters
+        return image
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        start, end = self.view
+        if self.store is not None and self.grid is not None and end > start:
+            if (start, end) not in self.images:
+                self.images[(start, end)] = self.drawTrack(start, end)
+                while len(self.images) > self.CACHED:
+                    self.images.popitem(last=False)
+            self.images.move_to_end((start, end))
+            painter.drawImage(QPointF(self.grid[4], 0), self.images[(start, end)])
+        painter.end()
+        del painter, event, start, end
+
+
+class HeatmapPane(QWidget):
+    """
+    Square heatmap of a sequences x sequences matrix of percentages, rows and columns in the given order, from white
+    at the lowest value in the matrix to a deep blue at 100. Built once into an image of at most MAXSIZE pixels a side,
+    averaging blocks of cells for larger matrices, and only scaled when painting. Hovering shows the pair under the
+    mouse and its value.
+    """
+    MAXSIZE = 2048
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.matrix = None
+        self.names = []
+        self.order = []
+        self.image = None
+        self.setMinimumSize(300, 300)
+        self.setMouseTracking(True)
+
+    def setMatrix(self, matrix, names, order):
+        self.matrix = matrix
+        self.names = names
+        self.order = numpy.asarray(order)
+        self.image = None
+        self.update()
+        del matrix, names, order
+
+    def buildImage(self):
+        ordered = self.matrix[numpy.ix_(self.order, self.order)]
+        n = len(ordered)
+        if n > self.MAXSIZE:
+            edges = (numpy.arange(self.MAXSIZE) * n) // self.MAXSIZE
+            sizes = numpy.diff(numpy.append(edges, n))
+            ordered = numpy.add.reduceat(numpy.add.reduceat(ordered, edges, axis=0), edges, axis=1) / \
+                numpy.outer(sizes, sizes)
+            del edges, sizes
+        low = float(ordered.min())
+        score = (ordered - low) / max(1e-6, 100 - low)
+        self.image = rgbImage((255 - score[..., None] * numpy.array([200, 160, 60])).astype(numpy.uint8))
+        del ordered, n, low, score
+
+    def square(self):
+        side = min(self.width(), self.height())
+        return QRectF((self.width() - side) / 2, (self.height() - side) / 2, side, side)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().window())
+        if self.matrix is not None and len(self.matrix):
+            if self.image is None:
+                self.buildImage()
+            painter.drawImage(self.square(), self.image)
+        painter.end()
+        del painter, event
+
+    def mouseMoveEvent(self, event):
+        if self.matrix is not None and len(self.matrix):
+            square = self.square()
+            n = len(self.matrix)
+            col = int((event.pos().x() - square.left()) * n / square.width())
+            row = int((event.pos().y() - square.top()) * n / square.height())
+            if 0 <= row < n and 0 <= col < n:
+                i, j = int(self.order[row]), int(self.order[col])
+                QToolTip.showText(event.globalPos(), "%s / %s: %.1f%%" % (self.names[i], self.names[j],
+                                                                          self.matrix[i, j]))
+                del i, j
+            else:
+                QToolTip.hideText()
+            del square, n, col, row
+        del event
+
+
+class JobPane(QWidget):
+    """
+    Lists the jobs of an AlignQueue with their state and run time, and sets how many run at once and how many threads
+    each gets. Selected jobs that have not finished can be cancelled.
+    """
+
+    def __init__(self, queue, cores, parent=None):
+        super().__init__(parent)
+        self.queue = queue
+        self.jobTree = QTreeWidget()
+        self.jobTree.setHeaderLabels(["Alignment", "Sequences", "State"])
+        self.jobTree.setRootIsDecorated(False)
+        self.jobTree.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.spinJobs = QSpinBox()
+        self.spinJobs.setRange(1, cores)
+        self.spinJobs.setValue(queue.maxJobs)
+        self.spinJobs.setToolTip("Alignments that may run at the same time")
+        self.spinThreads = QSpinBox()
+        self.spinThreads.setRange(1, cores)
+        self.spinThreads.setValue(queue.threads)
+        self.spinThreads.setToolTip("Clustal Omega threads for each alignment")
+        self.buttonCancel = QPushButton("Cancel")
+        self.buttonClear = QPushButton("Clear Finished")
+        layout = QGridLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.jobTree, 0, 0, 1, 4)
+        layout.addWidget(QLabel("Jobs"), 1, 0)
+        layout.addWidget(self.spinJobs, 1, 1)
+        layout.addWidget(QLabel("Threads"), 1, 2)
+        layout.addWidget(self.spinThreads, 1, 3)
+        layout.addWidget(self.buttonCancel, 2, 0, 1, 2)
+        layout.addWidget(self.buttonClear, 2, 2, 1, 2)
+        # Only the run times change while nothing happens, so a slow tick is enough
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.refresh)
+        self.queue.changed.connect(self.refresh)
+        self.spinJobs.valueChanged.connect(self.setLimits)
+        self.spinThreads.valueChanged.connect(self.setLimits)
+        self.buttonCancel.clicked.connect(self.cancelSelected)
+        self.buttonClear.clicked.connect(self.queue.clearFinished)
+        del queue, cores, parent, layout
+
+    def refresh(self):
+        selected = {item.data(0, Qt.UserRole) for item in self.jobTree.selectedItems()}
+        self.jobTree.clear()
+        for job in self.queue.jobs:
+            state = job.state
+            if job.started is not None:
+                state += " %d:%02d" % divmod(int(job.runtime()), 60)
+            if job.error:
+                state += ": " + job.error
+            item = QTreeWidgetItem([job.title, str(job.count), state])
+            item.setData(0, Qt.UserRole, job.jid)
+            self.jobTree.addTopLevelItem(item)
+            item.setSelected(job.jid in selected)
+        if self.queue.active():
+            self.timer.start()
+        else:
+            self.timer.stop()
+        del selected
+
+    def setLimits(self):
+        self.queue.setLimits(self.spinJobs.value(), self.spinThreads.value())
+
+    def cancelSelected(self):
+        selected = {item.data(0, Qt.UserRole) for item in self.jobTree.selectedItems()}
+        for job in self.queue.jobs:
+            if job.jid in selected:
+                self.queue.cancel(job)
+        del selected
+
+
+class BlockPane(QAbstractScrollArea):
+    """
+    Zoomed-out view of an alignment below legible text sizes: every residue is a solid cell of its background color,
+    straight from the color layer of the residue store, wrapped to the width like the text view. Zoom is in pixels per
+    column; below one, neighbouring columns are averaged into a pixel. Only the wrapped lines in view become images,
+    and those are kept until the zoom, width or colors change. Hovering shows the residue under the mouse.
+    """
+    MARGIN = 4
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.store = None
+        self.names = []
+        self.zoom = 1
+        self.lut = None
+        self.images = {}
+        self.setMouseTracking(True)
+        self.viewport().setMouseTracking(True)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        self.setSizePolicy(QSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding))
+        self.verticalScrollBar().valueChanged.connect(self.viewport().update)
+
+    def setStore(self, store, names):
+        self.store = store
+        self.names = names
+        self.lut = paletteRGB(store.palette)
+        self.relayout()
+        del store, names
+
+    def setZoom(self, zoom):
+        if zoom != self.zoom:
+            fraction = self.verticalScrollBar().value() / max(1, self.verticalScrollBar().maximum())
+            self.zoom = zoom
+            self.relayout()
+            self.verticalScrollBar().setValue(int(fraction * self.verticalScrollBar().maximum()))
+            del fraction
+        del zoom
+
+    def rowHeight(self):
+        return max(1, int(self.zoom))
+
+    def lineHeight(self):
+        return len(self.store) * self.rowHeight() + max(3, 2 * self.rowHeight())
+
+    def columnsPerLine(self):
+        """ Columns on each wrapped line; a whole number of pixels' worth when several columns share a pixel. """
+        pixels = max(1, self.viewport().width() - 2 * self.MARGIN)
+        if self.zoom >= 1:
+            return max(1, int(pixels / self.zoom))
+        return max(1, pixels) * int(round(1 / self.zoom))
+
+    def lines(self):
+        return -(-self.store.width // self.columnsPerLine())
+
+    def relayout(self):
+        self.images = {}
+        if self.store is not None and len(self.store):
+            bar = self.verticalScrollBar()
+            bar.setRange(0, max(0, self.lines() * self.lineHeight() - self.viewport().height()))
+            bar.setPageStep(self.viewport().height())
+            bar.setSingleStep(max(1, self.lineHeight() // 4))
+            del bar
+        self.viewport().update()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.store is not None:
+            self.relayout()
+
+    def lineImage(self, line):
+        """ Image of one wrapped line: a row of cells per sequence, averaged or widened to the zoom. """
+        image = self.images.get(line)
+        if image is None:
+            chars = self.columnsPerLine()
+            start = line * chars
+            end = min(self.store.width, start + chars)
+            colors = self.store.colors[:, start:end]
+            if self.zoom >= 1:
+                pixels = numpy.repeat(self.lut[colors], int(self.zoom), axis=1)
+            else:
+                edges = numpy.arange(0, end - start, int(round(1 / self.zoom)))
+                summed = numpy.add.reduceat(packRGB(self.lut)[colors], edges, axis=1)
+                pixels = unpackRGB(summed, numpy.diff(numpy.append(edges, end - start)).astype(numpy.uint64))
+                del edges, summed
+            image = rgbImage(numpy.repeat(pixels, self.rowHeight(), axis=0))
+            self.images[line] = image
+            del chars, start, end, colors, pixels
+        return image
+
+    def paintEvent(self, event):
+        painter = QPainter(self.viewport())
+        painter.fillRect(event.rect(), self.palette().base())
+        if self.store is not None and len(self.store) and self.store.width:
+            top = self.verticalScrollBar().value()
+            height = self.lineHeight()
+            for line in range(top // height, min(self.lines(), (top + self.viewport().height()) // height + 1)):
+                painter.drawImage(self.MARGIN, line * height - top + self.MARGIN, self.lineImage(line))
+            del top, height
+        painter.end()
+        del painter, event
+
+    def cellAt(self, pos):
+        """ (sequence index, column) under a viewport position, or None. """
+        if self.store is None or not len(self.store):
+            return None
+        y = pos.y() + self.verticalScrollBar().value() - self.MARGIN
+        line, row = divmod(y, self.lineHeight())
+        seqi = row // self.rowHeight()
+        column = line * self.columnsPerLine() + int((pos.x() - self.MARGIN) / self.zoom)
+        if y < 0 or pos.x() < self.MARGIN or seqi >= len(self.store) or not \
+                line * self.columnsPerLine() <= column < min(self.store.width, (line + 1) * self.columnsPerLine()):
+            return None
+        del pos, y, line, row
+        return seqi, column
+
+    def visibleColumns(self):
+        """ Columns from the first wrapped line at least partly in view to the end of the last. """
+        top = self.verticalScrollBar().value()
+        chars = self.columnsPerLine()
+        start = (top // self.lineHeight()) * chars
+        end = min(self.store.width, ((top + self.viewport().height()) // self.lineHeight() + 1) * chars)
+        del top, chars
+        return start, end
+
+    def scrollToColumn(self, column):
+        self.verticalScrollBar().setValue((column // self.columnsPerLine()) * self.lineHeight())
+        del column
+
+    def mouseMoveEvent(self, event):
+        cell = self.cellAt(event.pos())
+        if cell and cell[0] < len(self.names):
+            seqi, column = cell
+            resid = int(self.store.resids[seqi, column])
+            QToolTip.showText(event.globalPos(), "%s %s of %s" % (chr(self.store.residues[seqi, column]),
+                                                                 resid if resid else "gap", self.names[seqi]))
+            del seqi, column, resid
+        else:
+            QToolTip.hideText()
+        del cell, event
+
+
+def paletteRGB(palette):
+    """
+    Background of every color index in a ResidueStore palette as RGB rows, for drawing residues as solid cells.
+    Residues with no color of their own show grey rather than white, so the shape of the alignment is still visible.
+    """
+    rgb = numpy.array([QColor(bg).getRgb()[:3] for bg, fg in palette], dtype=numpy.uint8)
+    rgb[1:][(rgb[1:] == 255).all(axis=1)] = 200
+    del palette
+    return rgb
+
+
+def packRGB(rgb):
+    """ Packs RGB triplets into one integer with 21 bits per channel, so blocks can be summed in a single pass. """
+    rgb = numpy.asarray(rgb, dtype=numpy.uint64)
+    return rgb[..., 0] | (rgb[..., 1] << numpy.uint64(21)) | (rgb[..., 2] << numpy.uint64(42))
+
+
+def unpackRGB(summed, counts):
+    """ Mean RGB (as uint8 triplets) of packed colors summed over blocks of the given sizes. """
+    mask = numpy.uint64((1 << 21) - 1)
+    rgb = numpy.stack([summed & mask, (summed >> numpy.uint64(21)) & mask, summed >> numpy.uint64(42)], axis=-1)
+    final = (rgb // counts[..., None]).astype(numpy.uint8)
+    del summed, counts, mask, rgb
+    return final
+
+
+def rgbImage(pixels):
+    """ QImage (owning its own data) from a (rows, columns, 3) uint8 array. """
+    pixels = numpy.ascontiguousarray(pixels)
+    h, w = pixels.shape[:2]
+    return QImage(pixels.tobytes(), w, h, 3 * w, QImage.Format_RGB888).copy()
+
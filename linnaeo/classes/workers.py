@@ -0,0 +1,28 @@
+"""
+Entry points of worker processes. Spawned workers load this module before anything else of Linnaeo, so it imports
+nothing beyond the standard library until BLAS has been held to one thread, which numpy only reads when it is first
+loaded: the workers already share the cores out between them.
+"""
+import os
+
+BLAS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS")
+_encoded = None
+
+
+def initIdentity(data, shape):
+    """
+    Pool initializer for stats.pairwiseIdentity: one thread of BLAS, then the alignment one-hot encoded once for
+    every block of rows this worker takes. The alignment comes as bytes so that unpickling it doesn't load numpy.
+    """
+    global _encoded
+    for name in BLAS:
+        os.environ[name] = "1"
+    import numpy
+    from linnaeo.classes import stats
+    _encoded = stats.oneHot(numpy.frombuffer(data, dtype=numpy.uint8).reshape(shape))
+    del data, shape, name
+
+
+def identityRows(start, end):
+    from linnaeo.classes import stats
+    return stats.identityBlock(_encoded, start, end)
@@ -13,10 +13,10 @@ import psutil
 from Bio.Align import MultipleSeqAlignment
 from Bio.Alphabet import generic_protein
 from Bio.Seq import Seq
-from PyQt5.QtCore import Qt, QThreadPool, QFile, QIODevice, QDataStream, QDir
+from PyQt5.QtCore import Qt, QThreadPool, QFile, QIODevice, QDataStream, QDir, QStandardPaths
 from PyQt5.QtGui import QStandardItem, QFontDatabase, QFont, QIcon, QTextCursor, QColor, QFontMetrics, QPalette
 from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QAbstractItemView, qApp, QWidget, QSizePolicy, \
-    QFileDialog, QTextEdit, QTextBrowser
+    QFileDialog, QTextEdit, QTextBrowser, QAction
 
 #from pympler import tracker, refbrowser  # summary, muppy
 
@@ -68,12 +68,27 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
 
         # System instants; status bar and threads
         self.memLabel = QLabel()
+        self.renderLabel = QLabel()
+        self.actionTimings = QAction("Show Render Timings", self)
+        self.actionTimings.setCheckable(True)
+        self.actionImportTheme = QAction("Color Theme...", self)
+        self.actionIdentity = QAction("Percent Identity...", self)
+        self.actionJobs = QAction("Show Alignment Jobs", self)
+        self.actionJobs.setCheckable(True)
         self.mainProcess = psutil.Process(os.getpid())
         self.processTimer = utilities.ProcTimerThread(self)
 
         self.mainLogger = logging.getLogger("Main")
         self.threadpool = QThreadPool()
         self.mainLogger.info("Threading with a maximum of %d threads" % self.threadpool.maxThreadCount())
+        # By default a few alignments share the cores, rather than one taking all of them and the rest waiting
+        cores = self.threadpool.maxThreadCount()
+        jobs = max(1, cores // 4)
+        self.alignQueue = utilities.AlignQueue(self, maxJobs=jobs, threads=max(1, cores // jobs))
+        self.jobPane = widgets.JobPane(self.alignQueue, cores)
+        self.alignCache = utilities.AlignCache(os.path.join(QStandardPaths.writableLocation(
+            QStandardPaths.CacheLocation), "alignments"), utilities.AlignQueue.PARAMS)
+        del cores, jobs
 
         # Project instants and inherent variables for logic.
         self.params = {}
@@ -137,6 +152,8 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
 
     def guiSet(self, trees=None, data=None):
         """ Initialize GUI with default parameters. """
+        # Alignments still queued belong to the workspace being replaced
+        self.alignQueue.cancelAll()
         self.lastClickedTree = None
         self.lastAlignment = {}
         self.windows = {}  # Windows stored as { windex : MDISubWindow }
@@ -152,7 +169,9 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         self.default_params = {'ruler': True, 'colors': True, 'fontsize': 10,
                                'theme': 'Default', 'font': qApp.instance().defFont,
                                'byconsv': False, 'tabbed': False,
-                               'darkmode': False, 'dssp': False,
+                               'darkmode': False, 'dssp': False, 'virtual': True,
+                               'cachemb': 32, 'painter': False, 'overview': True,
+                               'wrap': True, 'logo': False,
                                }
         
         self.params = self.default_params.copy()
@@ -202,6 +221,8 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         self.splitter_2.addWidget(self.bioTree)
         #self.mainLogger.debug("Up to projectTree took %f seconds" % float(time.perf_counter() - self.start))
         self.splitter_2.addWidget(self.projectTree)
+        self.splitter_2.addWidget(self.jobPane)
+        self.jobPane.hide()
         self.mainLogger.debug("Adding all GUI objects took %f seconds" % float(time.perf_counter() - self.start))
 
         self.changeTheme()
@@ -213,7 +234,13 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         self.toolBar.addAction(self.actionOptions)
         # Status bar setup
         self.updateUsage()
+        self.statusBar().addPermanentWidget(self.renderLabel)
         self.statusBar().addPermanentWidget(self.memLabel)
+        self.renderLabel.hide()
+        self.menuWindow.addAction(self.actionTimings)
+        self.menuWindow.addAction(self.actionJobs)
+        self.menuImport.addAction(self.actionImportTheme)
+        self.menuActions.insertAction(self.actionNewFolder, self.actionIdentity)
         #self.mainLogger.debug("After StatusbarUpdate")
 
         # Load
@@ -231,6 +258,7 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         self.actionOpen.triggered.connect(self.openWorkspace)
         self.actionImportSeq.triggered.connect(self.importSequence)
         self.actionImportAlign.triggered.connect(self.importAlignment)
+        self.actionImportTheme.triggered.connect(self.importTheme)
         self.actionExportSeq.triggered.connect(self.exportSequence)
         self.actionExportAlign.triggered.connect(self.exportAlignment)
         self.actionSave.triggered.connect(self.saveWorkspace)
@@ -243,6 +271,7 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
 
         # TOOLS
         self.actionAlign.triggered.connect(self.seqDbClick)
+        self.actionIdentity.triggered.connect(self.showIdentity)
         self.actionNewFolder.triggered.connect(self.addFolder)
         self.actionDelete.triggered.connect(self.deleteNode)
 
@@ -252,6 +281,8 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         self.actionToggle_Tabs.triggered.connect(self.mdiArea.toggleTabs)  # TODO: Set as preference
         self.actionClose.triggered.connect(self.closeTab)
         self.actionClose_all.triggered.connect(self.closeAllTabs)
+        self.actionTimings.toggled.connect(self.toggleTimings)
+        self.actionJobs.toggled.connect(self.jobPane.setVisible)
 
         # HELP
         self.actionOnThemes.triggered.connect(self.openThemeHelp)
@@ -280,6 +311,9 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         self.optionsPane.comboFont.currentFontChanged.connect(self.changeFont)
         self.optionsPane.spinFontSize.valueChanged.connect(self.changeFontSize)
         self.optionsPane.checkStructure.toggled.connect(self.toggleStructure)
+        self.optionsPane.checkLogo.toggled.connect(self.toggleLogo)
+        self.optionsPane.checkPainter.toggled.connect(self.togglePainter)
+        self.optionsPane.checkWrap.toggled.connect(self.toggleWrap)
         self.optionsPane.checkConsv.toggled.connect(self.toggleConsv)
         self.optionsPane.comboReference.currentIndexChanged.connect(self.selectReference)
 
@@ -299,6 +333,7 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
                  #self.optionsPane.comboTheme, self.optionsPane.comboFont, self.optionsPane.spinFontSize,
                  #self.optionsPane.checkConsv, self.optionsPane.comboReference,
                  self.optionsPane.buttonStructure, #self.optionsPane.checkStructure
+                 self.actionTimings, self.actionImportTheme, self.actionIdentity, self.actionJobs,
                  ]
         for signal in slots:
             signal.disconnect()
@@ -369,65 +404,91 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         else:
             self.mainStatus.showMessage("Please select sequences", msecs=3000)
         combo.sort()
-        aligned = self.callAlign(items)
         if items:
-            if combo in self.sequences.values():
-                # If an alignment with this combo has already been made...
-                for key, value in self.sequences.items():
-                    if combo == value:
-                        # Get the window ID for this combo
-                        wid = key
-                        for x in range(len(combo)):
-                            # Check names and rebuild window if different
-                            # TODO: THIS CAN BE DELETED I THINK
-                            if combo[x].name != value[x].name:
-                                self.windows.pop(key)
-                        try:
-                            # Reopen the window, if it exists.
-                            sub = self.windows[wid]
-                            self.openWindow(sub)
-                            del sub
-                        except KeyError:
-                            # Or generate a new window, if it does not.
-                            sub = self.makeNewWindow(wid, aligned)
-                            self.openWindow(sub)
-                            del sub
+            wid = next((key for key, value in self.sequences.items() if value == combo), None)
+            if wid in self.windows and all(new.name == old.name for new, old in zip(combo, self.sequences[wid])):
+                # Already made and its window is still around, so there is nothing to align
+                self.openWindow(self.windows[wid])
             else:
-                # If it hasn't been made yet, add the combo to the main list and make/open window.
-                wid = str(int(self.windex) + 1)
-                self.sequences[wid] = combo
-                sub = self.makeNewWindow(wid, aligned)
-                self.openWindow(sub)
-                self.windex = self.windex + 1
-                del aligned, wid, sub
-        del combo, items
-
-    def callAlign(self, seqarray):
+                self.callAlign(items, lambda aligned: self.alignmentReady(combo, aligned))
+            del wid
+        del items
+
+    def alignmentReady(self, combo, aligned):
+        """ Opens the window for a combo of sequences once callAlign has its alignment. """
+        if combo in self.sequences.values():
+            # If an alignment with this combo has already been made...
+            for key, value in self.sequences.items():
+                if combo == value:
+                    # Get the window ID for this combo
+                    wid = key
+                    for x in range(len(combo)):
+                        # Check names and rebuild window if different
+                        # TODO: THIS CAN BE DELETED I THINK
+                        if combo[x].name != value[x].name:
+                            self.windows.pop(key)
+                    try:
+                        # Reopen the window, if it exists.
+                        sub = self.windows[wid]
+                        self.openWindow(sub)
+                        del sub
+                    except KeyError:
+                        # Or generate a new window, if it does not.
+                        sub = self.makeNewWindow(wid, aligned)
+                        self.openWindow(sub)
+                        del sub
+        else:
+            # If it hasn't been made yet, add the combo to the main list and make/open window.
+            wid = str(int(self.windex) + 1)
+            self.sequences[wid] = combo
+            sub = self.makeNewWindow(wid, aligned)
+            self.openWindow(sub)
+            self.windex = self.windex + 1
+            del wid, sub
+        del combo, aligned
+
+    def callAlign(self, seqarray, callback, title=None):
         """
-        Generates a sequence alignment using Clustal Omega in a separate thread. Currently returns with the same
-        order as the nodes were clicked; need to figure out how to return with alignment order.
-        This is also called upon double clicking a single sequence, but just passes it through if so.
+        Queues a sequence alignment with Clustal Omega on the AlignQueue, which calls callback with it when it is done,
+        so the GUI keeps going while it runs. Sequences aligned before are taken from the AlignCache instead, and
+        callback is called straight away. Currently returns with the same order as the nodes were clicked; need to
+        figure out how to return with alignment order.
+        This is also called upon double clicking a single sequence, but just passes it straight through if so.
         """
         # TODO: Do pairwise here if only 2!
         if len(list(seqarray.values())) > 1:
-            # Sort the sequences to prevent duplicates and generate the alignment in a new thread.
-            worker = utilities.AlignThread(self, seqarray, seqtype=3, num_threads=self.threadpool.maxThreadCount())
-            worker.start()
-            worker.finished.connect(worker.deleteLater)
-            worker.finished.connect(worker.quit)
-            worker.wait()
-            aligned = worker.aligned
-            del worker
+            if title is None:
+                names = list(seqarray.keys())
+                title = ", ".join(names[:2]) + (" +%d" % (len(names) - 2) if len(names) > 2 else "")
+                del names
+            aligned = self.alignCache.get(seqarray)
+            if aligned is not None:
+                callback(aligned)
+            else:
+                self.alignQueue.submit(title, seqarray, lambda aligned: self.alignmentDone(seqarray, aligned, callback))
+                self.actionJobs.setChecked(True)
+                self.mainStatus.showMessage("Aligning %s sequences..." % len(seqarray), msecs=3000)
+            del aligned
         #  elif len(list(seqarray.values())) == 2:
         else:
-            aligned = seqarray  # send single sequence
-        return aligned
+            callback(seqarray)  # send single sequence
+        # seqarray and callback live on in the job's callback
+        del title
+
+    def alignmentDone(self, seqarray, aligned, callback):
+        """ Caches a finished alignment before handing it on. """
+        self.alignCache.put(seqarray, aligned)
+        callback(aligned)
+        del seqarray, aligned, callback
 
     def alignmentDbClick(self):
         """ Simple method that confirms you didn't click on a folder, then opens the window """
         # Only a single item is selectable at once in the alignment tree.
         item = self.projectModel.itemFromIndex(self.projectTree.selectedIndexes()[0])
-        if item.data(role=self.WindowRole):
+        if item.data(role=self.WindowRole) and item.data(role=self.WindowRole) not in self.windows:
+            # Reopened workspaces rebuild their alignment windows on the AlignQueue
+            self.mainStatus.showMessage("%s is still being aligned" % item.data(), msecs=3000)
+        elif item.data(role=self.WindowRole):
             sub = self.windows[item.data(role=self.WindowRole)]
             sub.setWindowTitle(item.data())
             self.openWindow(sub)
@@ -538,6 +599,23 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         else:
             return None
 
+    def closeEvent(self, event):
+        """
+        Alignment threads can't be stopped, so closing waits for any still running. Render jobs of the alignment
+        windows are cancelled, and waited for too, so that none is left sending lines to a deleted window.
+        """
+        self.alignQueue.cancelAll()
+        if self.alignQueue.active():
+            self.mainStatus.showMessage("Waiting for running alignments to finish...")
+            qApp.processEvents()
+            self.alignQueue.wait()
+        for sub in self.windows.values():
+            sub.widget().renderer.cancel()
+        QThreadPool.globalInstance().clear()
+        QThreadPool.globalInstance().waitForDone()
+        super().closeEvent(event)
+        del event
+
     def quit(self):
         # TODO: Make this consistent and more reliable.
         # confirm = self.maybeClose()
@@ -606,6 +684,8 @@ class Linnaeo(QMainWindow, methods.Slots, methods.Debug, linnaeo_ui.Ui_MainWindo
         mem = self.mainProcess.memory_full_info().uss / 1000000
         cpu = self.mainProcess.cpu_percent()
         self.memLabel.setText("CPU: " + str(cpu) + " % | RAM: " + str(round(mem, 2)) + " MB")
+        if utilities.RenderTimings.enabled and self._currentWindow:
+            self.renderLabel.setText(self._currentWindow.widget().timings.summary())
 
 
     #def memoryPrint(self):
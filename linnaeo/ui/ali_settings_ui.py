@@ -47,6 +47,15 @@ class Ui_Form(object):
         self.checkStructure.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.checkStructure.setObjectName("checkStructure")
         self.verticalLayout.addWidget(self.checkStructure)
+        self.checkLogo = QtWidgets.QCheckBox(Form)
+        self.checkLogo.setObjectName("checkLogo")
+        self.verticalLayout.addWidget(self.checkLogo)
+        self.checkPainter = QtWidgets.QCheckBox(Form)
+        self.checkPainter.setObjectName("checkPainter")
+        self.verticalLayout.addWidget(self.checkPainter)
+        self.checkWrap = QtWidgets.QCheckBox(Form)
+        self.checkWrap.setObjectName("checkWrap")
+        self.verticalLayout.addWidget(self.checkWrap)
         self.horizontalLayout_3 = QtWidgets.QHBoxLayout()
         self.horizontalLayout_3.setObjectName("horizontalLayout_3")
         spacerItem = QtWidgets.QSpacerItem(30, 20, QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Minimum)
@@ -82,6 +91,10 @@ class Ui_Form(object):
         self.comboTheme.addItem("")
         self.comboTheme.addItem("")
         self.comboTheme.addItem("")
+        self.comboTheme.addItem("")
+        self.comboTheme.addItem("")
+        self.comboTheme.addItem("")
+        self.comboTheme.addItem("")
         self.verticalLayout.addWidget(self.comboTheme)
         self.checkConsv = QtWidgets.QCheckBox(Form)
         self.checkConsv.setEnabled(True)
@@ -144,6 +157,12 @@ class Ui_Form(object):
         self.checkColors.setText(_translate("Form", "Show colors"))
         self.checkStructure.setToolTip(_translate("Form", "Show structure information calculated by DSSP"))
         self.checkStructure.setText(_translate("Form", "Show structure"))
+        self.checkLogo.setToolTip(_translate("Form", "Show the consensus and sequence logo of the columns in view"))
+        self.checkLogo.setText(_translate("Form", "Show consensus"))
+        self.checkPainter.setToolTip(_translate("Form", "Paint residues from cached glyphs instead of laying out text; faster for large alignments"))
+        self.checkPainter.setText(_translate("Form", "Painted alignment"))
+        self.checkWrap.setToolTip(_translate("Form", "Wrap the alignment into lines; off shows one row per sequence with a horizontal scrollbar"))
+        self.checkWrap.setText(_translate("Form", "Wrap lines"))
         self.buttonStructure.setText(_translate("Form", "Get structure"))
         self.label_2.setText(_translate("Form", "Theme"))
         self.comboTheme.setToolTip(_translate("Form", "Choose color theme for alignment"))
@@ -155,6 +174,10 @@ class Ui_Form(object):
         self.comboTheme.setItemText(4, _translate("Form", "ColorSafe"))
         self.comboTheme.setItemText(5, _translate("Form", "Grayscale"))
         self.comboTheme.setItemText(6, _translate("Form", "Rainbow"))
+        self.comboTheme.setItemText(7, _translate("Form", "Identity"))
+        self.comboTheme.setItemText(8, _translate("Form", "Entropy"))
+        self.comboTheme.setItemText(9, _translate("Form", "Occupancy"))
+        self.comboTheme.setItemText(10, _translate("Form", "BLOSUM62"))
         self.checkConsv.setToolTip(_translate("Form", "Color only conserved residues"))
         self.checkConsv.setText(_translate("Form", "Use reference"))
         self.comboReference.setToolTip(_translate("Form", "Choose color theme for alignment"))